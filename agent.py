@@ -4,43 +4,56 @@ AI Agent для помощи в написании кода
 """
 
 import os
+import copy
 import json
 import yaml
 import re
 import time
+import asyncio
+import threading
 from datetime import datetime
 from pathlib import Path
-from typing import List, Dict, Optional, Generator
-import requests
-from rich.console import Console
-from rich.markdown import Markdown
-from dotenv import load_dotenv
+from typing import List, Dict, Optional, Generator, AsyncGenerator, Callable, Iterable, Iterator, Tuple
 
-# Загружаем переменные окружения
-load_dotenv()
+from utils.lazy import Lazy, LazyConsole
 
-# Инициализация console
-console = Console()
+# Консоль (rich) создаётся при первом выводе
+console = LazyConsole()
 
 # Инициализация логирования
 from utils.logger import setup_logger
 logger = setup_logger('code_agent')
 
-# Импорт MCP инструментов
-try:
-    from mcp_tools import MCPToolManager, format_tools_for_prompt
-    MCP_AVAILABLE = True
-except ImportError:
-    MCP_AVAILABLE = False
-    console.print("[yellow]MCP tools not available[/yellow]")
+from utils.http_pool import HTTPPool, request_exceptions, retryable_errors
+from utils.async_http import AsyncHTTPClient, AIOHTTP_AVAILABLE, async_request_errors
+from utils.stream_decoder import StreamDecoder, NDJSON, SSE
+from utils.response_cache import ResponseCache
+from utils.warm_keeper import ModelWarmKeeper
+from utils.retry_policy import RetryPolicy, CircuitBreaker, CircuitOpenError
+from utils.load_balancer import EndpointPool, EndpointRoute, RequestCancelled
+from utils.hedging import Hedger
+from utils.cancellation import CancellationToken
+from utils.local_generation import LocalGeneration
+from utils.model_loader import ModelLoader, LocalModel
+from utils.probe_cache import ProbeCache
+from utils.config_cache import ConfigCache
+from utils.token_counter import TokenCounter
+from utils.token_calibration import TokenCalibrator, CalibratedCounter
+from utils.token_ledger import TokenLedger
+from utils.context_packer import ContextPacker, Segment
+from utils.history_compactor import HistoryCompactor, CompactionJob, SUMMARY_PROMPT, format_transcript
+from utils.prompt_cache_monitor import PromptCacheMonitor, PromptSnapshot, common_prefix_tokens, snapshot
 
-# Импорт контекста проекта
-try:
-    from project_context import ProjectContext, load_project_context
-    PROJECT_CONTEXT_AVAILABLE = True
-except ImportError:
-    PROJECT_CONTEXT_AVAILABLE = False
-    console.print("[yellow]Project context not available[/yellow]")
+_env_loaded = False
+
+
+def load_env():
+    """Переменные окружения из .env (один раз, при создании первого агента, а не при импорте)"""
+    global _env_loaded
+    if not _env_loaded:
+        from dotenv import load_dotenv
+        load_dotenv()
+        _env_loaded = True
 
 # Импорт адаптера модели
 try:
@@ -51,11 +64,21 @@ except ImportError:
     console.print("[yellow]Model adapter not available[/yellow]")
 
 
+class ErrorChunk(str):
+    """
+    Текст ошибки провайдера, отдаваемый в поток вместо ответа модели
+    
+    Ведёт себя как обычная строка для UI, но позволяет отличить сбой от
+    ответа (например, чтобы не положить ошибку в кэш ответов).
+    """
+
+
 class CodeAgent:
     """AI агент для помощи в написании кода"""
     
     def __init__(self, config_path: str = "config.yaml"):
         """Инициализация агента"""
+        load_env()
         self.config = self._load_config(config_path)
         
         # Безопасное получение конфигурации с значениями по умолчанию
@@ -67,16 +90,70 @@ class CodeAgent:
         history_path = agent_config.get('history_path', './history')
         
         self.history: List[Dict] = []
+        self.session_id: Optional[str] = None
+        self.last_stream_stats: Optional[Dict] = None
+        # Ответ последнего запроса получен полностью (поток дошёл до маркера конца,
+        # локальная генерация - до EOS/max_tokens); неполный ответ не кэшируется
+        self._response_complete = True
+        # Токены по данным провайдера: последний запрос и текущий ход (с итерациями инструментов)
+        self.last_usage: Optional[Dict[str, int]] = None
+        self.turn_usage: Dict[str, int] = {'prompt_tokens': 0, 'completion_tokens': 0}
+        # None - сохранять историю согласно agent.save_history
+        self.persist_history: Optional[bool] = None
         self.history_path = Path(history_path)
         self.history_path.mkdir(parents=True, exist_ok=True)
         
-        # Инициализация MCP инструментов
-        self.use_mcp = self.config.get('mcp', {}).get('enabled', True) and MCP_AVAILABLE
-        if self.use_mcp:
-            self.mcp_tools = MCPToolManager()
-            console.print(f"[green]MCP инструменты загружены: {len(self.mcp_tools.list_tools())} доступно[/green]")
-        else:
-            self.mcp_tools = None
+        # Общий пул keep-alive соединений для всех запросов к провайдеру
+        self.http_pool = HTTPPool.from_config(self.config)
+        # Асинхронный клиент для aask() (веб-сервер); без aiohttp aask() работает через потоки
+        self.async_http = AsyncHTTPClient.from_config(self.config) if AIOHTTP_AVAILABLE else None
+        # Единая политика повторов и circuit breaker для запросов генерации
+        # (с пулом эндпоинтов - выключатель основного сервера, см. ниже)
+        self.retry_policy = RetryPolicy.from_config(self.config)
+        self.circuit_breaker = CircuitBreaker.from_config(self.config, name=self.provider)
+        # Хеджирование медленных запросов (None если выключено)
+        self.hedger = Hedger.from_config(self.config)
+        # Маршрут текущего хода диалога (эндпоинт закрепляется на весь ход)
+        self._route: Optional[EndpointRoute] = None
+        # Токен отмены текущего хода и общая статистика отмен
+        self._cancel_token: Optional[CancellationToken] = None
+        self.cancel_stats = {'cancelled': 0, 'tokens_saved': 0}
+        
+        # Кэш ответов для детерминированных запросов (None если выключен)
+        self.response_cache = ResponseCache.from_config(self.config)
+        # Локальная модель transformers с планировщиком батчей и кэшем префиксов
+        # (создаётся в _init_transformers, общая для всех сессий)
+        self.local_model: Optional[LocalModel] = None
+        
+        # MCP инструменты создаются при первом использовании (сборка промпта)
+        self.use_mcp = self.config.get('mcp', {}).get('enabled', True)
+        self._mcp_tools = Lazy(self._create_mcp_tools) if self.use_mcp else None
+        
+        # Стартовые проверки провайдера: кэш на диске, список моделей запрашивается
+        # в фоне параллельно с определением возможностей модели
+        self.probe_cache = ProbeCache.from_config(self.config)
+        self._prefetch_model_list()
+        
+        # Подсчёт токенов: токенизатор модели (загружается при первом подсчёте) или оценка,
+        # калиброванная по расходу токенов, который сообщает провайдер
+        self.token_calibrator = TokenCalibrator.from_config(self.config)
+        self._calibration_key = f"{self.provider}:{self.model_name}"
+        fallback = CalibratedCounter(self.token_calibrator, self._calibration_key) if self.token_calibrator else None
+        self.token_counter = TokenCounter.from_config(self.config, self.model_name, fallback=fallback)
+        # Токены сообщений истории считаются один раз; history_tokens - их сумма
+        self.token_ledger = TokenLedger(self.token_counter)
+        self.history_tokens = 0
+        # Упаковка промпта в окно контекста модели
+        self.context_packer = ContextPacker.from_config(self.config)
+        # Фоновое сжатие старых ходов истории в краткое содержание
+        self.history_compactor = HistoryCompactor.from_config(self.config)
+        self._compaction: Optional[CompactionJob] = None
+        # Неизменное начало промпта и первый ход истории в нём (раскладка stable);
+        # попадания в кэш префиксов сервера
+        self._prompt_prefix = Lazy(self._create_prompt_prefix)
+        self._history_anchor: Optional[Dict] = None
+        self.prompt_cache_monitor = PromptCacheMonitor()
+        self._last_prompt: Optional[PromptSnapshot] = None
         
         # Инициализация адаптера модели
         self.use_adapter = MODEL_ADAPTER_AVAILABLE
@@ -98,7 +175,11 @@ class CodeAgent:
                         base_url = "https://api.anthropic.com/v1"
             
             try:
-                self.model_adapter = create_model_adapter(self.provider, self.model_name, base_url)
+                self.model_adapter = create_model_adapter(
+                    self.provider, self.model_name, base_url,
+                    http_pool=self.http_pool, probe_cache=self.probe_cache,
+                    token_counter=self.token_counter
+                )
                 self.model_adapter.print_info()
                 
                 # Адаптируем конфигурацию под модель
@@ -110,26 +191,15 @@ class CodeAgent:
         else:
             self.model_adapter = None
         
-        # Инициализация контекста проекта
-        self.use_project_context = self.config.get('agent', {}).get('load_project_context', True) and PROJECT_CONTEXT_AVAILABLE
+        # Инициализация контекста проекта (загружается при первом запросе)
+        self.use_project_context = self.config.get('agent', {}).get('load_project_context', True)
         if self.use_project_context:
             # Проверяем, стоит ли включать контекст проекта для этой модели
             if self.use_adapter and self.model_adapter:
                 if not self.model_adapter.should_include_project_context():
                     console.print(f"[yellow]Контекст проекта отключен для модели с маленьким контекстом ({self.model_adapter.capabilities.max_context} токенов)[/yellow]")
                     self.use_project_context = False
-            
-            if self.use_project_context:
-                project_root = self.config.get('agent', {}).get('project_root', '.')
-                try:
-                    self.project_context = load_project_context(project_root)
-                    console.print(f"[green]Контекст проекта загружен: {self.project_context.project_root}[/green]")
-                except Exception as e:
-                    console.print(f"[yellow]Ошибка загрузки контекста проекта: {e}[/yellow]")
-                    self.project_context = None
-                    self.use_project_context = False
-        else:
-            self.project_context = None
+        self._project_context = Lazy(self._create_project_context) if self.use_project_context else None
         
         # Инициализация провайдера
         if self.provider == "ollama":
@@ -144,6 +214,65 @@ class CodeAgent:
             # Пробуем как OpenAI-совместимый API
             console.print(f"[yellow]Провайдер '{self.provider}' не распознан, пробуем как OpenAI-совместимый API[/yellow]")
             self._init_openai_compatible()
+        
+        # Несколько серверов одной модели: балансировка и исключение отказавших
+        server_url = getattr(self, 'ollama_url', None) or getattr(self, 'lmstudio_url', None) or getattr(self, 'openai_url', None)
+        self.endpoints = EndpointPool.from_config(self.config, self.provider, server_url, self.http_pool)
+        if self.endpoints:
+            # Запросы идут через маршруты пула, поэтому состояние основного сервера -
+            # выключатель его эндпоинта (остальные - в endpoints[*].state)
+            self.circuit_breaker = self.endpoints.endpoints[0].breaker
+            self.endpoints.start()
+            if len(self.endpoints.endpoints) > 1:
+                console.print(f"[green]Балансировка между {len(self.endpoints.endpoints)} серверами ({self.endpoints.strategy})[/green]")
+        
+        # Фоновая загрузка модели и поддержание её в памяти сервера
+        self.warm_keeper = ModelWarmKeeper.from_config(self.config, self.http_pool, self.provider, server_url, self.model_name)
+        if self.warm_keeper:
+            self.warm_keeper.start()
+    
+    @property
+    def mcp_tools(self):
+        """MCP инструменты (None если выключены или недоступны)"""
+        return self._mcp_tools.get() if self._mcp_tools else None
+    
+    @property
+    def project_context(self):
+        """Контекст проекта (None если выключен или не загрузился)"""
+        return self._project_context.get() if self._project_context else None
+    
+    def _create_mcp_tools(self):
+        try:
+            from mcp_tools import MCPToolManager
+        except ImportError:
+            console.print("[yellow]MCP tools not available[/yellow]")
+            self.use_mcp = False
+            return None
+        mcp_tools = MCPToolManager()
+        console.print(f"[green]MCP инструменты загружены: {len(mcp_tools.list_tools())} доступно[/green]")
+        return mcp_tools
+    
+    def _create_project_context(self):
+        try:
+            from project_context import load_project_context
+        except ImportError:
+            console.print("[yellow]Project context not available[/yellow]")
+            self.use_project_context = False
+            return None
+        project_root = self.config.get('agent', {}).get('project_root', '.')
+        context_config = self.config.get('context', {})
+        try:
+            project_context = load_project_context(
+                project_root,
+                chunk_cache=context_config.get('chunk_cache', './cache/chunks.json'),
+                chunk_chars=context_config.get('chunk_chars', 2000)
+            )
+            console.print(f"[green]Контекст проекта загружен: {project_context.project_root}[/green]")
+            return project_context
+        except Exception as e:
+            console.print(f"[yellow]Ошибка загрузки контекста проекта: {e}[/yellow]")
+            self.use_project_context = False
+            return None
     
     def _load_config(self, config_path: str) -> Dict:
         """Загрузка и валидация конфигурации"""
@@ -154,13 +283,19 @@ class CodeAgent:
         
         try:
             from utils.file_utils import read_file_safe
-            from utils.config_validator import validate_config
             
             content = read_file_safe(Path(config_path))
             if content is None:
                 logger.warning("Не удалось прочитать конфигурацию, используем значения по умолчанию")
                 return self._default_config()
             
+            # Файл не менялся с прошлого запуска - проверка (и импорт pydantic) не нужна
+            config_cache = ConfigCache()
+            cached = config_cache.get(content)
+            if cached is not None:
+                logger.info("Конфигурация загружена (проверена ранее)")
+                return cached
+            
             config = yaml.safe_load(content)
             if config is None:
                 logger.warning("Конфигурация пуста, используем значения по умолчанию")
@@ -168,10 +303,13 @@ class CodeAgent:
                 return self._default_config()
             
             # Валидация конфигурации
+            from utils.config_validator import validate_config
             is_valid, validated_config, error_msg = validate_config(config)
             if is_valid and validated_config:
                 logger.info("Конфигурация успешно загружена и валидирована")
-                return validated_config.to_dict()
+                validated = validated_config.to_dict()
+                config_cache.put(content, validated)
+                return validated
             else:
                 logger.warning(f"Ошибка валидации конфигурации: {error_msg}, используем как есть")
                 if error_msg:
@@ -196,12 +334,14 @@ class CodeAgent:
                 'provider': 'ollama',
                 'model_name': 'deepseek-coder:6.7b',
                 'device': 'cuda',
+                'lazy_load': False,
                 'generation': {
                     'max_tokens': 4096,
                     'temperature': 0.2,
                     'top_p': 0.95,
                     'top_k': 40,
-                    'repetition_penalty': 1.1
+                    'repetition_penalty': 1.1,
+                    'stop': []
                 }
             },
             'agent': {
@@ -214,10 +354,12 @@ class CodeAgent:
             },
             'ollama': {
                 'base_url': 'http://localhost:11434',
+                'endpoints': [],
                 'timeout': 300
             },
             'lmstudio': {
                 'base_url': 'http://localhost:1234',
+                'endpoints': [],
                 'timeout': 300
             },
             'openai': {
@@ -233,20 +375,152 @@ class CodeAgent:
             'mcp': {
                 'enabled': True,
                 'max_iterations': 5
+            },
+            'http': {
+                'pool_connections': 4,
+                'pool_maxsize': 16,
+                'keep_alive': True,
+                'pool_block': False
+            },
+            'sessions': {
+                'max_sessions': 500,
+                'idle_timeout': 3600,
+                'max_memory_mb': 256
+            },
+            'cache': {
+                'enabled': True,
+                'path': './cache/responses.sqlite',
+                'memory_entries': 256,
+                'max_disk_mb': 100,
+                'ttl': 86400,
+                'max_temperature': 0.0
+            },
+            'compaction': {
+                'enabled': True,
+                'trigger_ratio': 0.5,
+                'keep_turns': 4,
+                'summary_tokens': 512,
+                'idle_delay': 1.0,
+                'max_defer': 30
+            },
+            'context': {
+                'layout': 'stable',
+                'chunk_cache': './cache/chunks.json',
+                'chunk_chars': 2000,
+                'project_share': 0.25,
+                'history_slack': 0.25,
+                'max_files': 3,
+                'max_file_chars': 4000,
+                'max_response_share': 0.5,
+                'recent_turns': 3,
+                'safety_margin': 0.05
+            },
+            'retry': {
+                'max_attempts': 4,
+                'base_delay': 0.5,
+                'max_delay': 10,
+                'deadline': 300,
+                'retry_statuses': [408, 425, 429, 500, 502, 503, 504],
+                'breaker_threshold': 5,
+                'breaker_reset_timeout': 30
+            },
+            'balancer': {
+                'strategy': 'least_outstanding',
+                'ewma_alpha': 0.3,
+                'health_check_interval': 10
+            },
+            'batch': {
+                'concurrency': 4
+            },
+            'continuous_batching': {
+                'enabled': True,
+                'max_batch_size': 8
+            },
+            'prefix_cache': {
+                'enabled': True,
+                'max_memory_mb': 1024,
+                'block_size': 32
+            },
+            'probe_cache': {
+                'enabled': True,
+                'path': './cache/probes.json',
+                'ttl': 600
+            },
+            'token_calibration': {
+                'enabled': True,
+                'path': './cache/token_calibration.json',
+                'decay': 0.98
+            },
+            'tokenizer': {
+                'enabled': True,
+                'memo_entries': 2048
+            },
+            'hedging': {
+                'enabled': False,
+                'delay': 'auto',
+                'percentile': 0.95,
+                'min_delay': 0.5,
+                'max_delay': 10
+            },
+            'warmup': {
+                'enabled': True,
+                'keep_alive': '30m',
+                'ping_interval': 240,
+                'check_interval': 30,
+                'wait_timeout': 120
             }
         }
     
+    def _model_list_probe(self, timeout: float = 10) -> Optional[Tuple[str, Callable[[], Optional[Dict]]]]:
+        """
+        Проверка списка моделей провайдера: ключ кэша и функция запроса
+        
+        Функция возвращает JSON ответа или None, если сервер не ответил 200.
+        None вместо проверки - у провайдера нет списка моделей.
+        """
+        if self.provider == "ollama":
+            base_url = self.config.get('ollama', {}).get('base_url', 'http://localhost:11434')
+            url = f"{base_url}/api/tags"
+        elif self.provider == "lmstudio":
+            base_url = self.config.get('lmstudio', {}).get('base_url', 'http://localhost:1234')
+            url = f"{base_url}/v1/models"
+        else:
+            return None
+        
+        def fetch() -> Optional[Dict]:
+            response = self.http_pool.get(url, timeout=timeout)
+            return response.json() if response.status_code == 200 else None
+        
+        return ProbeCache.key('models', self.provider, base_url), fetch
+    
+    def _fetch_model_list(self, refresh: bool = False) -> Optional[Dict]:
+        """Список моделей провайдера из кэша проверок или от сервера"""
+        probe = self._model_list_probe()
+        if probe is None:
+            return None
+        key, fetch = probe
+        return self.probe_cache.fetch(key, fetch, refresh=refresh)
+    
+    def _prefetch_model_list(self):
+        """Запросить список моделей в фоне, параллельно с определением возможностей модели"""
+        probe = self._model_list_probe()
+        if probe is not None:
+            self.probe_cache.prefetch(*probe)
+    
     def _init_ollama(self):
         """Инициализация Ollama"""
         self.ollama_url = self.config.get('ollama', {}).get('base_url', 'http://localhost:11434')
         self.timeout = self.config.get('ollama', {}).get('timeout', 300)
         
-        # Проверяем доступность Ollama
+        # Проверяем доступность Ollama (список моделей мог быть запрошен в фоне или взят из кэша)
         try:
-            response = requests.get(f"{self.ollama_url}/api/tags", timeout=5)
-            if response.status_code == 200:
-                models = response.json().get('models', [])
-                model_names = [m['name'] for m in models]
+            data = self._fetch_model_list()
+            if data is not None:
+                model_names = [m['name'] for m in data.get('models', [])]
+                if self.model_name not in model_names:
+                    # Сохранённый список мог устареть - перепроверяем у сервера
+                    data = self._fetch_model_list(refresh=True) or data
+                    model_names = [m['name'] for m in data.get('models', [])]
                 console.print(f"[green]Ollama подключен. Доступные модели: {', '.join(model_names)}[/green]")
                 
                 # Проверяем наличие нужной модели
@@ -265,75 +539,40 @@ class CodeAgent:
         self.available_models = []  # Список доступных моделей
         self.lmstudio_model_map = {}  # Маппинг имен моделей
         
+        # Список моделей мог быть запрошен в фоне или сохранён при прошлом запуске
+        try:
+            data = self._fetch_model_list()
+        except Exception:
+            data = None
+        if data is not None:
+            model_ids = [(m.get('id') or m.get('model') or m.get('name') or '').lower() for m in data.get('data', [])]
+            wanted = (self.model_name or '').lower()
+            if wanted and not any(mid and (wanted in mid or mid in wanted) for mid in model_ids):
+                # В сохранённом списке нет даже похожей модели - он мог устареть, перепроверяем у сервера
+                try:
+                    data = self._fetch_model_list(refresh=True) or data
+                except Exception:
+                    pass
+            if self._apply_lmstudio_models(data):
+                return
+        
         # Пробуем несколько раз с разными таймаутами
         for attempt in range(3):
             try:
                 timeout = 5 + (attempt * 5)  # 5, 10, 15 секунд
-                response = requests.get(f"{self.lmstudio_url}/v1/models", timeout=timeout)
+                response = self.http_pool.get(f"{self.lmstudio_url}/v1/models", timeout=timeout)
                 
                 if response.status_code == 200:
                     data = response.json()
-                    models = data.get('data', [])
-                    
-                    # Извлекаем все возможные идентификаторы моделей
-                    model_ids = []
-                    for m in models:
-                        # Пробуем разные поля
-                        model_id = m.get('id') or m.get('model') or m.get('name') or ''
-                        if model_id:
-                            model_ids.append(model_id)
-                            # Сохраняем все варианты имени для поиска
-                            self.lmstudio_model_map[model_id.lower()] = model_id
-                            # Также сохраняем без расширения и с разными вариантами
-                            model_base = model_id.split('/')[-1].split(':')[0].lower()
-                            if model_base not in self.lmstudio_model_map:
-                                self.lmstudio_model_map[model_base] = model_id
-                    
-                    self.available_models = model_ids
-                    
-                    if model_ids:
-                        console.print(f"[green]LM Studio подключен. Найдено моделей: {len(model_ids)}[/green]")
-                        for i, mid in enumerate(model_ids, 1):
-                            console.print(f"  {i}. {mid}")
-                        
-                        # Если модель не указана или не найдена, используем первую доступную
-                        if not self.model_name or self.model_name not in model_ids:
-                            if model_ids:
-                                # Пробуем найти похожую модель (частичное совпадение)
-                                found_model = None
-                                if self.model_name:
-                                    model_name_lower = self.model_name.lower()
-                                    # Сначала пробуем точное совпадение в маппинге
-                                    if model_name_lower in self.lmstudio_model_map:
-                                        found_model = self.lmstudio_model_map[model_name_lower]
-                                    else:
-                                        # Ищем модель с похожим именем
-                                        for mid in model_ids:
-                                            mid_lower = mid.lower()
-                                            # Проверяем различные варианты совпадения
-                                            if (model_name_lower in mid_lower or 
-                                                mid_lower in model_name_lower or
-                                                model_name_lower.split(':')[0] in mid_lower or
-                                                mid_lower.split(':')[0] in model_name_lower):
-                                                found_model = mid
-                                                break
-                                
-                                # Если не нашли похожую, используем первую доступную
-                                self.model_name = found_model or model_ids[0]
-                                if found_model:
-                                    console.print(f"[yellow]Используется похожая модель: {self.model_name}[/yellow]")
-                                else:
-                                    console.print(f"[yellow]Используется первая доступная модель: {self.model_name}[/yellow]")
-                                console.print(f"[cyan]Доступно моделей: {len(model_ids)}. Можно использовать любую из них.[/cyan]")
-                        else:
-                            console.print(f"[green]Используется указанная модель: {self.model_name}[/green]")
-                            console.print(f"[cyan]Доступно моделей: {len(model_ids)}. Можно использовать любую из них.[/cyan]")
+                    self.probe_cache.put(self._model_list_probe()[0], data)
+                    if self._apply_lmstudio_models(data):
                         return
-                    else:
-                        console.print(f"[yellow]Модели не найдены в ответе API[/yellow]")
-                        console.print(f"[yellow]Полный ответ: {data}[/yellow]")
                 
                 elif response.status_code == 502:
+                    if self.config.get('warmup', {}).get('enabled', True):
+                        # Готовность модели отслеживает фоновый ModelWarmKeeper - не ждём здесь
+                        console.print(f"[yellow]LM Studio сервер отвечает, но модель ещё загружается; готовность отслеживается в фоне[/yellow]")
+                        return
                     if attempt < 2:
                         import time
                         wait_time = (attempt + 1) * 3
@@ -349,13 +588,13 @@ class CodeAgent:
                     if attempt < 2:
                         continue
                     
-            except requests.exceptions.Timeout:
+            except request_exceptions().Timeout:
                 if attempt < 2:
                     console.print(f"[yellow]Таймаут подключения, попытка {attempt + 1}/3...[/yellow]")
                     continue
                 else:
                     console.print(f"[yellow]Не удалось подключиться к LM Studio (таймаут)[/yellow]")
-            except requests.exceptions.ConnectionError:
+            except request_exceptions().ConnectionError:
                 if attempt < 2:
                     import time
                     time.sleep(2)
@@ -378,28 +617,103 @@ class CodeAgent:
             console.print(f"[cyan]Наше ПО поддерживает любую модель из LM Studio - просто загрузите её в LM Studio[/cyan]")
             console.print(f"[cyan]Запустите test_lmstudio.py для диагностики подключения[/cyan]")
     
+    def _apply_lmstudio_models(self, data: Dict) -> bool:
+        """
+        Разбор списка моделей LM Studio и выбор модели
+        
+        Returns:
+            True если список содержит модели
+        """
+        models = data.get('data', [])
+        
+        # Извлекаем все возможные идентификаторы моделей
+        model_ids = []
+        for m in models:
+            # Пробуем разные поля
+            model_id = m.get('id') or m.get('model') or m.get('name') or ''
+            if model_id:
+                model_ids.append(model_id)
+                # Сохраняем все варианты имени для поиска
+                self.lmstudio_model_map[model_id.lower()] = model_id
+                # Также сохраняем без расширения и с разными вариантами
+                model_base = model_id.split('/')[-1].split(':')[0].lower()
+                if model_base not in self.lmstudio_model_map:
+                    self.lmstudio_model_map[model_base] = model_id
+        
+        self.available_models = model_ids
+        
+        if model_ids:
+            console.print(f"[green]LM Studio подключен. Найдено моделей: {len(model_ids)}[/green]")
+            for i, mid in enumerate(model_ids, 1):
+                console.print(f"  {i}. {mid}")
+            
+            # Если модель не указана или не найдена, используем первую доступную
+            if not self.model_name or self.model_name not in model_ids:
+                if model_ids:
+                    # Пробуем найти похожую модель (частичное совпадение)
+                    found_model = None
+                    if self.model_name:
+                        model_name_lower = self.model_name.lower()
+                        # Сначала пробуем точное совпадение в маппинге
+                        if model_name_lower in self.lmstudio_model_map:
+                            found_model = self.lmstudio_model_map[model_name_lower]
+                        else:
+                            # Ищем модель с похожим именем
+                            for mid in model_ids:
+                                mid_lower = mid.lower()
+                                # Проверяем различные варианты совпадения
+                                if (model_name_lower in mid_lower or 
+                                    mid_lower in model_name_lower or
+                                    model_name_lower.split(':')[0] in mid_lower or
+                                    mid_lower.split(':')[0] in model_name_lower):
+                                    found_model = mid
+                                    break
+                    
+                    # Если не нашли похожую, используем первую доступную
+                    self.model_name = found_model or model_ids[0]
+                    if found_model:
+                        console.print(f"[yellow]Используется похожая модель: {self.model_name}[/yellow]")
+                    else:
+                        console.print(f"[yellow]Используется первая доступная модель: {self.model_name}[/yellow]")
+                    console.print(f"[cyan]Доступно моделей: {len(model_ids)}. Можно использовать любую из них.[/cyan]")
+            else:
+                console.print(f"[green]Используется указанная модель: {self.model_name}[/green]")
+                console.print(f"[cyan]Доступно моделей: {len(model_ids)}. Можно использовать любую из них.[/cyan]")
+            return True
+        else:
+            console.print(f"[yellow]Модели не найдены в ответе API[/yellow]")
+            console.print(f"[yellow]Полный ответ: {data}[/yellow]")
+        
+        return False
+    
     def _init_transformers(self):
         """Инициализация transformers (для прямого использования моделей)"""
+        loader = ModelLoader.from_config(self.config, self.model_name)
+        self.local_model = LocalModel(loader, self.config)
+        if self.config['model'].get('lazy_load', False):
+            console.print(f"[cyan]Модель {loader.model_path} будет загружена при первом запросе[/cyan]")
+            return
+        self._load_local_model()
+    
+    def _load_local_model(self) -> LocalModel:
+        """Загрузка локальной модели (при старте или при первом запросе)"""
+        if self.local_model.loaded:
+            return self.local_model
         try:
-            import torch
-            from transformers import AutoTokenizer, AutoModelForCausalLM
-            
-            model_path = self.config['model'].get('model_path') or self.model_name
-            device = self.config['model'].get('device', 'cuda')
-            
-            console.print(f"[cyan]Загрузка модели {model_path}...[/cyan]")
-            
-            self.tokenizer = AutoTokenizer.from_pretrained(model_path)
-            self.model = AutoModelForCausalLM.from_pretrained(
-                model_path,
-                torch_dtype=torch.float16 if device == 'cuda' else torch.float32,
-                device_map='auto' if device == 'cuda' else None,
-            )
-            
-            if device == 'cpu':
-                self.model = self.model.to(device)
-            
-            console.print(f"[green]Модель загружена[/green]")
+            console.print(f"[cyan]Загрузка модели {self.local_model.loader.model_path}...[/cyan]")
+            self.local_model.ensure_loaded()
+            stats = self.local_model.get_stats()
+            memory = stats.get('memory_mb', {})
+            if self.local_model.shared:
+                console.print("[green]Модель уже загружена в процессе, используется общий экземпляр[/green]")
+            else:
+                console.print(
+                    f"[green]Модель загружена за {stats.get('load_seconds', 0):.1f}с на {stats.get('device')}"
+                    f" (веса {memory.get('weights', 0):.0f} МБ, RSS {memory.get('rss', 0):.0f} МБ)[/green]"
+                )
+            if self.local_model.batch_engine:
+                console.print(f"[green]Непрерывный батчинг: до {self.local_model.batch_engine.max_batch_size} запросов за шаг[/green]")
+            return self.local_model
         except Exception as e:
             console.print(f"[red]Ошибка загрузки модели: {e}[/red]")
             raise
@@ -435,7 +749,7 @@ class CodeAgent:
                 else:
                     headers['Authorization'] = f'Bearer {self.api_key}'
             
-            response = requests.get(
+            response = self.http_pool.get(
                 f"{self.openai_url}/models",
                 headers=headers,
                 timeout=10
@@ -467,178 +781,344 @@ class CodeAgent:
             console.print(f"[yellow]Не удалось проверить подключение к {self.provider}: {e}[/yellow]")
             console.print(f"[cyan]Продолжаем работу, модель будет использована как указано в конфигурации[/cyan]")
     
+    def _generation_budget(self) -> int:
+        """Лимит генерации одного запроса (max_tokens из конфигурации или адаптера)"""
+        generation_config = self.config.get('model', {}).get('generation', {})
+        if self.use_adapter and self.model_adapter:
+            return generation_config.get('max_tokens', self.model_adapter.capabilities.max_tokens)
+        return generation_config.get('max_tokens', 4096)
+    
     def _estimate_tokens(self, text: str) -> int:
         """Оценивает количество токенов в тексте"""
         if self.use_adapter and self.model_adapter:
             return self.model_adapter.estimate_tokens(text)
-        # Простая оценка: примерно 4 символа на токен
-        return len(text) // 4
+        return self.token_counter.count(text)
     
-    def _build_messages(self, user_prompt: str) -> List[Dict]:
-        """Построение списка сообщений для модели"""
-        messages = []
-        
-        # Оцениваем размер истории
-        history_tokens = sum(self._estimate_tokens(msg.get('content', '')) for msg in self.history[-10:])
+    def _append_history(self, entry: Dict):
+        """Добавить сообщение в историю и учесть его токены в общей сумме"""
+        self.history.append(entry)
+        if self.token_ledger.valid:
+            self.history_tokens += self.token_ledger.count(entry)
+        else:
+            # Счётчик сменился - прежние числа пересчитываются один раз
+            self.history_tokens = self.token_ledger.total(self.history)
+    
+    def get_history_tokens(self) -> int:
+        """Токены всей истории (без повторного подсчёта текста)"""
+        if not self.token_ledger.valid:
+            self.history_tokens = self.token_ledger.total(self.history)
+        return self.history_tokens
+    
+    def _history_summary(self) -> Optional[Dict]:
+        """Запись истории с кратким содержанием сжатых ходов (всегда первая)"""
+        if self.history and self.history[0].get('summary'):
+            return self.history[0]
+        return None
+    
+    def _schedule_compaction(self):
+        """Поставить старые ходы на сжатие, если история заняла много места"""
+        if self._compaction is not None and not self._compaction.done.is_set():
+            return
+        compactor = self.history_compactor
+        turns = self._history_turns()
+        if len(turns) <= compactor.keep_turns:
+            return
+        messages = [msg for turn in turns[:len(turns) - compactor.keep_turns] for msg in turn]
+        budget = self.context_packer.budget(self._context_window(), self._generation_budget()).budget
+        if not compactor.should_compact(self.get_history_tokens(), self.token_ledger.total(messages), budget):
+            return
+        previous = self._history_summary()
+        # Сессия для вызова: модель и соединения общие, состояние хода своё
+        session = self.fork_session(persist_history=False)
+        job = CompactionJob(
+            messages, previous,
+            lambda: session._summarize_history(previous['content'] if previous else None, messages)
+        )
+        self._compaction = job
+        compactor.submit(job)
+    
+    def _summarize_history(self, previous: Optional[str], messages: List[Dict]) -> Tuple[Optional[str], Dict[str, int]]:
+        """Вызов модели для сжатия (фоновый поток, на копии агента из fork_session)"""
+        model_config = dict(self.config.get('model', {}))
+        model_config['generation'] = {
+            **model_config.get('generation', {}),
+            'max_tokens': self.history_compactor.summary_tokens,
+            'temperature': 0.1,
+        }
+        self.config = {**self.config, 'model': model_config}
+        prompt = [
+            {'role': 'system', 'content': SUMMARY_PROMPT},
+            {'role': 'user', 'content': format_transcript(previous, messages)},
+        ]
+        chunks = list(self._dispatch_provider(prompt, stream=False))
+        if any(isinstance(chunk, ErrorChunk) for chunk in chunks):
+            return None, self.turn_usage
+        summary = ''.join(chunks).strip()
+        return summary or None, self.turn_usage
+    
+    def _apply_compaction(self):
+        """Заменить сжатые ходы содержанием (готовое задание, в начале хода)"""
+        job = self._compaction
+        if job is None or not job.done.is_set():
+            return
+        self._compaction = None
+        if job.summary is None:
+            return
+        # История могла быть очищена или заменена, пока шло сжатие
+        start = 1 if job.previous is not None else 0
+        if self._history_summary() is not job.previous:
+            return
+        end = start + len(job.messages)
+        if len(self.history) < end or any(a is not b for a, b in zip(self.history[start:end], job.messages)):
+            return
+        compacted = (job.previous or {}).get('compacted', 0) + len(job.messages)
+        entry = {
+            'role': 'system',
+            'content': job.summary,
+            'summary': True,
+            'compacted': compacted,
+            'timestamp': datetime.now().isoformat()
+        }
+        before = self.get_history_tokens()
+        self.history = [entry] + self.history[end:]
+        self.token_ledger.retain(self.history)
+        self.history_tokens = self.token_ledger.total(self.history)
+        logger.info(
+            f"История сжата: {len(job.messages)} сообщений заменены содержанием, "
+            f"токены истории {before} -> {self.history_tokens}"
+        )
+    
+    def _context_window(self) -> int:
+        """Окно контекста модели в токенах"""
+        if self.use_adapter and self.model_adapter:
+            return self.model_adapter.capabilities.max_context
+        return self.config.get('agent', {}).get('max_context_length', 8192)
+    
+    def _history_turns(self) -> List[List[Dict]]:
+        """История по ходам: запрос пользователя и следующие за ним сообщения (без содержания)"""
+        turns: List[List[Dict]] = []
+        for msg in self.history:
+            if msg.get('summary'):
+                continue
+            if msg.get('role') == 'user' or not turns:
+                turns.append([])
+            turns[-1].append(msg)
+        return turns
+    
+    def _project_segment(self, max_chars: int) -> Optional[Segment]:
+        """Описание проекта для системного промпта (обрезается под свободное место)"""
+        try:
+            project_summary = self.project_context.get_project_summary(max_chars=max_chars)
+        except Exception as e:
+            console.print(f"[yellow]Ошибка добавления контекста проекта: {e}[/yellow]")
+            return None
+        if not project_summary:
+            return None
         
-        # Системный промпт
-        system_prompt = self.config.get('agent', {}).get('system_prompt', '')
+        def frame(summary: str) -> str:
+            return "=" * 60 + "\nКОНТЕКСТ ПРОЕКТА:\n" + "=" * 60 + "\n" + summary + "\n" + "=" * 60
         
-        # Проверяем, стоит ли включать контекст проекта
-        should_include_project = False
-        if self.use_project_context and self.project_context:
+        def cut(chars: int) -> str:
+            # Адаптер сохраняет начало (структура) и конец описания
             if self.use_adapter and self.model_adapter:
-                should_include_project = self.model_adapter.should_include_project_context(history_tokens)
-            else:
-                # Fallback: только если нет истории
-                should_include_project = len(self.history) == 0
-        
-        # Добавляем контекст проекта в системный промпт (только при первом запросе и если разрешено)
-        if should_include_project and len(self.history) == 0:
-            try:
-                # Используем адаптер для определения размера контекста
-                if self.use_adapter and self.model_adapter:
-                    max_project_context = self.model_adapter.get_max_context_for_project()
-                else:
-                    # Fallback на старый метод
-                    max_context_length = self.config.get('agent', {}).get('max_context_length', 8192)
-                    max_project_context = int(max_context_length * 0.3 * 4)
-                
-                project_summary = self.project_context.get_project_summary(max_chars=max_project_context)
-                
-                # Оптимизируем контекст через адаптер
-                if self.use_adapter and self.model_adapter:
-                    project_summary = self.model_adapter.optimize_context(project_summary, max_project_context)
-                
-                if project_summary:
-                    system_prompt += "\n\n" + "=" * 60
-                    system_prompt += "\nКОНТЕКСТ ПРОЕКТА:\n"
-                    system_prompt += "=" * 60 + "\n"
-                    system_prompt += project_summary
-                    system_prompt += "\n" + "=" * 60
-                    console.print(f"[cyan]Контекст проекта добавлен в системный промпт ({len(project_summary)} символов)[/cyan]")
-            except Exception as e:
-                console.print(f"[yellow]Ошибка добавления контекста проекта: {e}[/yellow]")
+                return frame(self.model_adapter.optimize_context(project_summary, chars))
+            return frame(project_summary[:chars] + "\n... [Контекст обрезан]")
         
-        # Добавляем информацию о MCP инструментах в системный промпт
+        return Segment('project', frame(project_summary), priority=4, cut=cut)
+    
+    def _file_segments(self, user_prompt: str) -> List[Segment]:
+        """Фрагменты файлов проекта, подходящие к запросу (обрезаются под свободное место)"""
+        context_config = self.config.get('context', {})
+        try:
+            relevant_files = self.project_context.get_relevant_files_for_query(
+                user_prompt,
+                max_files=context_config.get('max_files', 3),
+                max_file_size=context_config.get('max_file_chars', 4000)
+            )
+        except Exception as e:
+            console.print(f"[yellow]Ошибка загрузки релевантных файлов: {e}[/yellow]")
+            return []
+        
+        def frame(file_path: str, content: str) -> str:
+            return f"Релевантный файл {file_path}:\n```\n{content}\n```\n\n"
+        
+        segments = []
+        for file_path, content in relevant_files.items():
+            segments.append(Segment(
+                f"file:{file_path}", frame(file_path, content), priority=3,
+                cut=lambda chars, file_path=file_path, content=content: frame(
+                    file_path, content[:chars] + "\n... [файл обрезан]"
+                )
+            ))
+        return segments
+    
+    def _create_prompt_prefix(self) -> str:
+        """
+        Неизменный префикс промпта (раскладка stable): системный промпт,
+        инструменты и описание проекта фиксированного размера
+        """
+        parts = [self.config.get('agent', {}).get('system_prompt', '')]
         if self.use_mcp and self.mcp_tools:
-            tools_info = format_tools_for_prompt(self.mcp_tools)
-            if tools_info:
-                system_prompt += "\n\n" + tools_info
+            from mcp_tools import format_tools_for_prompt
+            parts.append(format_tools_for_prompt(self.mcp_tools))
+        if self.use_project_context and self.project_context:
+            budget = self.context_packer.budget(self._context_window(), self._generation_budget()).budget
+            project_segment = self._project_segment(budget * 4)
+            if project_segment is not None:
+                share = self.config.get('context', {}).get('project_share', 0.25)
+                parts.append(self.context_packer.fit(project_segment, int(budget * share), self._estimate_tokens))
+        return "\n\n".join(part for part in parts if part)
+    
+    def _anchored_turns(self, turns: List[List[Dict]]) -> List[List[Dict]]:
+        """Ходы истории, начиная с закреплённого (раскладка stable)"""
+        if self._history_anchor is not None:
+            for index, turn in enumerate(turns):
+                if turn[0] is self._history_anchor:
+                    return turns[index:]
+        return turns
+    
+    def _slide_history(self, kept: List[Segment], budget: int) -> List[Segment]:
+        """
+        История не поместилась: отбросить сразу несколько старых ходов, чтобы
+        следующие ходы снова только дописывались в конец промпта
+        
+        Args:
+            kept: Включённые ходы, от новых к старым
+            budget: Место под промпт
+        """
+        slack = int(budget * self.config.get('context', {}).get('history_slack', 0.25))
+        freed = 0
+        kept = list(kept)
+        while len(kept) > 1 and freed < slack:
+            freed += kept.pop().tokens
+        logger.info(f"Начало истории сдвинуто: оставлено ходов {len(kept)}, освобождено {freed} токенов")
+        return kept
+    
+    def _build_messages(self, user_prompt: str) -> List[Dict]:
+        """
+        Построение списка сообщений для модели
+        
+        Фрагменты промпта упаковываются в окно контекста по приоритету:
+        системный промпт и запрос обязательны, затем описание инструментов,
+        последние ходы истории, содержание сжатых ходов, релевантные файлы,
+        описание проекта и более старые ходы истории (от новых к старым).
+        Место под ответ резервируется заранее (ContextPacker).
+        
+        Раскладка stable (по умолчанию) держит начало промпта неизменным,
+        чтобы сервер (Ollama, LM Studio, llama.cpp) брал его из KV-кэша:
+        системный промпт, инструменты и описание проекта собираются один
+        раз, история начинается с закреплённого хода и сдвигается сразу на
+        несколько ходов, файлы для запроса идут после него в конце промпта.
+        Раскладка packed заполняет окно плотнее, но меняет начало промпта.
+        """
+        context_config = self.config.get('context', {})
+        stable = context_config.get('layout', 'stable') == 'stable'
+        window = self._context_window()
+        generation_budget = self._generation_budget()
+        
+        if stable:
+            segments = [Segment('prefix', self._prompt_prefix.get(), priority=0, required=True, messages=1)]
+        else:
+            segments = [
+                Segment('system', self.config.get('agent', {}).get('system_prompt', ''), priority=0, required=True, messages=1)
+            ]
+            
+            # Описание MCP инструментов: без него модель не сможет их вызвать
+            if self.use_mcp and self.mcp_tools:
+                from mcp_tools import format_tools_for_prompt
+                tools_info = format_tools_for_prompt(self.mcp_tools)
+                if tools_info:
+                    segments.append(Segment('tools', tools_info, priority=1))
+            
+            # Описание проекта - в меру свободного места
+            if self.use_project_context and self.project_context:
+                budget_chars = self.context_packer.budget(window, generation_budget).budget * 4
+                project_segment = self._project_segment(budget_chars)
+                if project_segment is not None:
+                    segments.append(project_segment)
+        
+        # Файлы проекта, подходящие к запросу
+        if self.use_project_context and self.project_context:
+            segments.extend(self._file_segments(user_prompt))
+        
+        # История по ходам: последние ходы важнее файлов проекта, более старый ход
+        # включается, только если включён следующий за ним
+        recent_turns = context_config.get('recent_turns', 3)
+        turns = self._history_turns()
+        if stable:
+            turns = self._anchored_turns(turns)
+        previous = None
+        for age, turn in enumerate(reversed(turns)):
+            name = f"history:{age}"
+            segments.append(Segment(
+                name, '', priority=2 if age < recent_turns else 10 + age,
+                tokens=self.token_ledger.total(turn), messages=len(turn),
+                requires=previous, payload=turn
+            ))
+            previous = name
+        
+        # Краткое содержание сжатых ходов
+        summary_entry = self._history_summary()
+        if summary_entry is not None:
+            summary_text = "КРАТКОЕ СОДЕРЖАНИЕ ПРЕДЫДУЩЕГО РАЗГОВОРА:\n" + summary_entry['content']
+            segments.append(Segment(
+                'summary', summary_text, priority=2,
+                cut=lambda chars: summary_text[:chars] + "\n..."
+            ))
+        
+        segments.append(Segment(
+            'user', user_prompt, priority=0, required=True, messages=1,
+            cut=lambda chars: user_prompt[:chars] + "\n... [запрос обрезан]"
+        ))
+        
+        overhead = self.token_calibrator.message_overhead(self._calibration_key) if self.token_calibrator else 0
+        packed = self.context_packer.pack(segments, window, generation_budget, self._estimate_tokens, overhead)
+        if packed.used > packed.budget:
+            console.print(f"[yellow]⚠ Промпт больше окна контекста ({packed.used}/{packed.budget} токенов)[/yellow]")
+        
+        # Ходы истории от новых к старым
+        history = [segment for segment in packed.included if segment.name.startswith('history:')]
+        if stable:
+            if any(name.startswith('history:') for name in packed.dropped):
+                history = self._slide_history(history, packed.budget)
+            self._history_anchor = history[-1].payload[0] if history else None
+        
+        system_prompt = "\n\n".join(
+            segment.text for segment in packed.included
+            if segment.name in ('prefix', 'system', 'tools', 'project', 'summary') and segment.text
+        )
+        files = "".join(segment.text for segment in packed.included if segment.name.startswith('file:'))
         
+        messages = []
         if system_prompt:
             messages.append({
                 'role': 'system',
                 'content': system_prompt
             })
         
-        # Форматируем сообщения под модель через адаптер
+        # Форматируем системный промпт под модель через адаптер
         if self.use_adapter and self.model_adapter:
             messages = self.model_adapter.format_messages_for_model(messages)
         
-        # Оцениваем текущий размер контекста
-        current_context_tokens = (
-            self._estimate_tokens(system_prompt) +
-            history_tokens +
-            self._estimate_tokens(user_prompt)
-        )
+        # Ходы истории в хронологическом порядке
+        for segment in reversed(history):
+            messages.extend(segment.payload)
         
-        # Определяем доступное место для релевантных файлов
-        if self.use_adapter and self.model_adapter:
-            max_context = self.model_adapter.capabilities.max_context
-            available_tokens = max_context - current_context_tokens - 500  # Оставляем запас для ответа
-            
-            # Для маленьких моделей - не добавляем релевантные файлы если места мало
-            if available_tokens < 200 or max_context <= 4096:
-                console.print(f"[yellow]Мало места для релевантных файлов ({available_tokens} токенов доступно), пропускаем[/yellow]")
-            else:
-                # Добавляем релевантные файлы для текущего запроса (ограниченные)
-                if self.use_project_context and self.project_context:
-                    try:
-                        max_relevant_files_size = self.model_adapter.get_max_relevant_files_size()
-                        # Ограничиваем доступным местом
-                        max_relevant_chars = min(max_relevant_files_size, available_tokens * 3)
-                        max_file_size = min(800, max_relevant_chars // 2)  # Еще более консервативно
-                        
-                        relevant_files = self.project_context.get_relevant_files_for_query(
-                            user_prompt, 
-                            max_files=1,  # Только 1 файл для маленьких моделей
-                            max_file_size=max_file_size
-                        )
-                        if relevant_files:
-                            context_files = "\n\nРелевантный файл:\n"
-                            context_files += "-" * 60 + "\n"
-                            for file_path, content in list(relevant_files.items())[:1]:  # Только первый
-                                context_files += f"\n{file_path}:\n```\n{content}\n```\n"
-                            user_prompt = context_files + "\n" + user_prompt
-                            console.print(f"[cyan]Добавлен 1 релевантный файл ({len(content)} символов)[/cyan]")
-                    except Exception as e:
-                        console.print(f"[yellow]Ошибка загрузки релевантных файлов: {e}[/yellow]")
+        # Текущий запрос: в раскладке stable файлы после него, в конце промпта
+        user_text = packed.get('user').text
+        if stable:
+            content = user_text + ("\n\n" + files.rstrip() if files else "")
         else:
-            # Fallback: не добавляем релевантные файлы для маленьких моделей
-            max_context_length = self.config.get('agent', {}).get('max_context_length', 8192)
-            if max_context_length > 6000 and self.use_project_context and self.project_context:
-                try:
-                    max_relevant_files_size = int(max_context_length * 0.10 * 3)  # 10% консервативно
-                    max_file_size = min(800, max_relevant_files_size // 2)
-                    
-                    relevant_files = self.project_context.get_relevant_files_for_query(
-                        user_prompt, 
-                        max_files=1,
-                        max_file_size=max_file_size
-                    )
-                    if relevant_files:
-                        context_files = "\n\nРелевантный файл:\n"
-                        context_files += "-" * 60 + "\n"
-                        for file_path, content in list(relevant_files.items())[:1]:
-                            context_files += f"\n{file_path}:\n```\n{content}\n```\n"
-                        user_prompt = context_files + "\n" + user_prompt
-                except Exception as e:
-                    console.print(f"[yellow]Ошибка загрузки релевантных файлов: {e}[/yellow]")
-        
-        # История диалога (ограниченная)
-        history_messages = self.history[-10:]  # Последние 10 сообщений
-        
-        # Для маленьких моделей ограничиваем историю
-        if self.use_adapter and self.model_adapter:
-            if self.model_adapter.capabilities.max_context <= 4096:
-                # Для 4K моделей - только последние 3 сообщения
-                history_messages = self.history[-3:]
-            elif self.model_adapter.capabilities.max_context < 6000:
-                # Для 4K-6K моделей - последние 5 сообщений
-                history_messages = self.history[-5:]
-        
-        for msg in history_messages:
-            messages.append(msg)
-        
-        # Текущий запрос
+            content = files + user_text
         messages.append({
             'role': 'user',
-            'content': user_prompt
+            'content': content
         })
         
-        # Финальная проверка размера контекста
-        if self.use_adapter and self.model_adapter:
-            total_tokens = sum(self._estimate_tokens(msg.get('content', '')) for msg in messages)
-            max_context = self.model_adapter.capabilities.max_context
-            
-            if total_tokens > max_context * 0.9:  # Если превышаем 90% контекста
-                console.print(f"[yellow]⚠ Предупреждение: контекст большой ({total_tokens}/{max_context} токенов)[/yellow]")
-                
-                # Агрессивно обрезаем системный промпт если нужно
-                if total_tokens > max_context:
-                    system_msg = messages[0] if messages and messages[0].get('role') == 'system' else None
-                    if system_msg:
-                        # Оставляем только базовый системный промпт
-                        base_prompt = self.config.get('agent', {}).get('system_prompt', '')
-                        if len(system_msg['content']) > len(base_prompt) * 2:
-                            system_msg['content'] = base_prompt + "\n\n[Контекст проекта был удален для экономии токенов]"
-                            console.print("[yellow]Контекст проекта удален из системного промпта для экономии токенов[/yellow]")
-        
         return messages
     
-    def _call_ollama(self, messages: List[Dict], stream: bool = False) -> Generator[str, None, None]:
-        """Вызов Ollama API"""
+    def _prepare_ollama_request(self, messages: List[Dict], stream: bool) -> Tuple[str, Dict, Dict]:
+        """Подготовка запроса к Ollama API: (url, payload, headers)"""
         url = f"{self.ollama_url}/api/chat"
         
         generation_config = self.config.get('model', {}).get('generation', {})
@@ -667,40 +1147,17 @@ class CodeAgent:
                 'num_predict': max_tokens,
             }
         }
-        
-        try:
-            response = requests.post(
-                url,
-                json=payload,
-                stream=stream,
-                timeout=self.timeout
-            )
-            response.raise_for_status()
-            
-            if stream:
-                for line in response.iter_lines():
-                    if line:
-                        try:
-                            data = json.loads(line)
-                            if 'message' in data and 'content' in data['message']:
-                                yield data['message']['content']
-                            if data.get('done', False):
-                                break
-                        except json.JSONDecodeError:
-                            continue
-            else:
-                result = response.json()
-                if 'message' in result and 'content' in result['message']:
-                    yield result['message']['content']
-                else:
-                    yield "Ошибка: неожиданный формат ответа от Ollama"
-                
-        except requests.exceptions.RequestException as e:
-            console.print(f"[red]Ошибка запроса к Ollama: {e}[/red]")
-            yield f"Ошибка: {e}"
+        if generation_config.get('stop'):
+            payload['options']['stop'] = generation_config['stop']
+        
+        # Сколько держать модель в памяти после запроса (согласовано с пингами ModelWarmKeeper)
+        warmup_config = self.config.get('warmup', {})
+        if warmup_config.get('enabled', True) and warmup_config.get('keep_alive'):
+            payload['keep_alive'] = warmup_config['keep_alive']
+        return url, payload, {}
     
-    def _call_lmstudio(self, messages: List[Dict], stream: bool = False) -> Generator[str, None, None]:
-        """Вызов LM Studio API (OpenAI-совместимый)"""
+    def _prepare_lmstudio_request(self, messages: List[Dict], stream: bool) -> Tuple[str, Dict, Dict]:
+        """Подготовка запроса к LM Studio API: (url, payload, headers)"""
         url = f"{self.lmstudio_url}/v1/chat/completions"
         
         generation_config = self.config.get('model', {}).get('generation', {})
@@ -760,144 +1217,17 @@ class CodeAgent:
         # Добавляем дополнительные параметры
         if top_p:
             payload['top_p'] = top_p
+        if generation_config.get('stop'):
+            payload['stop'] = generation_config['stop']
         
-        try:
-            # Увеличиваем таймаут для больших моделей
-            timeout = max(self.timeout, 180)  # Минимум 3 минуты
-            
-            # Пробуем несколько раз с задержками и увеличивающимися таймаутами
-            max_retries = 5
-            response = None
-            
-            for attempt in range(max_retries):
-                try:
-                    # Увеличиваем таймаут с каждой попыткой
-                    current_timeout = timeout + (attempt * 30)  # 180, 210, 240, 270, 300
-                    
-                    response = requests.post(
-                        url,
-                        json=payload,
-                        stream=stream,
-                        timeout=current_timeout,
-                        headers={
-                            'Content-Type': 'application/json',
-                            'Accept': 'application/json'
-                        }
-                    )
-                    
-                    # Если получили 200 - отлично
-                    if response.status_code == 200:
-                        break
-                    
-                    # Если 502 и не последняя попытка - ждем и пробуем снова
-                    if response.status_code == 502 and attempt < max_retries - 1:
-                        import time
-                        wait_time = (attempt + 1) * 10  # 10, 20, 30, 40 секунд
-                        console.print(f"[yellow]Ожидание готовности модели (попытка {attempt + 1}/{max_retries}, ждем {wait_time}с)...[/yellow]")
-                        time.sleep(wait_time)
-                        continue
-                    
-                    # Для других ошибок - пробуем еще раз
-                    if attempt < max_retries - 1:
-                        import time
-                        time.sleep(5)
-                        continue
-                    
-                    # Последняя попытка - выходим
-                    response.raise_for_status()
-                    break
-                    
-                except requests.exceptions.HTTPError as e:
-                    if e.response.status_code == 502 and attempt < max_retries - 1:
-                        import time
-                        wait_time = (attempt + 1) * 10
-                        console.print(f"[yellow]Повторная попытка через {wait_time}с (попытка {attempt + 1}/{max_retries})...[/yellow]")
-                        time.sleep(wait_time)
-                        continue
-                    if attempt < max_retries - 1:
-                        import time
-                        time.sleep(5)
-                        continue
-                    raise
-                except requests.exceptions.Timeout:
-                    if attempt < max_retries - 1:
-                        import time
-                        wait_time = (attempt + 1) * 5
-                        console.print(f"[yellow]Таймаут, повтор через {wait_time}с...[/yellow]")
-                        time.sleep(wait_time)
-                        continue
-                    raise
-            
-            if not response:
-                raise requests.exceptions.RequestException("Не удалось получить ответ после всех попыток")
-            
-            response.raise_for_status()
-            
-            if stream:
-                for line in response.iter_lines():
-                    if line:
-                        try:
-                            line_text = line.decode('utf-8')
-                            # LM Studio может использовать разные форматы
-                            if line_text.startswith('data: '):
-                                data_str = line_text[6:]
-                                if data_str.strip() == '[DONE]':
-                                    break
-                                try:
-                                    data = json.loads(data_str)
-                                    if 'choices' in data and len(data['choices']) > 0:
-                                        delta = data['choices'][0].get('delta', {})
-                                        content = delta.get('content', '')
-                                        if content:
-                                            yield content
-                                except json.JSONDecodeError:
-                                    continue
-                            elif line_text.strip() and not line_text.startswith(':'):
-                                # Пробуем распарсить как JSON напрямую
-                                try:
-                                    data = json.loads(line_text)
-                                    if 'choices' in data and len(data['choices']) > 0:
-                                        delta = data['choices'][0].get('delta', {})
-                                        content = delta.get('content', '')
-                                        if content:
-                                            yield content
-                                except json.JSONDecodeError:
-                                    # Если не JSON, возможно это просто текст
-                                    if line_text.strip() and not line_text.startswith(':'):
-                                        yield line_text
-                        except UnicodeDecodeError:
-                            continue
-            else:
-                result = response.json()
-                if 'choices' in result and len(result['choices']) > 0:
-                    yield result['choices'][0]['message']['content']
-                else:
-                    yield "Ошибка: неожиданный формат ответа"
-                
-        except requests.exceptions.HTTPError as e:
-            if e.response.status_code == 502:
-                error_msg = (
-                    "Ошибка 502: Сервер LM Studio не может обработать запрос.\n\n"
-                    "Возможные причины:\n"
-                    "1. Модель еще загружается - подождите 30-60 секунд\n"
-                    "2. Сервер перегружен - попробуйте позже\n"
-                    "3. Модель слишком большая для системы\n\n"
-                    "Решение:\n"
-                    "- В LM Studio убедитесь, что статус 'READY'\n"
-                    "- Перезапустите Local Server в настройках LM Studio\n"
-                    "- Попробуйте использовать меньшую модель"
-                )
-                console.print(f"[red]{error_msg}[/red]")
-                yield error_msg
-            else:
-                console.print(f"[red]Ошибка HTTP {e.response.status_code}: {e}[/red]")
-                yield f"Ошибка HTTP {e.response.status_code}: {e}"
-        except requests.exceptions.RequestException as e:
-            console.print(f"[red]Ошибка запроса к LM Studio: {e}[/red]")
-            yield f"Ошибка подключения: {e}\n\nУбедитесь, что:\n1. LM Studio запущен\n2. Local Server включен\n3. Модель загружена"
+        headers = {
+            'Content-Type': 'application/json',
+            'Accept': 'application/json'
+        }
+        return url, payload, headers
     
-    def _call_openai_compatible(self, messages: List[Dict], stream: bool = False) -> Generator[str, None, None]:
-        """Вызов OpenAI-совместимого API (OpenAI, Anthropic, кастомные провайдеры)"""
+    def _prepare_openai_request(self, messages: List[Dict], stream: bool) -> Tuple[str, Dict, Dict]:
+        """Подготовка запроса к OpenAI-совместимому API: (url, payload, headers)"""
         url = f"{self.openai_url}/chat/completions"
         
         generation_config = self.config.get('model', {}).get('generation', {})
@@ -938,100 +1268,366 @@ class CodeAgent:
         
         if top_p:
             payload['top_p'] = top_p
+        if generation_config.get('stop'):
+            payload['stop'] = generation_config['stop']
         
         # Для Anthropic нужен другой формат
         if self.provider == "anthropic":
             # Anthropic использует немного другой формат
             payload['max_tokens'] = min(max_tokens, 4096)  # Anthropic ограничивает max_tokens
         
+        return url, payload, headers
+    
+    @staticmethod
+    def _lmstudio_http_error_message(status_code: int, error: str) -> str:
+        """Текст ошибки HTTP от LM Studio для пользователя"""
+        if status_code == 502:
+            return (
+                "Ошибка 502: Сервер LM Studio не может обработать запрос.\n\n"
+                "Возможные причины:\n"
+                "1. Модель еще загружается - подождите 30-60 секунд\n"
+                "2. Сервер перегружен - попробуйте позже\n"
+                "3. Модель слишком большая для системы\n\n"
+                "Решение:\n"
+                "- В LM Studio убедитесь, что статус 'READY'\n"
+                "- Перезапустите Local Server в настройках LM Studio\n"
+                "- Попробуйте использовать меньшую модель"
+            )
+        return f"Ошибка HTTP {status_code}: {error}"
+    
+    @staticmethod
+    def _openai_http_error_message(status_code: int, error_data) -> str:
+        """Текст ошибки HTTP от OpenAI-совместимого API для пользователя"""
+        error_msg = f"Ошибка HTTP {status_code}"
         try:
-            response = requests.post(
-                url,
-                json=payload,
-                headers=headers,
-                stream=stream,
-                timeout=self.timeout
+            if 'error' in error_data:
+                error_msg += f": {error_data['error'].get('message', 'Неизвестная ошибка')}"
+        except Exception:
+            pass
+        return error_msg
+    
+    @staticmethod
+    def _usage_from_event(event: Optional[Dict]) -> Optional[Dict[str, int]]:
+        """
+        Количество токенов из финального события потока (Ollama или OpenAI-совместимый API)
+        
+        Кроме prompt_tokens/completion_tokens: cached_tokens - токены промпта из
+        кэша префиксов сервера (usage.prompt_tokens_details, timings llama.cpp),
+        prompt_eval_ms - время разбора промпта (Ollama, llama.cpp).
+        """
+        if not event:
+            return None
+        if 'eval_count' in event or 'prompt_eval_count' in event:
+            result = {
+                'prompt_tokens': event.get('prompt_eval_count', 0),
+                'completion_tokens': event.get('eval_count', 0),
+            }
+            if event.get('prompt_eval_duration') is not None:
+                result['prompt_eval_ms'] = int(event['prompt_eval_duration'] / 1e6)
+            return result
+        usage = event.get('usage')
+        if usage:
+            result = {
+                'prompt_tokens': usage.get('prompt_tokens', 0) or 0,
+                'completion_tokens': usage.get('completion_tokens', 0) or 0,
+            }
+            details = usage.get('prompt_tokens_details') or {}
+            timings = event.get('timings') or {}
+            if details.get('cached_tokens') is not None:
+                result['cached_tokens'] = details['cached_tokens']
+            elif timings.get('cache_n') is not None:
+                result['cached_tokens'] = timings['cache_n']
+            if timings.get('prompt_ms') is not None:
+                result['prompt_eval_ms'] = int(timings['prompt_ms'])
+            return result
+        return None
+    
+    def _record_usage(self, usage: Optional[Dict[str, int]]):
+        """Учёт расхода токенов последнего запроса и текущего хода"""
+        if usage:
+            self.last_usage = usage
+            self.turn_usage = {key: self.turn_usage.get(key, 0) + value for key, value in usage.items()}
+    
+    def _record_stream_stats(self, decoder: StreamDecoder):
+        """Сохраняет статистику разбора последнего потока и расход токенов"""
+        self.last_stream_stats = decoder.get_stats()
+        logger.debug(f"Разбор потока: {self.last_stream_stats}")
+        self._record_usage(self._usage_from_event(decoder.last_event))
+    
+    @staticmethod
+    def _raise_if_aborted(decoder: StreamDecoder, route: Optional[EndpointRoute]):
+        """
+        Поток оборван отменой запроса (клиент ушёл или попытка хеджирования проиграла)
+        
+        Закрытое соединение выглядит как конец потока - без исключения
+        частичный ответ попал бы в кэш и калибровку как завершённый.
+        """
+        if route is not None and route.aborted and not decoder.done:
+            raise RequestCancelled()
+    
+    def _iter_stream(self, response, decoder: StreamDecoder, route: Optional[EndpointRoute] = None) -> Generator[str, None, None]:
+        """Чтение потокового ответа requests через инкрементальный декодер"""
+        self._response_complete = False
+        try:
+            for chunk in response.iter_content(chunk_size=None):
+                yield from decoder.feed(chunk)
+                if decoder.done:
+                    break
+            else:
+                yield from decoder.finish()
+        except Exception:
+            if route is None or not route.aborted:
+                raise
+        self._raise_if_aborted(decoder, route)
+        
+        if decoder.done:
+            # Поток логически завершён - возвращаем соединение в пул
+            self.http_pool.release(response)
+        self._response_complete = decoder.done
+        self._record_stream_stats(decoder)
+    
+    async def _aiter_stream(self, response, decoder: StreamDecoder, route: Optional[EndpointRoute] = None) -> AsyncGenerator[str, None]:
+        """Чтение потокового ответа aiohttp через инкрементальный декодер"""
+        self._response_complete = False
+        try:
+            async for chunk in response.content.iter_any():
+                for content in decoder.feed(chunk):
+                    yield content
+                if decoder.done:
+                    break
+            else:
+                for content in decoder.finish():
+                    yield content
+        except async_request_errors():
+            if route is None or not route.aborted:
+                raise
+        self._raise_if_aborted(decoder, route)
+        
+        if decoder.done:
+            await self.async_http.release(response)
+        self._response_complete = decoder.done
+        self._record_stream_stats(decoder)
+    
+    def _call_route(self) -> Optional[EndpointRoute]:
+        """Маршрут запроса: закреплённый за ходом или разовый (None без балансировки)"""
+        if self.endpoints is None:
+            return None
+        return self._route or EndpointRoute(self.endpoints)
+    
+    def _post_with_retry(self, url: str, payload: Dict, headers: Dict, stream: bool, timeout: float, describe: str,
+                         route: Optional[EndpointRoute] = None):
+        """POST к провайдеру по политике повторов (статус ответа может быть ошибочным)"""
+        def send(attempt_timeout: float):
+            response = self.http_pool.post(
+                route.url(url) if route else url, json=payload, headers=headers, stream=stream, timeout=attempt_timeout
+            )
+            if route is not None:
+                route.attach(response)
+            return response
+        
+        return self.retry_policy.call(
+            send,
+            timeout,
+            retryable_errors(),
+            breaker=route or self.circuit_breaker,
+            describe=describe
+        )
+    
+    async def _apost_with_retry(self, url: str, payload: Dict, headers: Dict, timeout: float, describe: str,
+                                route: Optional[EndpointRoute] = None):
+        """Асинхронный POST по политике повторов; ответ закрывается через async with"""
+        async def send(attempt_timeout: float):
+            response = await self.async_http.send(
+                'POST', route.url(url) if route else url, json=payload, headers=headers, timeout=attempt_timeout
             )
+            if route is not None:
+                route.attach(response)
+            return response
+        
+        return await self.retry_policy.acall(
+            send,
+            timeout,
+            async_request_errors(),
+            breaker=route or self.circuit_breaker,
+            describe=describe
+        )
+    
+    def _call_ollama(self, messages: List[Dict], stream: bool = False, route: Optional[EndpointRoute] = None) -> Generator[str, None, None]:
+        """Вызов Ollama API"""
+        url, payload, headers = self._prepare_ollama_request(messages, stream)
+        
+        route = route or self._call_route()
+        response = None
+        try:
+            response = self._post_with_retry(url, payload, headers, stream, self.timeout, "Ollama", route)
             response.raise_for_status()
             
             if stream:
-                for line in response.iter_lines():
-                    if line:
-                        try:
-                            line_text = line.decode('utf-8')
-                            if line_text.startswith('data: '):
-                                data_str = line_text[6:]
-                                if data_str.strip() == '[DONE]':
-                                    break
-                                try:
-                                    data = json.loads(data_str)
-                                    if 'choices' in data and len(data['choices']) > 0:
-                                        delta = data['choices'][0].get('delta', {})
-                                        content = delta.get('content', '')
-                                        if content:
-                                            yield content
-                                except json.JSONDecodeError:
-                                    continue
-                        except UnicodeDecodeError:
-                            continue
+                yield from self._iter_stream(response, StreamDecoder(NDJSON), route)
             else:
                 result = response.json()
+                self._record_usage(self._usage_from_event(result))
+                if 'message' in result and 'content' in result['message']:
+                    yield result['message']['content']
+                else:
+                    yield ErrorChunk("Ошибка: неожиданный формат ответа от Ollama")
+                
+        except CircuitOpenError as e:
+            console.print(f"[red]{e}[/red]")
+            yield ErrorChunk(f"Ошибка: {e}")
+        except request_exceptions().RequestException as e:
+            console.print(f"[red]Ошибка запроса к Ollama: {e}[/red]")
+            yield ErrorChunk(f"Ошибка: {e}")
+        finally:
+            if response is not None:
+                response.close()
+            if route is not None:
+                route.release()
+    
+    def _call_lmstudio(self, messages: List[Dict], stream: bool = False, route: Optional[EndpointRoute] = None) -> Generator[str, None, None]:
+        """Вызов LM Studio API (OpenAI-совместимый)"""
+        url, payload, headers = self._prepare_lmstudio_request(messages, stream)
+        
+        route = route or self._call_route()
+        response = None
+        try:
+            # Увеличиваем таймаут для больших моделей
+            timeout = max(self.timeout, 180)  # Минимум 3 минуты
+            response = self._post_with_retry(url, payload, headers, stream, timeout, "LM Studio", route)
+            response.raise_for_status()
+            
+            if stream:
+                # LM Studio может использовать разные форматы
+                yield from self._iter_stream(response, StreamDecoder(SSE, allow_raw=True), route)
+            else:
+                result = response.json()
+                self._record_usage(self._usage_from_event(result))
                 if 'choices' in result and len(result['choices']) > 0:
                     yield result['choices'][0]['message']['content']
                 else:
-                    yield "Ошибка: неожиданный формат ответа"
+                    yield ErrorChunk("Ошибка: неожиданный формат ответа")
                 
-        except requests.exceptions.HTTPError as e:
+        except CircuitOpenError as e:
+            console.print(f"[red]{e}[/red]")
+            yield ErrorChunk(f"Ошибка подключения: {e}")
+        except request_exceptions().HTTPError as e:
+            error_msg = self._lmstudio_http_error_message(e.response.status_code, str(e))
+            console.print(f"[red]{error_msg}[/red]")
+            yield ErrorChunk(error_msg)
+        except request_exceptions().RequestException as e:
+            console.print(f"[red]Ошибка запроса к LM Studio: {e}[/red]")
+            yield ErrorChunk(f"Ошибка подключения: {e}\n\nУбедитесь, что:\n1. LM Studio запущен\n2. Local Server включен\n3. Модель загружена")
+        finally:
+            if response is not None:
+                response.close()
+            if route is not None:
+                route.release()
+    
+    def _call_openai_compatible(self, messages: List[Dict], stream: bool = False, route: Optional[EndpointRoute] = None) -> Generator[str, None, None]:
+        """Вызов OpenAI-совместимого API (OpenAI, Anthropic, кастомные провайдеры)"""
+        url, payload, headers = self._prepare_openai_request(messages, stream)
+        
+        route = route or self._call_route()
+        response = None
+        try:
+            response = self._post_with_retry(url, payload, headers, stream, self.timeout, self.provider, route)
+            response.raise_for_status()
+            
+            if stream:
+                yield from self._iter_stream(response, StreamDecoder(SSE), route)
+            else:
+                result = response.json()
+                self._record_usage(self._usage_from_event(result))
+                if 'choices' in result and len(result['choices']) > 0:
+                    yield result['choices'][0]['message']['content']
+                else:
+                    yield ErrorChunk("Ошибка: неожиданный формат ответа")
+                
+        except CircuitOpenError as e:
+            console.print(f"[red]{e}[/red]")
+            yield ErrorChunk(f"Ошибка подключения: {e}")
+        except request_exceptions().HTTPError as e:
             console.print(f"[red]Ошибка HTTP {e.response.status_code}: {e}[/red]")
-            error_msg = f"Ошибка HTTP {e.response.status_code}"
             try:
                 error_data = e.response.json()
-                if 'error' in error_data:
-                    error_msg += f": {error_data['error'].get('message', 'Неизвестная ошибка')}"
-            except:
-                pass
-            yield error_msg
-        except requests.exceptions.RequestException as e:
+            except Exception:
+                error_data = {}
+            yield ErrorChunk(self._openai_http_error_message(e.response.status_code, error_data))
+        except request_exceptions().RequestException as e:
             console.print(f"[red]Ошибка запроса к {self.provider}: {e}[/red]")
-            yield f"Ошибка подключения: {e}\n\nУбедитесь, что:\n1. API ключ указан правильно\n2. Базовый URL корректен\n3. Модель доступна"
+            yield ErrorChunk(f"Ошибка подключения: {e}\n\nУбедитесь, что:\n1. API ключ указан правильно\n2. Базовый URL корректен\n3. Модель доступна")
+        finally:
+            if response is not None:
+                response.close()
+            if route is not None:
+                route.release()
     
-    def _call_transformers(self, messages: List[Dict], stream: bool = False) -> Generator[str, None, None]:
-        """Вызов модели через transformers"""
-        import torch
+    def _call_transformers(
+        self,
+        messages: List[Dict],
+        stream: bool = False,
+        cancel_token: Optional[CancellationToken] = None
+    ) -> Generator[str, None, None]:
+        """
+        Вызов модели через transformers
+        
+        Генерация идёт в фоновом потоке, текст выдаётся по мере декодирования
+        токенов. Стоп-последовательности и отмена хода останавливают модель
+        на следующем токене.
+        
+        Args:
+            cancel_token: Токен отмены хода (по умолчанию токен текущего хода)
+        """
+        if cancel_token is None:
+            cancel_token = self._cancel_token
+        if cancel_token is not None and cancel_token.cancelled:
+            # Ход отменён раньше, чем дошло до генерации - модель не запускаем
+            return
+        local = self._load_local_model()
         
         # Форматируем сообщения в промпт
         prompt = self._format_messages(messages)
         
-        # Токенизация
-        inputs = self.tokenizer(prompt, return_tensors="pt")
-        if self.config['model'].get('device') == 'cuda':
-            inputs = {k: v.cuda() for k, v in inputs.items()}
+        # Токенизация (на устройство модели: cpu, cuda или первое устройство device_map)
+        inputs = local.tokenizer(prompt, return_tensors="pt").to(local.model.device)
         
         # Генерация
         generation_config = self.config.get('model', {}).get('generation', {})
-        
-        with torch.no_grad():
-            outputs = self.model.generate(
-                **inputs,
-                max_new_tokens=generation_config.get('max_tokens', 4096),
-                temperature=generation_config.get('temperature', 0.2),
+        temperature = generation_config.get('temperature', 0.2)
+        generation_kwargs = {
+            'max_new_tokens': generation_config.get('max_tokens', 4096),
+            'repetition_penalty': generation_config.get('repetition_penalty', 1.1),
+            'pad_token_id': local.tokenizer.eos_token_id,
+        }
+        if temperature > 0:
+            generation_kwargs.update(
+                do_sample=True,
+                temperature=temperature,
                 top_p=generation_config.get('top_p', 0.95),
                 top_k=generation_config.get('top_k', 40),
-                repetition_penalty=generation_config.get('repetition_penalty', 1.1),
-                do_sample=True,
-                pad_token_id=self.tokenizer.eos_token_id
             )
+        else:
+            # Нулевая температура - жадное декодирование (сэмплирование с ней невозможно)
+            generation_kwargs['do_sample'] = False
         
-        # Декодирование
-        generated_text = self.tokenizer.decode(outputs[0][inputs['input_ids'].shape[1]:], skip_special_tokens=True)
-        
-        if stream:
-            # Симулируем стриминг
-            words = generated_text.split()
-            for word in words:
-                yield word + " "
+        stop = generation_config.get('stop') or []
+        if local.batch_engine is not None:
+            # Запросы всех сессий декодируются одним батчем
+            generation = local.batch_engine.submit(inputs['input_ids'][0].tolist(), generation_kwargs, stop)
         else:
-            yield generated_text
+            generation = LocalGeneration(local.model, local.tokenizer, inputs, generation_kwargs, stop=stop, prefix_cache=local.prefix_cache)
+        if cancel_token is not None:
+            cancel_token.register(generation.cancel)
+        
+        self._response_complete = False
+        try:
+            if stream:
+                yield from generation
+            else:
+                yield ''.join(generation)
+            self._response_complete = generation.completed
+        finally:
+            self._record_usage(generation.usage)
     
     def _format_messages(self, messages: List[Dict]) -> str:
         """Форматирование сообщений в промпт"""
@@ -1094,87 +1690,756 @@ class CodeAgent:
         
         return "\n\n".join(results)
     
-    def ask(self, prompt: str, stream: bool = True, max_iterations: int = 5) -> Generator[str, None, None]:
-        """Задать вопрос агенту с поддержкой MCP инструментов"""
+    def _response_cache_key(self, messages: List[Dict]) -> Optional[str]:
+        """Ключ кэша ответов или None, если запрос не кэшируется"""
+        if self.response_cache is None:
+            return None
+        
+        generation_config = dict(self.config.get('model', {}).get('generation', {}))
+        temperature = generation_config.get('temperature')
+        if temperature is None and self.use_adapter and self.model_adapter:
+            temperature = self.model_adapter.capabilities.optimal_temperature
+        if not self.response_cache.is_cacheable(temperature):
+            return None
+        
+        params = dict(generation_config, provider=self.provider, temperature=temperature)
+        return self.response_cache.make_key(self.model_name, params, messages)
+    
+    def _cache_through(self, cache_key: str, generator: Iterator[str]) -> Generator[str, None, None]:
+        """Отдаёт чанки ответа и сохраняет полный ответ в кэш (ошибки и оборванные ответы не кэшируются)"""
+        cancel_token = self._cancel_token
+        self._response_complete = True
+        chunks = []
+        failed = False
+        for chunk in generator:
+            if isinstance(chunk, ErrorChunk):
+                failed = True
+            chunks.append(chunk)
+            yield chunk
+        if self._cacheable_response(chunks, failed, cancel_token):
+            self.response_cache.put(cache_key, chunks)
+    
+    def _cacheable_response(self, chunks: List[str], failed: bool, cancel_token: Optional[CancellationToken]) -> bool:
+        """Ответ можно сохранить в кэш: получен полностью, без ошибок и без отмены хода"""
+        if failed or not chunks or not self._response_complete:
+            return False
+        return cancel_token is None or not cancel_token.cancelled
+    
+    def _call_provider(self, messages: List[Dict], stream: bool = True) -> Iterator[str]:
+        """Вызов провайдера через кэш ответов"""
+        cache_key = self._response_cache_key(messages)
+        if cache_key is None:
+            return self._calibrating(messages, self._dispatch_provider(messages, stream=stream))
+        
+        cached = self.response_cache.get(cache_key)
+        if cached is not None:
+            # Попадание в кэш стримится по тем же чанкам, что и живой ответ
+            return iter(cached)
+        return self._cache_through(cache_key, self._calibrating(messages, self._dispatch_provider(messages, stream=stream)))
+    
+    def _observe_prompt_cache(self, messages: List[Dict], usage: Optional[Dict[str, int]]) -> Optional[int]:
+        """Общее начало с предыдущим промптом сессии и попадание в кэш префиксов сервера"""
+        overhead = self.token_calibrator.message_overhead(self._calibration_key) if self.token_calibrator else 0
+        current = snapshot(messages)
+        prompt_tokens = sum(self._estimate_tokens(content) + overhead for _, content in current)
+        expected = 0
+        if self._last_prompt is not None:
+            expected = common_prefix_tokens(self._last_prompt, current, self._estimate_tokens, overhead)
+        self._last_prompt = current
+        return self.prompt_cache_monitor.observe(prompt_tokens, expected, usage)
+    
+    def _observe_usage(self, messages: List[Dict], response: str, usage_before: Optional[Dict[str, int]]):
+        """Учёт кэша префиксов и калибровка оценки токенов по расходу, который сообщил провайдер"""
+        usage = self.last_usage if self.last_usage is not usage_before else None
+        cached = self._observe_prompt_cache(messages, usage)
+        if self.token_calibrator is None or usage is None:
+            return
+        if self.provider == "local_transformers" or self.token_counter.exact:
+            # Токены и так считаются токенизатором модели
+            return
+        if cached is not None and 'cached_tokens' not in usage:
+            # Провайдер посчитал только токены промпта вне кэша - для калибровки они не годятся
+            usage = {key: value for key, value in usage.items() if key != 'prompt_tokens'}
+        self.token_calibrator.observe_request(self._calibration_key, messages, response, usage)
+    
+    def _calibrating(self, messages: List[Dict], chunks: Iterator[str]) -> Generator[str, None, None]:
+        """Поток ответа; после его завершения расход токенов идёт в калибровку"""
+        usage_before = self.last_usage
+        parts = []
+        failed = False
+        for chunk in chunks:
+            failed = failed or isinstance(chunk, ErrorChunk)
+            parts.append(chunk)
+            yield chunk
+        if not failed:
+            self._observe_usage(messages, ''.join(parts), usage_before)
+    
+    async def _acalibrating(self, messages: List[Dict], chunks: AsyncGenerator[str, None]) -> AsyncGenerator[str, None]:
+        """Асинхронный поток ответа с калибровкой оценки токенов"""
+        usage_before = self.last_usage
+        parts = []
+        failed = False
+        async for chunk in chunks:
+            failed = failed or isinstance(chunk, ErrorChunk)
+            parts.append(chunk)
+            yield chunk
+        if not failed:
+            self._observe_usage(messages, ''.join(parts), usage_before)
+    
+    def _dispatch_provider(self, messages: List[Dict], stream: bool = True) -> Generator[str, None, None]:
+        """Выбор метода вызова по провайдеру"""
+        if self.provider == "ollama":
+            call = self._call_ollama
+        elif self.provider == "lmstudio":
+            call = self._call_lmstudio
+        elif self.provider == "local_transformers":
+            return self._call_transformers(messages, stream=stream)
+        elif self.provider in ["openai", "openai_compatible", "anthropic", "custom"] or hasattr(self, 'openai_url'):
+            call = self._call_openai_compatible
+        else:
+            # Пробуем как OpenAI-совместимый API
+            console.print(f"[yellow]Провайдер '{self.provider}' не распознан, пробуем как OpenAI-совместимый API[/yellow]")
+            raise ValueError(f"Неподдерживаемый провайдер: {self.provider}. Укажите base_url в конфигурации для использования как OpenAI-совместимого API.")
+        
+        if self._hedging_enabled(stream):
+            return self._hedged_call(call, messages)
+        return call(messages, stream=stream)
+    
+    def _hedging_enabled(self, stream: bool) -> bool:
+        """Хеджирование возможно для потоковых запросов при нескольких эндпоинтах"""
+        return self.hedger is not None and stream and self.endpoints is not None and len(self.endpoints.endpoints) > 1
+    
+    def _hedge_routes(self) -> List[EndpointRoute]:
+        """Маршруты основной и дублирующей попыток (дублирующая - на другой эндпоинт)"""
+        primary = EndpointRoute(self.endpoints, endpoint=self._route.endpoint if self._route else None)
+        routes = [primary, EndpointRoute(self.endpoints, avoid=primary)]
+        if self._cancel_token is not None:
+            for route in routes:
+                self._cancel_token.register(route.abort)
+        return routes
+    
+    def _pin_hedge_winner(self, routes: List[EndpointRoute]):
+        """Закрепить ход за эндпоинтом победившей попытки"""
+        if self._route is None:
+            return
+        for route in routes:
+            if route.endpoint is not None and not route.aborted:
+                self._route.endpoint = route.endpoint
+                return
+    
+    def _hedged_call(self, call: Callable, messages: List[Dict]) -> Generator[str, None, None]:
+        """Потоковый вызов с дублированием на второй эндпоинт, если первый токен задерживается"""
+        routes = self._hedge_routes()
+        yield from self.hedger.stream(
+            lambda attempt: call(messages, stream=True, route=routes[attempt]),
+            lambda attempt: routes[attempt].abort(),
+            lambda chunk: isinstance(chunk, ErrorChunk)
+        )
+        self._pin_hedge_winner(routes)
+    
+    async def _ahedged_call(self, call: Callable, messages: List[Dict]) -> AsyncGenerator[str, None]:
+        """Асинхронный вариант _hedged_call (проигравшая задача отменяется)"""
+        routes = self._hedge_routes()
+        async for chunk in self.hedger.astream(
+            lambda attempt: call(messages, stream=True, route=routes[attempt]),
+            lambda attempt: routes[attempt].abort(),
+            lambda chunk: isinstance(chunk, ErrorChunk)
+        ):
+            yield chunk
+        self._pin_hedge_winner(routes)
+    
+    def _wait_model_ready(self):
+        """Ожидание загрузки модели на сервере (вместо слепых повторов с time.sleep)"""
+        if self.warm_keeper is None:
+            return
+        self.warm_keeper.note_activity()
+        if self.warm_keeper.ready_event.is_set():
+            return
+        
+        timeout = self.config.get('warmup', {}).get('wait_timeout', 120)
+        console.print(f"[cyan]Ожидание загрузки модели {self.model_name}...[/cyan]")
+        if not self.warm_keeper.wait_ready(timeout):
+            console.print(f"[yellow]Модель не готова (состояние: {self.warm_keeper.state}), отправляем запрос как есть[/yellow]")
+    
+    def _start_turn(self, prompt: str, cancel_token: CancellationToken) -> List[Dict]:
+        """Начало хода диалога: сборка сообщений и запись запроса в историю"""
+        self._wait_model_ready()
+        self.turn_usage = {'prompt_tokens': 0, 'completion_tokens': 0}
+        # Все запросы хода (включая итерации инструментов) идут на один эндпоинт
+        self._route = EndpointRoute(self.endpoints) if self.endpoints else None
+        # Отмена закрывает текущий ответ провайдера и запрещает повторы
+        self._cancel_token = cancel_token
+        if self._route is not None:
+            cancel_token.register(self._route.abort)
+        if self.history_compactor is not None:
+            self.history_compactor.begin_turn()
+            self._apply_compaction()
         messages = self._build_messages(prompt)
         
         # Сохраняем запрос пользователя
-        self.history.append({
+        self._append_history({
             'role': 'user',
             'content': prompt,
             'timestamp': datetime.now().isoformat()
         })
+        return messages
+    
+    def _apply_tool_calls(self, messages: List[Dict], current_response: str) -> bool:
+        """
+        Выполняет вызовы инструментов из ответа модели
         
-        iteration = 0
-        full_response = ""
+        Returns:
+            True если инструменты были вызваны и нужна следующая итерация
+        """
+        if not (self.use_mcp and self.mcp_tools):
+            return False
         
-        while iteration < max_iterations:
-            iteration += 1
-            
-            # Получаем ответ
-            current_response = ""
-            if self.provider == "ollama":
-                generator = self._call_ollama(messages, stream=stream)
-            elif self.provider == "lmstudio":
-                generator = self._call_lmstudio(messages, stream=stream)
-            elif self.provider == "local_transformers":
-                generator = self._call_transformers(messages, stream=stream)
-            elif self.provider in ["openai", "openai_compatible", "anthropic", "custom"] or hasattr(self, 'openai_url'):
-                generator = self._call_openai_compatible(messages, stream=stream)
-            else:
-                # Пробуем как OpenAI-совместимый API
-                console.print(f"[yellow]Провайдер '{self.provider}' не распознан, пробуем как OpenAI-совместимый API[/yellow]")
-                if hasattr(self, 'openai_url'):
-                    generator = self._call_openai_compatible(messages, stream=stream)
-                else:
-                    raise ValueError(f"Неподдерживаемый провайдер: {self.provider}. Укажите base_url в конфигурации для использования как OpenAI-совместимого API.")
-            
-            for chunk in generator:
-                current_response += chunk
-                if stream:
-                    yield chunk
-            
-            full_response += current_response
-            
-            # Проверяем наличие вызовов инструментов
-            if self.use_mcp and self.mcp_tools:
-                tool_calls = self._parse_tool_calls(current_response)
-                
-                if tool_calls:
-                    # Выполняем инструменты
-                    tool_results = self._execute_tool_calls(tool_calls)
-                    
-                    # Добавляем результаты в контекст и запрашиваем продолжение
-                    messages.append({
-                        'role': 'assistant',
-                        'content': current_response
-                    })
-                    messages.append({
-                        'role': 'user',
-                        'content': f"Результаты выполнения инструментов:\n{tool_results}\n\nПродолжи ответ, используя эти результаты."
-                    })
-                    
-                    # Продолжаем цикл для получения финального ответа
-                    continue
-            
-            # Нет вызовов инструментов или они уже обработаны - завершаем
-            break
+        tool_calls = self._parse_tool_calls(current_response)
+        if not tool_calls:
+            return False
+        
+        # Выполняем инструменты
+        tool_results = self._execute_tool_calls(tool_calls)
+        
+        # Добавляем результаты в контекст и запрашиваем продолжение
+        messages.append({
+            'role': 'assistant',
+            'content': current_response
+        })
+        messages.append({
+            'role': 'user',
+            'content': f"Результаты выполнения инструментов:\n{tool_results}\n\nПродолжи ответ, используя эти результаты."
+        })
+        return True
+    
+    def _record_cancellation(self, cancel_token: CancellationToken, partial_response: str):
+        """
+        Учёт отменённой генерации
+        
+        Сэкономленные токены - оценка сверху: лимит генерации прерванного
+        запроса минус уже полученная часть ответа.
+        """
+        produced = self._estimate_tokens(partial_response)
+        cancel_token.tokens_saved = max(0, self._generation_budget() - produced)
+        self.cancel_stats['cancelled'] += 1
+        self.cancel_stats['tokens_saved'] += cancel_token.tokens_saved
+        logger.info(f"Ход отменён ({cancel_token.reason}), сэкономлено ~{cancel_token.tokens_saved} токенов")
+    
+    def _finish_turn(self, full_response: str, partial_response: str = "", save: bool = True) -> bool:
+        """
+        Завершение хода диалога: запись ответа в историю и её сохранение
+        
+        Args:
+            full_response: Ответ за весь ход
+            partial_response: Ответ последнего запроса (для учёта отмены)
+            save: Сохранить историю на диск сразу
+        
+        Returns:
+            Историю нужно сохранить на диск (при save=False сохраняет вызывающий)
+        """
+        if self.warm_keeper is not None:
+            self.warm_keeper.note_activity()
+        self._route = None
+        cancel_token, self._cancel_token = self._cancel_token, None
+        cancelled = cancel_token is not None and cancel_token.cancelled
+        if cancelled:
+            self._record_cancellation(cancel_token, partial_response)
         
         # Сохраняем ответ
-        self.history.append({
+        entry = {
             'role': 'assistant',
             'content': full_response,
             'timestamp': datetime.now().isoformat()
-        })
+        }
+        if cancelled:
+            entry['cancelled'] = True
+        self._append_history(entry)
+        # Сообщения промптов хода больше не нужны таблице токенов
+        self.token_ledger.retain(self.history)
+        if self.history_compactor is not None:
+            self.history_compactor.end_turn()
+            self._schedule_compaction()
         
         # Сохраняем историю
-        if self.config.get('agent', {}).get('save_history', True):
+        persist = self.persist_history
+        if persist is None:
+            persist = self.config.get('agent', {}).get('save_history', True)
+        if persist and save:
             self.save_history()
+        return bool(persist)
+    
+    def ask(
+        self,
+        prompt: str,
+        stream: bool = True,
+        max_iterations: int = 5,
+        cancel_token: Optional[CancellationToken] = None
+    ) -> Generator[str, None, None]:
+        """
+        Задать вопрос агенту с поддержкой MCP инструментов
+        
+        Args:
+            cancel_token: Токен отмены; cancel() из любого потока закрывает
+                запрос к модели и завершает ход с частичным ответом. Прерывание
+                генератора (close(), Ctrl+C) тоже считается отменой.
+        """
+        cancel_token = cancel_token or CancellationToken()
+        messages = self._start_turn(prompt, cancel_token)
+        
+        iteration = 0
+        full_response = ""
+        current_response = ""
+        
+        try:
+            while iteration < max_iterations and not cancel_token.cancelled:
+                iteration += 1
+                
+                # Получаем ответ
+                current_response = ""
+                try:
+                    for chunk in self._call_provider(messages, stream=stream):
+                        if cancel_token.cancelled:
+                            break
+                        current_response += chunk
+                        full_response += chunk
+                        if stream:
+                            yield chunk
+                except RequestCancelled:
+                    # Отмена пришла между повторами запроса
+                    pass
+                
+                # Отменённый ход не вызывает инструменты по частичному ответу
+                if cancel_token.cancelled:
+                    break
+                
+                # Проверяем наличие вызовов инструментов и продолжаем цикл для получения финального ответа
+                if self._apply_tool_calls(messages, current_response):
+                    continue
+                
+                # Нет вызовов инструментов или они уже обработаны - завершаем
+                break
+        except (GeneratorExit, KeyboardInterrupt):
+            cancel_token.cancel("генерация прервана клиентом")
+            self._finish_turn(full_response, current_response)
+            raise
+        
+        self._finish_turn(full_response, current_response)
+    
+    # ========== Асинхронный режим (веб-сервер) ==========
+    
+    async def _acall_ollama(self, messages: List[Dict], stream: bool = False, route: Optional[EndpointRoute] = None) -> AsyncGenerator[str, None]:
+        """Асинхронный вызов Ollama API"""
+        url, payload, headers = self._prepare_ollama_request(messages, stream)
+        
+        route = route or self._call_route()
+        try:
+            response = await self._apost_with_retry(url, payload, headers, self.timeout, "Ollama", route)
+            async with response:
+                if response.status >= 400:
+                    error = await response.text()
+                    console.print(f"[red]Ошибка запроса к Ollama: HTTP {response.status}[/red]")
+                    yield ErrorChunk(f"Ошибка: HTTP {response.status}: {error}")
+                    return
+                
+                if stream:
+                    async for content in self._aiter_stream(response, StreamDecoder(NDJSON), route):
+                        yield content
+                else:
+                    result = await response.json(content_type=None)
+                    self._record_usage(self._usage_from_event(result))
+                    if 'message' in result and 'content' in result['message']:
+                        yield result['message']['content']
+                    else:
+                        yield ErrorChunk("Ошибка: неожиданный формат ответа от Ollama")
+        except CircuitOpenError as e:
+            console.print(f"[red]{e}[/red]")
+            yield ErrorChunk(f"Ошибка: {e}")
+        except async_request_errors() as e:
+            console.print(f"[red]Ошибка запроса к Ollama: {e}[/red]")
+            yield ErrorChunk(f"Ошибка: {e}")
+        finally:
+            if route is not None:
+                route.release()
+    
+    async def _acall_lmstudio(self, messages: List[Dict], stream: bool = False, route: Optional[EndpointRoute] = None) -> AsyncGenerator[str, None]:
+        """Асинхронный вызов LM Studio API (OpenAI-совместимый)"""
+        url, payload, headers = self._prepare_lmstudio_request(messages, stream)
+        
+        # Увеличиваем таймаут для больших моделей
+        timeout = max(self.timeout, 180)  # Минимум 3 минуты
+        
+        route = route or self._call_route()
+        try:
+            response = await self._apost_with_retry(url, payload, headers, timeout, "LM Studio", route)
+            async with response:
+                if response.status != 200:
+                    error_msg = self._lmstudio_http_error_message(response.status, await response.text())
+                    console.print(f"[red]{error_msg}[/red]")
+                    yield ErrorChunk(error_msg)
+                    return
+                
+                if stream:
+                    async for content in self._aiter_stream(response, StreamDecoder(SSE, allow_raw=True), route):
+                        yield content
+                else:
+                    result = await response.json(content_type=None)
+                    self._record_usage(self._usage_from_event(result))
+                    if 'choices' in result and len(result['choices']) > 0:
+                        yield result['choices'][0]['message']['content']
+                    else:
+                        yield ErrorChunk("Ошибка: неожиданный формат ответа")
+        except CircuitOpenError as e:
+            console.print(f"[red]{e}[/red]")
+            yield ErrorChunk(f"Ошибка подключения: {e}")
+        except async_request_errors() as e:
+            console.print(f"[red]Ошибка запроса к LM Studio: {e}[/red]")
+            yield ErrorChunk(f"Ошибка подключения: {e}\n\nУбедитесь, что:\n1. LM Studio запущен\n2. Local Server включен\n3. Модель загружена")
+        finally:
+            if route is not None:
+                route.release()
+    
+    async def _acall_openai_compatible(self, messages: List[Dict], stream: bool = False, route: Optional[EndpointRoute] = None) -> AsyncGenerator[str, None]:
+        """Асинхронный вызов OpenAI-совместимого API"""
+        url, payload, headers = self._prepare_openai_request(messages, stream)
+        
+        route = route or self._call_route()
+        try:
+            response = await self._apost_with_retry(url, payload, headers, self.timeout, self.provider, route)
+            async with response:
+                if response.status >= 400:
+                    console.print(f"[red]Ошибка HTTP {response.status}[/red]")
+                    try:
+                        error_data = await response.json(content_type=None)
+                    except Exception:
+                        error_data = {}
+                    yield ErrorChunk(self._openai_http_error_message(response.status, error_data))
+                    return
+                
+                if stream:
+                    async for content in self._aiter_stream(response, StreamDecoder(SSE), route):
+                        yield content
+                else:
+                    result = await response.json(content_type=None)
+                    self._record_usage(self._usage_from_event(result))
+                    if 'choices' in result and len(result['choices']) > 0:
+                        yield result['choices'][0]['message']['content']
+                    else:
+                        yield ErrorChunk("Ошибка: неожиданный формат ответа")
+        except CircuitOpenError as e:
+            console.print(f"[red]{e}[/red]")
+            yield ErrorChunk(f"Ошибка подключения: {e}")
+        except async_request_errors() as e:
+            console.print(f"[red]Ошибка запроса к {self.provider}: {e}[/red]")
+            yield ErrorChunk(f"Ошибка подключения: {e}\n\nУбедитесь, что:\n1. API ключ указан правильно\n2. Базовый URL корректен\n3. Модель доступна")
+        finally:
+            if route is not None:
+                route.release()
+    
+    async def _aiter_in_thread(self, make_generator: Callable[[], Iterator[str]]) -> AsyncGenerator[str, None]:
+        """Выполняет синхронный генератор в отдельном потоке, не блокируя event loop"""
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        finished = object()
+        
+        def worker():
+            try:
+                for chunk in make_generator():
+                    loop.call_soon_threadsafe(queue.put_nowait, chunk)
+            except Exception as e:
+                loop.call_soon_threadsafe(queue.put_nowait, e)
+            finally:
+                loop.call_soon_threadsafe(queue.put_nowait, finished)
+        
+        threading.Thread(target=worker, daemon=True).start()
+        
+        while True:
+            item = await queue.get()
+            if item is finished:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    
+    async def _acall_provider(self, messages: List[Dict], stream: bool = True) -> AsyncGenerator[str, None]:
+        """Асинхронный вызов провайдера через кэш ответов"""
+        cache_key = self._response_cache_key(messages)
+        if cache_key is None:
+            async for chunk in self._acalibrating(messages, self._adispatch_provider(messages, stream=stream)):
+                yield chunk
+            return
+        
+        # Промах в памяти читает SQLite - не блокируем цикл событий
+        cached = await asyncio.to_thread(self.response_cache.get, cache_key)
+        if cached is not None:
+            for chunk in cached:
+                yield chunk
+            return
+        
+        cancel_token = self._cancel_token
+        self._response_complete = True
+        chunks = []
+        failed = False
+        async for chunk in self._acalibrating(messages, self._adispatch_provider(messages, stream=stream)):
+            if isinstance(chunk, ErrorChunk):
+                failed = True
+            chunks.append(chunk)
+            yield chunk
+        if self._cacheable_response(chunks, failed, cancel_token):
+            await asyncio.to_thread(self.response_cache.put, cache_key, chunks)
+    
+    def _adispatch_provider(self, messages: List[Dict], stream: bool = True) -> AsyncGenerator[str, None]:
+        """Асинхронный выбор метода вызова по провайдеру"""
+        if self.provider == "local_transformers":
+            # Токен берём сейчас: поток может стартовать, когда ход уже завершён
+            # (_finish_turn сбросил self._cancel_token), и генерацию было бы нечем остановить
+            cancel_token = self._cancel_token
+            return self._aiter_in_thread(lambda: self._call_transformers(messages, stream=stream, cancel_token=cancel_token))
+        if self.async_http is None:
+            # Без aiohttp генерация идёт в отдельном потоке
+            return self._aiter_in_thread(lambda: self._dispatch_provider(messages, stream=stream))
+        if self.provider == "ollama":
+            call = self._acall_ollama
+        elif self.provider == "lmstudio":
+            call = self._acall_lmstudio
+        elif self.provider in ["openai", "openai_compatible", "anthropic", "custom"] or hasattr(self, 'openai_url'):
+            call = self._acall_openai_compatible
+        else:
+            raise ValueError(f"Неподдерживаемый провайдер: {self.provider}. Укажите base_url в конфигурации для использования как OpenAI-совместимого API.")
+        
+        if self._hedging_enabled(stream):
+            return self._ahedged_call(call, messages)
+        return call(messages, stream=stream)
+    
+    async def aask(
+        self,
+        prompt: str,
+        stream: bool = True,
+        max_iterations: int = 5,
+        cancel_token: Optional[CancellationToken] = None
+    ) -> AsyncGenerator[str, None]:
+        """
+        Асинхронная версия ask() для веб-сервера
+        
+        Сетевые вызовы идут через aiohttp, а сборка контекста, инструменты и
+        сохранение истории выполняются в пуле потоков, поэтому event loop
+        не блокируется и несколько сессий могут стримить одновременно.
+        Отмена задачи или aclose() генератора считаются отменой хода.
+        """
+        cancel_token = cancel_token or CancellationToken()
+        messages = await asyncio.to_thread(self._start_turn, prompt, cancel_token)
+        
+        iteration = 0
+        full_response = ""
+        current_response = ""
+        
+        try:
+            while iteration < max_iterations and not cancel_token.cancelled:
+                iteration += 1
+                
+                current_response = ""
+                try:
+                    async for chunk in self._acall_provider(messages, stream=stream):
+                        if cancel_token.cancelled:
+                            break
+                        current_response += chunk
+                        full_response += chunk
+                        if stream:
+                            yield chunk
+                except RequestCancelled:
+                    pass
+                
+                if cancel_token.cancelled:
+                    break
+                
+                if await asyncio.to_thread(self._apply_tool_calls, messages, current_response):
+                    continue
+                
+                break
+        except (GeneratorExit, asyncio.CancelledError):
+            # Ждать пул потоков при закрытии генератора нельзя - завершаем ход синхронно,
+            # а запись истории на диск отдаём пулу потоков, не дожидаясь её
+            cancel_token.cancel("генерация прервана клиентом")
+            if self._finish_turn(full_response, current_response, save=False):
+                asyncio.get_running_loop().run_in_executor(None, self.save_history)
+            raise
+        
+        await asyncio.to_thread(self._finish_turn, full_response, current_response)
+    
+    async def aask_many(
+        self,
+        requests: Iterable[Dict],
+        concurrency: Optional[int] = None,
+        max_iterations: int = 5
+    ) -> AsyncGenerator[Dict, None]:
+        """
+        Пакетное выполнение запросов с ограничением числа одновременных
+        
+        Каждый запрос выполняется в отдельной сессии (fork_session) без общей
+        истории. Входные запросы читаются лениво, результаты отдаются по мере
+        готовности, а не в порядке входа.
+        
+        Args:
+            requests: Запросы вида {'id': ..., 'prompt': ...}
+            concurrency: Максимум запросов в работе (по умолчанию batch.concurrency)
+            max_iterations: Максимум итераций инструментов на запрос
+        
+        Yields:
+            Результат: id, ok, response, error, elapsed, prompt_tokens, completion_tokens
+        """
+        if concurrency is None:
+            concurrency = self.config.get('batch', {}).get('concurrency', 4)
+        concurrency = max(1, concurrency)
+        
+        items = iter(requests)
+        pending = set()
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(pending) < concurrency:
+                    item = next(items, None)
+                    if item is None:
+                        exhausted = True
+                        break
+                    pending.add(asyncio.ensure_future(self._aask_one(item, max_iterations)))
+                if not pending:
+                    break
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+    
+    async def _aask_one(self, item: Dict, max_iterations: int) -> Dict:
+        """Один запрос пакета в отдельной сессии"""
+        session = self.fork_session(persist_history=False)
+        started = time.perf_counter()
+        chunks = []
+        error = None
+        try:
+            async for chunk in session.aask(item['prompt'], stream=True, max_iterations=max_iterations):
+                if isinstance(chunk, ErrorChunk):
+                    error = str(chunk)
+                chunks.append(chunk)
+        except Exception as e:
+            logger.error(f"Ошибка запроса {item.get('id')}: {e}")
+            error = str(e)
+        
+        response = ''.join(chunks)
+        completion_tokens = session.turn_usage.get('completion_tokens', 0)
+        if not completion_tokens and response:
+            # Ответ из кэша или провайдер без usage - оценка по тексту
+            completion_tokens = self._estimate_tokens(response)
+        return {
+            'id': item.get('id'),
+            'ok': error is None,
+            'response': response,
+            'error': error,
+            'elapsed': round(time.perf_counter() - started, 3),
+            'prompt_tokens': session.turn_usage.get('prompt_tokens', 0),
+            'completion_tokens': completion_tokens,
+        }
+    
+    def ask_many(
+        self,
+        requests: Iterable[Dict],
+        concurrency: Optional[int] = None,
+        on_result: Optional[Callable[[Dict], None]] = None,
+        max_iterations: int = 5
+    ) -> List[Dict]:
+        """
+        Синхронная обёртка над aask_many для кода вне event loop (CLI, скрипты)
+        
+        Пакет выполняется в собственном event loop и через собственный
+        асинхронный клиент, который закрывается по завершении; общий клиент
+        агента (его используют сессии веб-сервера) не затрагивается. Из
+        работающего event loop вызывайте aask_many.
+        
+        Args:
+            requests: Запросы вида {'id': ..., 'prompt': ...}
+            concurrency: Максимум запросов в работе
+            on_result: Вызывается для каждого результата сразу по готовности
+        
+        Returns:
+            Результаты в порядке завершения
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+        else:
+            raise RuntimeError("ask_many() нельзя вызывать из работающего event loop, используйте aask_many()")
+        
+        batch = self.fork_session(persist_history=False)
+        if self.async_http is not None:
+            batch.async_http = AsyncHTTPClient.from_config(self.config)
+        
+        async def run() -> List[Dict]:
+            results = []
+            try:
+                async for result in batch.aask_many(requests, concurrency=concurrency, max_iterations=max_iterations):
+                    if on_result is not None:
+                        on_result(result)
+                    results.append(result)
+            finally:
+                await batch.aclose()
+            return results
+        
+        return asyncio.run(run())
+    
+    async def aclose(self):
+        """Закрытие асинхронных соединений"""
+        if self.async_http is not None:
+            await self.async_http.close()
+    
+    def shutdown(self):
+        """Остановка фоновых задач агента и закрытие пула соединений (асинхронный клиент - aclose())"""
+        if self.warm_keeper is not None:
+            self.warm_keeper.stop()
+        if self.endpoints is not None:
+            self.endpoints.stop()
+        if self.local_model is not None:
+            self.local_model.close()
+        if self.token_calibrator is not None:
+            self.token_calibrator.save()
+        if self.history_compactor is not None:
+            self.history_compactor.stop()
+        # Соединения пула общие с копиями из fork_session - агент останавливают,
+        # когда ни одна сессия с ним уже не работает
+        self.http_pool.close()
+    
+    def fork_session(self, history: Optional[List[Dict]] = None, persist_history: Optional[bool] = None) -> 'CodeAgent':
+        """
+        Лёгкая копия агента для отдельной сессии
+        
+        Пул соединений, адаптер модели, контекст проекта, MCP-инструменты и
+        загруженная модель остаются общими; своя у сессии только история.
+        
+        Args:
+            history: Начальная история сессии
+            persist_history: Сохранять ли историю сессии на диск (None - по конфигурации)
+        """
+        session = copy.copy(self)
+        session.history = list(history) if history else []
+        session.token_ledger = TokenLedger(self.token_counter)
+        session.history_tokens = session.token_ledger.total(session.history)
+        session.session_id = None
+        session._route = None
+        session._cancel_token = None
+        session.persist_history = persist_history
+        session.turn_usage = {'prompt_tokens': 0, 'completion_tokens': 0}
+        session._compaction = None
+        session._history_anchor = None
+        session._last_prompt = None
+        return session
     
     def save_history(self):
         """Сохранение истории диалога"""
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        history_file = self.history_path / f"history_{timestamp}.json"
+        if self.session_id:
+            history_file = self.history_path / f"history_{self.session_id}_{timestamp}.json"
+        else:
+            history_file = self.history_path / f"history_{timestamp}.json"
         
         with open(history_file, 'w', encoding='utf-8') as f:
             json.dump(self.history, f, ensure_ascii=False, indent=2)
@@ -1186,12 +2451,18 @@ class CodeAgent:
     def clear_history(self):
         """Очистка истории диалога"""
         self.history = []
+        self.history_tokens = 0
+        self._compaction = None
+        self.token_ledger.retain(self.history)
         console.print("[green]История очищена[/green]")
     
     def load_history(self, file_path: str):
         """Загрузка истории из файла"""
         with open(file_path, 'r', encoding='utf-8') as f:
             self.history = json.load(f)
+        self._compaction = None
+        self.token_ledger.retain(self.history)
+        self.history_tokens = self.token_ledger.total(self.history)
         console.print(f"[green]История загружена из {file_path}[/green]")
 
 
@@ -0,0 +1,181 @@
+"""
+Бенчмарк сокращения контекста: ModelAdapter.optimize_context (utils/context_trim.py)
+
+Для каждого размера входа генерируются два текста:
+  - summary: описание проекта с разделами get_project_summary
+    (структура, README, конфигурационные файлы, основной файл);
+  - plain: код без разделов.
+Текст сокращается до доли исходного размера (--ratio) и до фиксированного
+размера (--max-size). Для сравнения запускается прежняя реализация
+(квадратичная по размеру контекста) - только на входах до --legacy-max МБ.
+
+Проверяется, что результат не длиннее лимита и что время на мегабайт
+не растёт с размером входа (линейность).
+
+Использование:
+    python benchmark_context.py
+    python benchmark_context.py --sizes 1 4 16 --repeat 3
+    python benchmark_context.py --max-growth 3
+"""
+
+import sys
+import time
+import argparse
+import statistics
+from typing import Callable, Dict, List
+
+from utils.context_trim import trim_context, PROJECT_SUMMARY_SECTIONS
+
+MB = 1024 * 1024
+
+
+def legacy_optimize_context(context: str, max_size: int) -> str:
+    """Прежняя реализация optimize_context (для сравнения)"""
+    if len(context) <= max_size:
+        return context
+    lines = context.split('\n')
+    important_start = []
+    important_end = []
+    middle = []
+    for line in lines:
+        if len('\n'.join(important_start)) < max_size * 0.4:
+            important_start.append(line)
+        elif len('\n'.join(important_end)) < max_size * 0.3:
+            important_end.insert(0, line)
+        else:
+            middle.append(line)
+    result = '\n'.join(important_start)
+    if len(result) < max_size * 0.7:
+        result += '\n... [промежуточный контекст обрезан] ...\n'
+        result += '\n'.join(important_end[-int(max_size * 0.3):])
+    if len(result) > max_size:
+        result = result[:max_size] + "\n... [контекст обрезан]"
+    return result
+
+
+def _fill(lines: List[str], make_line: Callable[[int], str], size: int):
+    total = 0
+    number = 0
+    while total < size:
+        line = make_line(number)
+        lines.append(line)
+        total += len(line) + 1
+        number += 1
+
+
+def make_summary(size: int) -> str:
+    """Описание проекта с разделами get_project_summary; доли разделов 20/20/20/40%"""
+    lines = ["Структура проекта: bench", "", "=" * 60]
+    _fill(lines, lambda n: f"│   ├── module_{n}.py", size // 5)
+    lines += ["", "README (README.md):", "# Bench"]
+    _fill(lines, lambda n: f"- Возможность {n}: описание возможности проекта", size // 5)
+    lines += ["", "Конфигурационные файлы:", "-" * 60, "", "config.yaml:"]
+    _fill(lines, lambda n: f"  option_{n}: {n}", size // 5)
+    lines += ["", "Основной файл:", "-" * 60, "", "main.py:", "```"]
+    _fill(lines, lambda n: f"def function_{n}(value):\n    return value * {n}", size * 2 // 5)
+    lines.append("```")
+    return "\n".join(lines)
+
+
+def make_plain(size: int) -> str:
+    """Код без разделов"""
+    lines: List[str] = []
+    _fill(lines, lambda n: f"    result_{n} = compute(data[{n}], factor={n % 7})", size)
+    return "\n".join(lines)
+
+
+def measure(function: Callable[[str, int], str], text: str, max_size: int, repeat: int) -> Dict:
+    times = []
+    result = ''
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(text, max_size)
+        times.append(time.perf_counter() - start)
+    return {'seconds': statistics.median(times), 'length': len(result), 'result': result}
+
+
+def check_sections(result: str) -> bool:
+    """Разделы описания проекта не перемешаны: заголовки идут в исходном порядке"""
+    positions = [result.find('\n' + prefix) if i else result.find(prefix) for i, (prefix, _) in enumerate(PROJECT_SUMMARY_SECTIONS)]
+    present = [position for position in positions if position >= 0]
+    return present == sorted(present) and positions[0] == 0
+
+
+def run(sizes: List[float], ratio: float, max_size: int, repeat: int, legacy_max: float) -> List[Dict]:
+    rows = []
+    for size_mb in sizes:
+        size = int(size_mb * MB)
+        for kind, text in (('summary', make_summary(size)), ('plain', make_plain(size))):
+            for limit_name, limit in (('ratio', int(len(text) * ratio)), ('fixed', max_size)):
+                new = measure(trim_context, text, limit, repeat)
+                row = {
+                    'size_mb': size_mb,
+                    'kind': kind,
+                    'limit': limit_name,
+                    'max_size': limit,
+                    'seconds': new['seconds'],
+                    'ok': new['length'] <= limit and (kind != 'summary' or check_sections(new['result'])),
+                    'legacy_seconds': None,
+                }
+                if size_mb <= legacy_max:
+                    row['legacy_seconds'] = measure(legacy_optimize_context, text, limit, 1)['seconds']
+                rows.append(row)
+    return rows
+
+
+def print_rows(rows: List[Dict]):
+    print()
+    print(f"{'МБ':>6} {'текст':<8} {'лимит':<6} {'символов':>10} {'время':>10} {'МБ/с':>8} {'прежняя':>10} {'проверка':>9}")
+    for row in rows:
+        legacy = f"{row['legacy_seconds'] * 1000:>8.0f}мс" if row['legacy_seconds'] is not None else f"{'-':>10}"
+        speed = row['size_mb'] / row['seconds'] if row['seconds'] else float('inf')
+        print(
+            f"{row['size_mb']:>6g} {row['kind']:<8} {row['limit']:<6} {row['max_size']:>10} "
+            f"{row['seconds'] * 1000:>8.1f}мс {speed:>8.0f} {legacy} {'да' if row['ok'] else 'НЕТ':>9}"
+        )
+
+
+def growth(rows: List[Dict]) -> float:
+    """Во сколько раз время на мегабайт на самом большом входе больше, чем на самом маленьком"""
+    worst = 1.0
+    for kind in ('summary', 'plain'):
+        for limit in ('ratio', 'fixed'):
+            series = sorted((r for r in rows if r['kind'] == kind and r['limit'] == limit), key=lambda r: r['size_mb'])
+            if len(series) < 2:
+                continue
+            first, last = series[0], series[-1]
+            per_mb_first = first['seconds'] / first['size_mb']
+            per_mb_last = last['seconds'] / last['size_mb']
+            if per_mb_first > 0:
+                worst = max(worst, per_mb_last / per_mb_first)
+    return worst
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк сокращения контекста (optimize_context)")
+    parser.add_argument('--sizes', type=float, nargs='+', default=[0.25, 1, 4, 16], help="Размеры входа (МБ)")
+    parser.add_argument('--ratio', type=float, default=0.5, help="Лимит как доля размера входа")
+    parser.add_argument('--max-size', type=int, default=8000, help="Фиксированный лимит (символов)")
+    parser.add_argument('--repeat', type=int, default=3, help="Повторов на замер (медиана)")
+    parser.add_argument('--legacy-max', type=float, default=0.25, help="Прежняя реализация - на входах до стольких МБ")
+    parser.add_argument('--max-growth', type=float, default=None, help="Допустимый рост времени на МБ (раз), иначе код 1")
+    args = parser.parse_args()
+
+    print(f"Размеры: {', '.join(f'{s:g}' for s in args.sizes)} МБ; лимит {args.ratio:g} входа и {args.max_size} символов")
+    rows = run(args.sizes, args.ratio, args.max_size, args.repeat, args.legacy_max)
+    print_rows(rows)
+
+    failed = [row for row in rows if not row['ok']]
+    worst = growth(rows)
+    print(f"Рост времени на МБ от меньшего входа к большему: {worst:.2f}x")
+    if failed:
+        print(f"Результат длиннее лимита или разделы нарушены: {len(failed)}")
+        return 1
+    if args.max_growth is not None and worst > args.max_growth:
+        print(f"Время растёт быстрее линейного (>{args.max_growth:g}x)")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,259 @@
+"""
+Бенчмарк запуска точек входа: cli.py, web_ui.py, gui.py
+
+Для каждой точки входа запускается отдельный процесс Python и
+измеряется:
+  - import: время импорта модуля точки входа;
+  - first_response: от начала импорта до первого фрагмента ответа
+    (импорт, создание агента, первый запрос).
+
+Агент работает с локальным имитатором Ollama, поэтому результат не
+зависит от модели и сети. Первый запуск - холодный (без кэша проверок
+и конфигурации), остальные - повторные.
+
+Использование:
+    python benchmark_startup.py --runs 5
+    python benchmark_startup.py --save baseline.json
+    python benchmark_startup.py --baseline baseline.json --tolerance 0.25
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = Path(__file__).resolve().parent
+ENTRIES = ['cli', 'web_ui', 'gui']
+RESULT_MARKER = 'BENCH_RESULT '
+
+# Процесс точки входа: повторяет то, что она делает до первого ответа
+CHILD_SCRIPT = r'''
+import sys, json, time
+entry = sys.argv[1]
+result = {}
+
+def first_chunk(agent):
+    for chunk in agent.ask("ping", stream=True):
+        if chunk:
+            return chunk
+
+if entry == 'web_ui':
+    from fastapi.testclient import TestClient  # инструмент измерения, не часть запуска
+
+t0 = time.perf_counter()
+try:
+    module = __import__(entry)
+except ImportError as e:
+    print("BENCH_RESULT " + json.dumps({'skipped': str(e)}))
+    sys.exit(0)
+result['import'] = time.perf_counter() - t0
+
+if entry == 'web_ui':
+    # lifespan создаёт агента, затем первый запрос в /api/chat
+    with TestClient(module.app) as client:
+        with client.stream('POST', '/api/chat', json={'prompt': 'ping', 'stream': True}) as response:
+            for line in response.iter_lines():
+                if line.startswith('data:') and '"content"' in line:
+                    break
+else:
+    # cli.main() и gui.init_agent() создают CodeAgent и вызывают ask()
+    first_chunk(module.CodeAgent())
+result['first_response'] = time.perf_counter() - t0
+print("BENCH_RESULT " + json.dumps(result))
+'''
+
+
+class FakeOllama(BaseHTTPRequestHandler):
+    """Имитатор Ollama: список моделей, параметры модели, потоковый чат"""
+
+    protocol_version = 'HTTP/1.1'
+    latency = 0.0
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, parts: List[str], content_type: str = 'application/json'):
+        time.sleep(self.latency)
+        body = ''.join(parts).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/api/tags':
+            self._send([json.dumps({'models': [{'name': 'bench'}]})])
+        else:
+            self._send([json.dumps({'models': []})])
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        if self.path == '/api/show':
+            self._send([json.dumps({'parameters': 'num_ctx 8192'})])
+        elif self.path == '/api/chat':
+            parts = [json.dumps({'message': {'content': word}, 'done': False}) + '\n' for word in ('pong', '!')]
+            parts.append(json.dumps({'message': {'content': ''}, 'done': True, 'prompt_eval_count': 10, 'eval_count': 2}) + '\n')
+            self._send(parts, 'application/x-ndjson')
+        else:
+            self._send(['{}'])
+
+
+def start_server(latency: float) -> ThreadingHTTPServer:
+    FakeOllama.latency = latency
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeOllama)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def write_config(workdir: Path, port: int):
+    """config.yaml рабочего каталога: имитатор Ollama, без фоновых задач и кэша ответов"""
+    config = f"""
+agent:
+  history_path: {workdir / 'history'}
+  save_history: false
+  load_project_context: true
+  project_root: {ROOT}
+cache:
+  enabled: false
+mcp:
+  enabled: true
+model:
+  provider: ollama
+  model_name: bench
+ollama:
+  base_url: http://127.0.0.1:{port}
+warmup:
+  enabled: false
+"""
+    (workdir / 'config.yaml').write_text(config, encoding='utf-8')
+
+
+def run_entry(entry: str, workdir: Path, timeout: float) -> Optional[Dict]:
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [str(ROOT), env.get('PYTHONPATH')]))
+    process = subprocess.run(
+        [sys.executable, '-c', CHILD_SCRIPT, entry],
+        cwd=workdir, env=env, capture_output=True, text=True, encoding='utf-8', timeout=timeout,
+    )
+    for line in process.stdout.splitlines():
+        if line.startswith(RESULT_MARKER):
+            return json.loads(line[len(RESULT_MARKER):])
+    tail = (process.stderr or process.stdout).strip().splitlines()[-5:]
+    print(f"  {entry}: ошибка запуска (код {process.returncode})")
+    for line in tail:
+        print(f"    {line}")
+    return None
+
+
+def benchmark(entries: List[str], runs: int, latency: float, timeout: float) -> Dict[str, Dict]:
+    """Холодный запуск и runs повторных для каждой точки входа"""
+    server = start_server(latency)
+    results: Dict[str, Dict] = {}
+    try:
+        for entry in entries:
+            workdir = Path(tempfile.mkdtemp(prefix='bench_startup_'))
+            try:
+                write_config(workdir, server.server_address[1])
+                cold = run_entry(entry, workdir, timeout)
+                if cold is None:
+                    continue
+                if 'skipped' in cold:
+                    print(f"  {entry}: пропущен ({cold['skipped']})")
+                    results[entry] = {'skipped': cold['skipped']}
+                    continue
+                warm = [r for r in (run_entry(entry, workdir, timeout) for _ in range(runs)) if r]
+                results[entry] = {
+                    'cold': cold,
+                    'warm': {
+                        metric: statistics.median(r[metric] for r in warm)
+                        for metric in ('import', 'first_response')
+                    } if warm else None,
+                }
+            finally:
+                shutil.rmtree(workdir, ignore_errors=True)
+    finally:
+        server.shutdown()
+    return results
+
+
+def print_results(results: Dict[str, Dict]):
+    print()
+    print(f"{'Точка входа':<12} {'import':>10} {'первый ответ':>14} {'import*':>10} {'первый ответ*':>14}")
+    for entry, result in results.items():
+        if 'skipped' in result:
+            print(f"{entry:<12} {'пропущен':>10}")
+            continue
+        cold, warm = result['cold'], result['warm'] or {}
+        print(
+            f"{entry:<12} {cold['import'] * 1000:>8.0f}мс {cold['first_response'] * 1000:>12.0f}мс "
+            f"{warm.get('import', 0) * 1000:>8.0f}мс {warm.get('first_response', 0) * 1000:>12.0f}мс"
+        )
+    print("* медиана повторных запусков (кэш проверок и конфигурации заполнен)")
+
+
+def compare(results: Dict[str, Dict], baseline: Dict[str, Dict], tolerance: float, slack: float) -> List[str]:
+    """Регрессии повторного запуска относительно сохранённого результата"""
+    regressions = []
+    for entry, result in results.items():
+        base = (baseline.get(entry) or {}).get('warm')
+        warm = result.get('warm')
+        if not base or not warm:
+            continue
+        for metric in ('import', 'first_response'):
+            limit = base[metric] * (1 + tolerance) + slack
+            if warm[metric] > limit:
+                regressions.append(
+                    f"{entry}.{metric}: {warm[metric] * 1000:.0f}мс > {limit * 1000:.0f}мс "
+                    f"(базовое {base[metric] * 1000:.0f}мс)"
+                )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк запуска cli.py, web_ui.py и gui.py")
+    parser.add_argument('--runs', type=int, default=5, help="Повторных запусков на точку входа")
+    parser.add_argument('--entry', action='append', choices=ENTRIES, help="Точка входа (по умолчанию все)")
+    parser.add_argument('--latency', type=float, default=0.05, help="Задержка ответа имитатора Ollama (секунды)")
+    parser.add_argument('--timeout', type=float, default=120, help="Таймаут одного запуска (секунды)")
+    parser.add_argument('--save', help="Сохранить результат в JSON")
+    parser.add_argument('--baseline', help="Сравнить с сохранённым результатом")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="Допустимое замедление (доля)")
+    parser.add_argument('--slack', type=float, default=0.05, help="Допустимое замедление (секунды, шум измерений)")
+    args = parser.parse_args()
+
+    entries = args.entry or ENTRIES
+    print(f"Запуск: {', '.join(entries)}; повторов {args.runs}, задержка имитатора {args.latency * 1000:.0f}мс")
+    results = benchmark(entries, args.runs, args.latency, args.timeout)
+    print_results(results)
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"Результат сохранён: {args.save}")
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance, args.slack)
+        if regressions:
+            print("Регрессии времени запуска:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print("Регрессий нет")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,128 @@
+"""
+Проверка упаковки промпта в окно контекста (utils/context_packer.py)
+
+Для каждого случая собирается промпт как у агента: системный промпт и
+запрос пользователя (обязательные), инструменты, описание проекта,
+файлы (обрезаемые) и ходы истории от новых к старым (цепочка requires).
+Окно, лимит генерации и служебные токены сообщения - случайные.
+Проверяется, что:
+  - если обязательные фрагменты помещаются, занято не больше бюджета,
+    а used равно сумме токенов включённых фрагментов;
+  - обязательные фрагменты включены всегда;
+  - порядок включённых фрагментов исходный;
+  - ход истории включён, только если включён более новый ход;
+  - обрезанный фрагмент - начало исходного текста, не короче min_tokens;
+  - если всё помещается, ничего не обрезано и не отброшено.
+
+Использование:
+    python check_context_packer.py
+    python check_context_packer.py --cases 20000 --seed 7
+"""
+
+import sys
+import random
+import logging
+import argparse
+from typing import List, Optional
+
+from utils.context_packer import ContextPacker, Segment
+
+
+def count(text: str) -> int:
+    """Токены: примерно 4 символа на токен"""
+    return (len(text) + 3) // 4
+
+
+def make_text(rng: random.Random, max_chars: int) -> str:
+    return ''.join(rng.choices('abcdefgh \n', k=rng.randint(1, max_chars)))
+
+
+def make_segments(rng: random.Random) -> List[Segment]:
+    """Фрагменты в порядке сборки сообщений"""
+    def cuttable(text: str):
+        return lambda chars: text[:chars]
+
+    segments = [Segment('system', make_text(rng, 2000), priority=0, required=True, messages=1)]
+    if rng.random() < 0.7:
+        text = make_text(rng, 3000)
+        segments.append(Segment('tools', text, priority=2, cut=cuttable(text)))
+    if rng.random() < 0.7:
+        text = make_text(rng, 8000)
+        segments.append(Segment('project', text, priority=4, cut=cuttable(text), min_tokens=rng.choice([16, 64, 256])))
+    for number in range(rng.randint(0, 3)):
+        text = make_text(rng, 6000)
+        segments.append(Segment(f'file:{number}', text, priority=3, cut=cuttable(text)))
+    turns = rng.randint(0, 12)
+    # История: новые ходы важнее, более старый ход требует включения более нового
+    for age in reversed(range(turns)):
+        segments.append(Segment(
+            f'history:{age}', make_text(rng, 1500), priority=10 + age, messages=2,
+            requires=f'history:{age - 1}' if age else None,
+        ))
+    text = make_text(rng, 1500)
+    segments.append(Segment('user', text, priority=1, required=True, messages=1, cut=cuttable(text) if rng.random() < 0.5 else None))
+    return segments
+
+
+def check_case(rng: random.Random) -> Optional[str]:
+    """Описание нарушения или None"""
+    segments = make_segments(rng)
+    originals = {segment.name: segment.text for segment in segments}
+    window = rng.choice([512, 2048, 4096, 8192, 32768])
+    generation_budget = rng.choice([128, 1024, 4096])
+    overhead = rng.randint(0, 8)
+    packer = ContextPacker(safety_margin=rng.choice([0.0, 0.05, 0.1]), max_response_share=rng.choice([0.25, 0.5]))
+
+    required_tokens = sum(count(s.text) + overhead * s.messages for s in segments if s.required)
+    all_tokens = sum(count(s.text) + overhead * s.messages for s in segments)
+    result = packer.pack(segments, window, generation_budget, count, message_overhead=overhead)
+    names = [segment.name for segment in result.included]
+
+    if result.budget != max(window - result.reserve - int(window * packer.safety_margin), 0):
+        return "неверный бюджет"
+    if result.used != sum(segment.tokens for segment in result.included):
+        return f"used {result.used} != сумме включённых"
+    if required_tokens <= result.budget and result.used > result.budget:
+        return f"занято {result.used} > бюджета {result.budget}"
+    if not {'system', 'user'} <= set(names):
+        return "обязательный фрагмент не включён"
+    order = [segment.name for segment in segments]
+    if names != [name for name in order if name in names]:
+        return "порядок фрагментов нарушен"
+    for segment in result.included:
+        if segment.requires is not None and segment.requires not in names:
+            return f"{segment.name} включён без {segment.requires}"
+    for name in result.truncated:
+        segment = result.get(name)
+        if segment is None or not originals[name].startswith(segment.text):
+            return f"обрезанный {name} - не начало исходного текста"
+        if count(segment.text) < segment.min_tokens:
+            return f"обрезанный {name} короче min_tokens"
+    if all_tokens <= result.budget and (result.truncated or result.dropped):
+        return "всё помещается, но фрагменты обрезаны или отброшены"
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Проверка ContextPacker.pack на случайных промптах")
+    parser.add_argument('--cases', type=int, default=3000, help="Количество случаев")
+    parser.add_argument('--seed', type=int, default=1, help="Начальное значение генератора")
+    args = parser.parse_args()
+    # Журнал решений упаковки (в том числе о переполнении) для проверки не нужен
+    logging.getLogger('utils.context_packer').setLevel(logging.CRITICAL)
+
+    rng = random.Random(args.seed)
+    failures = 0
+    for case in range(args.cases):
+        problem = check_case(rng)
+        if problem is not None:
+            failures += 1
+            if failures <= 10:
+                print(f"  [FAIL] случай {case}: {problem}")
+
+    print(f"Случаев: {args.cases}, нарушений: {failures}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,120 @@
+"""
+Проверка сокращения контекста (utils/context_trim.py) на случайных текстах
+
+Для каждого случая генерируется текст (код без разделов или описание
+проекта с разделами get_project_summary в случайном порядке, пустые и
+очень длинные строки) и лимит от нескольких символов до размера текста.
+Проверяется, что:
+  - результат не длиннее лимита;
+  - текст, который помещается в лимит, возвращается без изменений;
+  - без разделов результат начинается с начала исходного текста
+    (или с метки пропуска, если первая строка слишком длинная);
+  - разделы остаются в исходном порядке, а самый важный раздел,
+    если он помещается, сохраняется целиком.
+
+Использование:
+    python check_context_trim.py
+    python check_context_trim.py --cases 20000 --seed 7
+"""
+
+import sys
+import random
+import argparse
+from typing import List, Optional
+
+from utils.context_trim import trim_context, MIDDLE_MARK, PROJECT_SUMMARY_SECTIONS
+
+
+def random_line(rng: random.Random) -> str:
+    kind = rng.random()
+    if kind < 0.1:
+        return ''
+    if kind < 0.15:
+        # Строка длиннее любого лимита - режется по символам
+        return 'x' * rng.randint(200, 3000)
+    return ' ' * rng.randint(0, 8) + ''.join(rng.choices('abcdefgh_()=:.', k=rng.randint(1, 80)))
+
+
+def make_plain(rng: random.Random) -> str:
+    return '\n'.join(random_line(rng) for _ in range(rng.randint(1, 300)))
+
+
+def make_sections(rng: random.Random) -> str:
+    """Описание проекта: необязательный текст до первого заголовка и разделы в случайном порядке"""
+    headers = [prefix + (' README.md):' if prefix.startswith('README') else '') for prefix, _ in PROJECT_SUMMARY_SECTIONS]
+    rng.shuffle(headers)
+    lines: List[str] = []
+    if rng.random() < 0.3:
+        lines += [random_line(rng) for _ in range(rng.randint(1, 5))]
+    for header in headers[:rng.randint(2, len(headers))]:
+        lines.append(header)
+        lines += [random_line(rng) for _ in range(rng.randint(0, 80))]
+    return '\n'.join(lines)
+
+
+def section_positions(text: str) -> List[int]:
+    """Номера разделов (по PROJECT_SUMMARY_SECTIONS) в порядке появления"""
+    order = []
+    for line in text.split('\n'):
+        for number, (prefix, _) in enumerate(PROJECT_SUMMARY_SECTIONS):
+            if line.startswith(prefix):
+                order.append(number)
+                break
+    return order
+
+
+def check_case(text: str, max_size: int) -> Optional[str]:
+    """Описание нарушения или None"""
+    result = trim_context(text, max_size)
+    if len(result) > max_size:
+        return f"длина {len(result)} > лимита {max_size}"
+    if len(text) <= max_size:
+        return None if result == text else "помещающийся текст изменён"
+
+    original = section_positions(text)
+    if len(original) < 2:
+        # Без разделов: начало текста по границам строк (или по символам);
+        # первая строка длиннее доли начала - результат начинается с метки пропуска
+        head = result.split('\n', 1)[0]
+        if head and head != MIDDLE_MARK and not text.startswith(head):
+            return "результат не начинается с начала текста"
+        return None
+
+    kept = section_positions(result)
+    if kept != [number for number in original if number in kept]:
+        return f"порядок разделов нарушен: {original} -> {kept}"
+    # Самый важный раздел текста (наименьший номер) целиком
+    lines = text.split('\n')
+    best = min(original)
+    start = next(i for i, line in enumerate(lines) if line.startswith(PROJECT_SUMMARY_SECTIONS[best][0]))
+    end = next((i for i in range(start + 1, len(lines)) if section_positions(lines[i])), len(lines))
+    section = '\n'.join(lines[start:end])
+    preamble = '\n'.join(lines[:next(i for i, line in enumerate(lines) if section_positions(line))])
+    if len(section) + len(preamble) + 2 <= max_size and section not in result:
+        return "самый важный раздел помещается, но не сохранён целиком"
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Проверка trim_context на случайных текстах")
+    parser.add_argument('--cases', type=int, default=3000, help="Количество случаев")
+    parser.add_argument('--seed', type=int, default=1, help="Начальное значение генератора")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    failures = 0
+    for case in range(args.cases):
+        text = make_sections(rng) if rng.random() < 0.5 else make_plain(rng)
+        max_size = rng.choice([rng.randint(0, 60), rng.randint(0, max(len(text), 1) * 11 // 10)])
+        problem = check_case(text, max_size)
+        if problem is not None:
+            failures += 1
+            if failures <= 10:
+                print(f"  [FAIL] случай {case}: текст {len(text)} символов, лимит {max_size}: {problem}")
+
+    print(f"Случаев: {args.cases}, нарушений: {failures}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
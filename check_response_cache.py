@@ -0,0 +1,246 @@
+"""
+Проверка кэша ответов: ResponseCache и сохранение только полных ответов
+
+ResponseCache проверяется отдельно от агента:
+  - ключ не зависит от порядка полей и метаданных сообщений, но зависит
+    от модели, параметров и текста;
+  - кэшируются только запросы с температурой не выше max_temperature;
+  - LRU в памяти вытесняет старые записи, они читаются с диска;
+  - просроченные записи не выдаются, при превышении max_disk_mb
+    вытесняются давно не использовавшиеся.
+
+Затем агент работает с локальным имитатором Ollama, который стримит
+ответ по словам с паузой. Проверяется, что:
+  - полный ответ сохраняется, повторный запрос обслуживается из кэша;
+  - ход, отменённый посреди потока (ask и aask), ничего не сохраняет;
+  - поток, оборванный сервером до маркера done, ничего не сохраняет.
+
+Использование:
+    python check_response_cache.py
+"""
+
+import sys
+import json
+import time
+import asyncio
+import tempfile
+import threading
+from pathlib import Path
+from typing import Callable, List
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from agent import CodeAgent
+from utils.cancellation import CancellationToken
+from utils.response_cache import ResponseCache
+
+WORDS = ['один ', 'два ', 'три ', 'четыре ', 'пять ', 'шесть ', 'семь ', 'восемь ']
+
+
+class SlowOllama(BaseHTTPRequestHandler):
+    """Имитатор Ollama: потоковый чат по одному слову; CUT в запросе - обрыв без done"""
+
+    protocol_version = 'HTTP/1.1'
+    delay = 0.05
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, data: dict):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _write_chunk(self, data: bytes):
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        self.wfile.flush()
+
+    def do_GET(self):
+        self._send_json({'models': [{'name': 'check'}]})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length) or b'{}')
+        if self.path != '/api/chat':
+            self._send_json({'parameters': 'num_ctx 8192'})
+            return
+        cut = 'CUT' in body['messages'][-1]['content']
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            for word in WORDS:
+                self._write_chunk((json.dumps({'message': {'content': word}, 'done': False}) + '\n').encode('utf-8'))
+                time.sleep(self.delay)
+            if not cut:
+                done = {'message': {'content': ''}, 'done': True, 'prompt_eval_count': 10, 'eval_count': len(WORDS)}
+                self._write_chunk((json.dumps(done) + '\n').encode('utf-8'))
+            self.wfile.write(b'0\r\n\r\n')
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+class QuietServer(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # Отменённый ход закрывает соединение - для проверки это норма
+        pass
+
+
+def start_server() -> ThreadingHTTPServer:
+    server = QuietServer(('127.0.0.1', 0), SlowOllama)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def write_config(workdir: Path, port: int) -> Path:
+    """Конфигурация: имитатор Ollama, жадное декодирование, кэш ответов в рабочем каталоге"""
+    config = f"""
+agent:
+  history_path: {workdir / 'history'}
+  save_history: false
+  load_project_context: false
+cache:
+  enabled: true
+  path: {workdir / 'responses.sqlite'}
+mcp:
+  enabled: false
+model:
+  provider: ollama
+  model_name: check
+  generation:
+    temperature: 0
+ollama:
+  base_url: http://127.0.0.1:{port}
+warmup:
+  enabled: false
+"""
+    path = workdir / 'config.yaml'
+    path.write_text(config, encoding='utf-8')
+    return path
+
+
+def check_cache(workdir: Path, check: Callable[[str, Callable[[], bool]], None]):
+    """ResponseCache без агента"""
+    messages = [{'role': 'user', 'content': 'вопрос'}]
+    key = ResponseCache.make_key('m', {'temperature': 0, 'top_p': 1}, messages)
+    check("ключ не зависит от порядка параметров и метаданных сообщений", lambda: key == ResponseCache.make_key(
+        'm', {'top_p': 1, 'temperature': 0}, [{'content': 'вопрос', 'role': 'user', 'timestamp': 1}]
+    ))
+    check("ключ зависит от модели, параметров и текста", lambda: len({
+        key,
+        ResponseCache.make_key('m2', {'temperature': 0, 'top_p': 1}, messages),
+        ResponseCache.make_key('m', {'temperature': 0, 'top_p': 0.9}, messages),
+        ResponseCache.make_key('m', {'temperature': 0, 'top_p': 1}, [{'role': 'user', 'content': 'другой'}]),
+    }) == 4)
+
+    cache = ResponseCache(path=str(workdir / 'unit.sqlite'), memory_entries=2, max_temperature=0.0)
+    check("жадное декодирование кэшируется, сэмплирование - нет", lambda: (
+        cache.is_cacheable(0) and not cache.is_cacheable(0.7) and not cache.is_cacheable(None)
+        and cache.stats['bypassed'] == 2
+    ))
+
+    for number in range(3):
+        cache.put(f'k{number}', [f'ответ {number}', '!'])
+    check("LRU в памяти держит memory_entries записей", lambda: len(cache._memory) == 2 and 'k0' not in cache._memory)
+    check("вытесненная из памяти запись читается с диска", lambda: cache.get('k0') == ['ответ 0', '!'] and cache.stats['disk_hits'] == 1)
+    check("промах - None", lambda: cache.get('нет') is None and cache.stats['misses'] == 1)
+    cache.close()
+
+    expired = ResponseCache(path=str(workdir / 'ttl.sqlite'), ttl=-1)
+    expired.put('k', ['устарел'])
+    check("просроченная запись не выдаётся", lambda: expired.get('k') is None)
+    expired.close()
+
+    small = ResponseCache(path=str(workdir / 'small.sqlite'), memory_entries=1, max_disk_mb=2048 / (1024 * 1024))
+    for number in range(5):
+        small.put(f'k{number}', ['x' * 500])
+        time.sleep(0.002)
+    check("при превышении max_disk_mb вытесняются старые записи", lambda: (
+        small.stats['evictions'] > 0 and small.get('k0') is None and small.get('k4') == ['x' * 500]
+    ))
+    small.close()
+
+
+def ask_and_cancel(agent: CodeAgent, prompt: str, after_chunks: int) -> str:
+    """Синхронный ход, отменённый после нескольких чанков ответа"""
+    token = CancellationToken()
+    parts = []
+    for chunk in agent.ask(prompt, cancel_token=token):
+        parts.append(chunk)
+        if len(parts) == after_chunks:
+            token.cancel("проверка")
+    return ''.join(parts)
+
+
+async def aask_and_cancel(agent: CodeAgent, prompt: str, after_chunks: int) -> str:
+    """Асинхронный ход, отменённый после нескольких чанков ответа"""
+    token = CancellationToken()
+    parts = []
+    try:
+        async for chunk in agent.aask(prompt, cancel_token=token):
+            parts.append(chunk)
+            if len(parts) == after_chunks:
+                token.cancel("проверка")
+    finally:
+        await agent.aclose()
+    return ''.join(parts)
+
+
+def main():
+    server = start_server()
+    failures: List[str] = []
+
+    def check(name: str, condition: Callable[[], bool]):
+        ok = condition()
+        print(f"  [{'OK' if ok else 'FAIL'}] {name}")
+        if not ok:
+            failures.append(name)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        print("[0] ResponseCache")
+        check_cache(Path(workdir), check)
+
+        agent = CodeAgent(config_path=str(write_config(Path(workdir), server.server_address[1])))
+        cache = agent.response_cache
+        try:
+            print("[1] Отмена посреди потока (ask)")
+            partial = ask_and_cancel(agent, "отмена", after_chunks=2)
+            check("ответ оборван", lambda: partial != ''.join(WORDS))
+            check("в кэш ничего не сохранено", lambda: cache.stats['stores'] == 0)
+
+            print("[2] Отмена посреди потока (aask)")
+            partial = asyncio.run(aask_and_cancel(agent, "асинхронная отмена", after_chunks=2))
+            check("ответ оборван", lambda: partial != ''.join(WORDS))
+            check("в кэш ничего не сохранено", lambda: cache.stats['stores'] == 0)
+
+            print("[3] Поток оборван сервером до done")
+            answer = ''.join(agent.ask("CUT"))
+            check("получены все слова", lambda: answer == ''.join(WORDS))
+            check("в кэш ничего не сохранено", lambda: cache.stats['stores'] == 0)
+
+            print("[4] Полный ответ")
+            agent.clear_history()
+            answer = ''.join(agent.ask("полный"))
+            check("ответ сохранён в кэш", lambda: cache.stats['stores'] == 1)
+            agent.clear_history()
+            hits = cache.stats['hits']
+            again = ''.join(agent.ask("полный"))
+            check("повтор обслужен из кэша", lambda: cache.stats['hits'] == hits + 1 and again == answer)
+        finally:
+            agent.shutdown()
+            server.shutdown()
+
+    print(f"Статистика кэша: {cache.get_stats()}")
+    if failures:
+        print(f"Не пройдено проверок: {len(failures)}")
+        return 1
+    print("Все проверки пройдены")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
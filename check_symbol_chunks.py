@@ -0,0 +1,240 @@
+"""
+Проверка разбиения файлов на фрагменты (utils/symbol_chunks.py)
+
+Проверяется, что:
+  - на файлах проекта (Python, Markdown, JS, прочие) при разных
+    max_chars фрагменты идут по порядку, не пересекаются, покрывают все
+    непустые строки и не длиннее max_chars (кроме одной длинной строки),
+    а функции и классы верхнего уровня Python становятся фрагментами;
+  - большой класс делится на заголовок и методы (Класс.метод),
+    определения JS/TS и разделы Markdown получают имена, заголовки
+    внутри блоков кода Markdown разделов не создают;
+  - фрагмент, в имени которого есть слово запроса, выше фрагмента,
+    где слово только в тексте, а редкое слово весит больше частого;
+  - ChunkIndex берёт неизменённый файл из памяти, после перезапуска -
+    из JSON, изменённый файл разбирает заново, таблицы удалённых файлов
+    при сохранении отбрасывает.
+
+Использование:
+    python check_symbol_chunks.py
+    python check_symbol_chunks.py --root ../other_project --max-chars 300 2000
+"""
+
+import os
+import ast
+import sys
+import time
+import argparse
+import tempfile
+from pathlib import Path
+from typing import Callable, List, Optional
+
+from utils.symbol_chunks import (
+    Chunk, ChunkIndex, chunk_spans, keyword_weights, query_keywords, score_chunk,
+)
+
+ROOT = Path(__file__).resolve().parent
+SUFFIXES = {'.py', '.md', '.js', '.ts', '.txt', '.yaml', '.html', '.css'}
+SKIP_DIRS = {'.git', '__pycache__', 'node_modules', 'venv', '.venv', 'cache', 'logs', 'history'}
+
+
+def project_files(root: Path, limit: int = 400) -> List[Path]:
+    files = []
+    for directory, dirs, names in os.walk(root):
+        dirs[:] = sorted(d for d in dirs if d not in SKIP_DIRS)
+        for name in sorted(names):
+            if Path(name).suffix.lower() in SUFFIXES:
+                files.append(Path(directory) / name)
+    return files[:limit]
+
+
+def check_spans(file_name: str, text: str, max_chars: int) -> Optional[str]:
+    """Описание нарушения или None"""
+    lines = text.split('\n')
+    spans = chunk_spans(file_name, text, max_chars)
+    covered = set()
+    previous_end = 0
+    for start, end, name, kind in spans:
+        if not 1 <= start <= end <= len(lines):
+            return f"фрагмент {start}-{end} вне файла ({len(lines)} строк)"
+        if start <= previous_end:
+            return f"фрагмент {start}-{end} пересекается с предыдущим (до {previous_end})"
+        previous_end = end
+        size = sum(len(line) + 1 for line in lines[start - 1:end])
+        if size > max_chars and start != end:
+            return f"фрагмент {start}-{end} ({name or kind}) длиннее {max_chars}: {size}"
+        covered.update(range(start, end + 1))
+    missed = [number for number, line in enumerate(lines, 1) if line.strip() and number not in covered]
+    if missed:
+        return f"строки вне фрагментов: {missed[:5]}"
+    if file_name.endswith('.py'):
+        try:
+            tree = ast.parse(text)
+        except SyntaxError:
+            return None
+        names = {span[2] for span in spans}
+        for node in tree.body:
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)) and node.name not in names:
+                return f"определение {node.name} не стало фрагментом"
+    return None
+
+
+PYTHON_SAMPLE = '''import os
+
+
+class Storage:
+    """Хранилище"""
+
+    limit = 10
+
+    def load(self, key):
+        return self._data.get(key)
+
+    # Запись с проверкой лимита
+    @staticmethod
+    def save(key, value):
+        return {key: value}
+
+
+def helper():
+    return Storage()
+'''
+
+SCRIPT_SAMPLE = '''import x from "x";
+
+/** Загрузка */
+export async function loadData(url) {
+  return fetch(url);
+}
+
+export const render = (items) => items.map(String);
+
+class Widget {
+}
+'''
+
+MARKDOWN_SAMPLE = '''# Заголовок
+
+Введение.
+
+## Установка
+
+```bash
+# не заголовок
+pip install x
+```
+
+## Использование
+
+Текст.
+'''
+
+
+def check_samples(check: Callable[[str, bool], None]):
+    spans = chunk_spans('storage.py', PYTHON_SAMPLE, max_chars=120)
+    names = [span[2] for span in spans]
+    check(f"большой класс: заголовок и методы ({names})", {'Storage', 'Storage.load', 'Storage.save', 'helper'} <= set(names))
+    save = next(span for span in spans if span[2] == 'Storage.save')
+    check("комментарий и декоратор относятся к методу", PYTHON_SAMPLE.split('\n')[save[0] - 1].lstrip().startswith('#'))
+
+    spans = chunk_spans('app.js', SCRIPT_SAMPLE)
+    names = [(span[2], span[3]) for span in spans]
+    check(f"определения JS ({names})", [('loadData', 'function'), ('render', 'function'), ('Widget', 'class')] == [n for n in names if n[0]])
+    load = next(span for span in spans if span[2] == 'loadData')
+    check("комментарий над функцией JS относится к ней", SCRIPT_SAMPLE.split('\n')[load[0] - 1].startswith('/**'))
+
+    spans = chunk_spans('README.md', MARKDOWN_SAMPLE)
+    check("разделы Markdown без заголовков из блоков кода", [span[2] for span in spans] == ['Заголовок', 'Установка', 'Использование'])
+
+    spans = chunk_spans('broken.py', 'def broken(:\n    pass\n' * 50, max_chars=200)
+    check("файл с синтаксической ошибкой делится по строкам", len(spans) > 1 and all(span[3] == 'code' for span in spans))
+
+
+def check_scoring(check: Callable[[str, bool], None]):
+    named = Chunk('load_config', 'function', 1, 3, 'def load_config(path):\n    return read(path)')
+    body = Chunk('parse', 'function', 4, 6, 'def parse(text):\n    config = load_config(text)\n    return config')
+    other = Chunk('render', 'function', 7, 9, 'def render(config):\n    return str(config)')
+    chunks = [named, body, other]
+    weights = keyword_weights(query_keywords("где load_config читает config"), chunks)
+    check("редкое слово весит больше частого", weights['load_config'] > weights['config'])
+    check(
+        "слово запроса в имени выше, чем только в тексте",
+        score_chunk(named, weights) > score_chunk(body, weights) > score_chunk(other, weights)
+    )
+    check("совпадение с именем файла повышает оценку", score_chunk(other, weights, 'config.py') > score_chunk(other, weights, 'view.py'))
+
+
+def check_index(check: Callable[[str, bool], None]):
+    with tempfile.TemporaryDirectory() as workdir:
+        source = Path(workdir) / 'module.py'
+        source.write_text(PYTHON_SAMPLE, encoding='utf-8')
+        cache = Path(workdir) / 'chunks.json'
+        read = lambda: source.read_text(encoding='utf-8')
+
+        index = ChunkIndex(str(cache), max_chunk_chars=120)
+        first = index.chunks(source, read)
+        again = index.chunks(source, read)
+        check("повторный запрос - из памяти", again is first and index.stats['memory_hits'] == 1)
+        check("текст фрагментов - строки файла", all(chunk.text in PYTHON_SAMPLE for chunk in first))
+        index.save()
+
+        restarted = ChunkIndex(str(cache), max_chunk_chars=120)
+        restored = restarted.chunks(source, read)
+        check(
+            "после перезапуска - таблица из JSON",
+            restarted.stats['disk_hits'] == 1 and [(c.start, c.end, c.name) for c in restored] == [(c.start, c.end, c.name) for c in first]
+        )
+        check("другой max_chunk_chars - таблицы строятся заново", ChunkIndex(str(cache), max_chunk_chars=500).get_stats()['files'] == 0)
+
+        # Время изменения в наносекундах может совпасть на грубых файловых системах
+        time.sleep(0.01)
+        source.write_text(PYTHON_SAMPLE + '\n\ndef added():\n    return 1\n', encoding='utf-8')
+        changed = restarted.chunks(source, read)
+        check("изменённый файл разбирается заново", restarted.stats['chunked'] == 1 and any(c.name == 'added' for c in changed))
+
+        source.unlink()
+        restarted.save()
+        check("таблица удалённого файла отброшена", ChunkIndex(str(cache), max_chunk_chars=120).get_stats()['files'] == 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Проверка разбиения файлов на фрагменты")
+    parser.add_argument('--root', default=str(ROOT), help="Каталог с файлами для проверки разбиения")
+    parser.add_argument('--max-chars', type=int, nargs='+', default=[300, 2000], help="Размеры фрагментов")
+    args = parser.parse_args()
+
+    failures: List[str] = []
+
+    def check(name: str, ok: bool):
+        print(f"  [{'OK' if ok else 'FAIL'}] {name}")
+        if not ok:
+            failures.append(name)
+
+    files = project_files(Path(args.root))
+    problems = []
+    for path in files:
+        try:
+            text = path.read_text(encoding='utf-8')
+        except (OSError, UnicodeDecodeError):
+            continue
+        for max_chars in args.max_chars:
+            problem = check_spans(path.name, text, max_chars)
+            if problem is not None:
+                problems.append(f"{path.relative_to(args.root)} (max_chars={max_chars}): {problem}")
+    for problem in problems[:10]:
+        print(f"    {problem}")
+    check(f"разбиение {len(files)} файлов проекта", not problems)
+
+    check_samples(check)
+    check_scoring(check)
+    check_index(check)
+
+    if failures:
+        print(f"Не пройдено проверок: {len(failures)}")
+        return 1
+    print("Все проверки пройдены")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,145 @@
+"""
+Проверка калибровки оценки токенов (utils/token_calibration.py)
+
+Без модели и сети: наблюдения генерируются по известным "истинным"
+коэффициентам. Проверяется, что:
+  - _solve решает случайные системы и отказывается от вырожденных;
+  - после серии наблюдений observe восстанавливает коэффициенты;
+  - коэффициенты не выходят за BOUNDS при неправдоподобных данных;
+  - пустые наблюдения игнорируются, калибровка включается после min_samples,
+    поколение растёт при заметном изменении коэффициентов;
+  - состояние переживает сохранение и повторную загрузку.
+
+Использование:
+    python check_token_calibration.py
+    python check_token_calibration.py --seed 7
+"""
+
+import sys
+import random
+import argparse
+import tempfile
+from pathlib import Path
+from typing import Callable, List
+
+from utils.token_calibration import BOUNDS, FEATURES, PRIOR, TokenCalibrator, _solve, text_features
+
+# "Истинные" коэффициенты модели: токенов на сообщение и на 100 символов кода, текста, кириллицы
+TRUE_WEIGHTS = (6.0, 35.0, 22.0, 48.0)
+
+
+def random_features(rng: random.Random) -> List[float]:
+    """Признаки запроса: сообщения и сотни символов каждого типа"""
+    return [float(rng.randint(1, 12))] + [rng.uniform(0, 40) for _ in FEATURES[1:]]
+
+
+def true_tokens(features: List[float], rng: random.Random, noise: float) -> int:
+    exact = sum(w * x for w, x in zip(TRUE_WEIGHTS, features))
+    return max(1, round(exact * (1 + rng.uniform(-noise, noise))))
+
+
+def check_solve(rng: random.Random, check: Callable[[str, bool], None]):
+    worst = 0.0
+    for _ in range(200):
+        n = rng.randint(1, 6)
+        # Диагональное преобладание - система заведомо невырожденная
+        matrix = [[rng.uniform(-1, 1) + (n + 1 if i == j else 0) for j in range(n)] for i in range(n)]
+        expected = [rng.uniform(-100, 100) for _ in range(n)]
+        vector = [sum(matrix[i][j] * expected[j] for j in range(n)) for i in range(n)]
+        solution = _solve(matrix, vector)
+        worst = max(worst, max(abs(a - b) for a, b in zip(solution, expected)))
+    check(f"_solve: случайные системы решены (наибольшая ошибка {worst:.1e})", worst < 1e-6)
+    check("_solve: вырожденная система - None", _solve([[1.0, 2.0], [2.0, 4.0]], [1.0, 2.0]) is None)
+    # Перестановка строк (нулевой элемент на диагонали)
+    check("_solve: выбор главного элемента", _solve([[0.0, 1.0], [1.0, 0.0]], [2.0, 3.0]) == [3.0, 2.0])
+
+
+def check_convergence(rng: random.Random, check: Callable[[str, bool], None]):
+    calibrator = TokenCalibrator(path=None)
+    for _ in range(300):
+        features = random_features(rng)
+        calibrator.observe('model', features, true_tokens(features, rng, noise=0.02))
+    weights = calibrator._models['model'].weights
+    errors = [abs(w - t) / t for w, t in zip(weights, TRUE_WEIGHTS)]
+    details = ", ".join(f"{name} {w:.1f}/{t:.0f}" for name, w, t in zip(FEATURES, weights, TRUE_WEIGHTS))
+    check(f"observe: коэффициенты восстановлены ({details})", max(errors) < 0.1)
+
+    text = "Пример текста и ```code = 1``` для оценки " * 20
+    expected = sum(w * x for w, x in zip(TRUE_WEIGHTS[1:], text_features(text)[1:]))
+    estimate = calibrator.estimate('model', text)
+    check(f"estimate: {estimate} токенов при истинных {expected:.0f}", abs(estimate - expected) <= 0.1 * expected)
+
+
+def check_bounds(rng: random.Random, check: Callable[[str, bool], None]):
+    calibrator = TokenCalibrator(path=None)
+    for _ in range(100):
+        features = random_features(rng)
+        calibrator.observe('huge', features, 10 ** 7)
+        calibrator.observe('tiny', features, 1)
+    inside = all(
+        low <= w <= high
+        for model in ('huge', 'tiny')
+        for w, (low, high) in zip(calibrator._models[model].weights, BOUNDS)
+    )
+    check("коэффициенты в пределах BOUNDS", inside)
+
+
+def check_lifecycle(rng: random.Random, check: Callable[[str, bool], None]):
+    with tempfile.TemporaryDirectory() as workdir:
+        path = Path(workdir) / 'calibration.json'
+        calibrator = TokenCalibrator(path=str(path), min_samples=3, save_every=1000)
+
+        calibrator.observe('model', random_features(rng), 0)
+        calibrator.observe('model', [3.0, 0.0, 0.0, 0.0], 50)
+        check("пустые наблюдения игнорируются", 'model' not in calibrator._models)
+
+        calibrator.observe_request('model', [{'role': 'user', 'content': 'Привет, мир'}], 'Ответ', {'prompt_tokens': 12, 'completion_tokens': 3})
+        check("observe_request: промпт и ответ - два наблюдения", calibrator._models['model'].samples == 2)
+        check("до min_samples калибровка не используется", not calibrator.calibrated('model') and calibrator.generation('model') == 0)
+        check("до min_samples - служебные токены по умолчанию", calibrator.message_overhead('model') == round(PRIOR[0]))
+
+        for _ in range(50):
+            features = random_features(rng)
+            calibrator.observe('model', features, true_tokens(features, rng, noise=0.0))
+        check("после min_samples калибровка используется", calibrator.calibrated('model'))
+        check("поколение выросло после изменения коэффициентов", calibrator.generation('model') > 0)
+
+        calibrator.save()
+        reloaded = TokenCalibrator(path=str(path))
+        before, after = calibrator._models['model'], reloaded._models.get('model')
+        check(
+            "состояние восстановлено из файла",
+            after is not None and after.samples == before.samples and after.weights == before.weights
+        )
+
+        path.write_text('{испорчен', encoding='utf-8')
+        check("испорченный файл не мешает запуску", TokenCalibrator(path=str(path))._models == {})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Проверка калибровки оценки токенов")
+    parser.add_argument('--seed', type=int, default=1, help="Начальное значение генератора")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    failures: List[str] = []
+
+    def check(name: str, ok: bool):
+        print(f"  [{'OK' if ok else 'FAIL'}] {name}")
+        if not ok:
+            failures.append(name)
+
+    check_solve(rng, check)
+    check_convergence(rng, check)
+    check_bounds(rng, check)
+    check_lifecycle(rng, check)
+
+    if failures:
+        print(f"Не пройдено проверок: {len(failures)}")
+        return 1
+    print("Все проверки пройдены")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
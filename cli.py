@@ -3,18 +3,21 @@
 """
 
 import sys
+import time
+import argparse
 from prompt_toolkit import PromptSession
 from prompt_toolkit.history import FileHistory
 from prompt_toolkit.auto_suggest import AutoSuggestFromHistory
 from prompt_toolkit.completion import Completer, Completion
 from prompt_toolkit.styles import Style
 from rich.console import Console
-from rich.markdown import Markdown
-from rich.syntax import Syntax
 from rich.panel import Panel
 from rich.live import Live
 from rich.text import Text
+from rich.table import Table
 from agent import CodeAgent
+from utils.batch import read_requests, finished_ids, ResultWriter, summarize
+from utils.cancellation import CancellationToken
 import os
 from pathlib import Path
 
@@ -84,6 +87,8 @@ def print_help():
 
 def format_code_in_response(text: str) -> str:
     """Форматирование кода в ответе"""
+    from rich.syntax import Syntax
+    
     # Простое определение блоков кода
     lines = text.split('\n')
     result = []
@@ -120,8 +125,73 @@ def format_code_in_response(text: str) -> str:
     return '\n'.join(str(r) for r in result) if result else text
 
 
+def run_batch(argv):
+    """
+    Пакетная обработка: python cli.py batch in.jsonl out.jsonl [--concurrency N]
+    
+    Результаты дописываются в out.jsonl по мере готовности; при повторном
+    запуске уже успешно обработанные id пропускаются.
+    """
+    parser = argparse.ArgumentParser(prog="cli.py batch", description="Пакетная обработка промптов из JSONL")
+    parser.add_argument('input', help="JSONL с запросами (поля id и prompt, или request_id/title/body)")
+    parser.add_argument('output', help="JSONL с результатами")
+    parser.add_argument('--concurrency', '-c', type=int, default=None, help="Максимум одновременных запросов")
+    parser.add_argument('--config', default="config.yaml", help="Путь к конфигурации")
+    args = parser.parse_args(argv)
+    
+    try:
+        agent = CodeAgent(args.config)
+    except Exception as e:
+        console.print(f"[red]Ошибка инициализации агента: {e}[/red]")
+        return 1
+    
+    done = finished_ids(args.output)
+    skipped = 0
+    
+    def pending_requests():
+        nonlocal skipped
+        for request in read_requests(args.input):
+            if request['id'] in done:
+                skipped += 1
+                continue
+            yield request
+    
+    concurrency = args.concurrency or agent.config.get('batch', {}).get('concurrency', 4)
+    console.print(f"[cyan]Пакетная обработка {args.input} -> {args.output} (параллельно: {concurrency})[/cyan]")
+    if done:
+        console.print(f"[dim]Уже обработано: {len(done)}, эти запросы будут пропущены[/dim]")
+    
+    results = []
+    started = time.perf_counter()
+    with ResultWriter(args.output) as writer:
+        def on_result(result):
+            writer.write(result)
+            results.append(result)
+            status = "[green]✓[/green]" if result['ok'] else "[red]✗[/red]"
+            console.print(f"{status} {result['id']} ({result['elapsed']:.1f}с, {result['completion_tokens']} ток.)")
+        
+        try:
+            agent.ask_many(pending_requests(), concurrency=concurrency, on_result=on_result)
+        except KeyboardInterrupt:
+            console.print("\n[yellow]Прервано. Готовые результаты сохранены, повторный запуск продолжит обработку[/yellow]")
+        finally:
+            agent.shutdown()
+    
+    summary = summarize(results, time.perf_counter() - started, skipped)
+    table = Table(title="Итоги пакета", show_header=False)
+    table.add_row("Выполнено", f"{summary['ok']} из {summary['total']} (ошибок: {summary['failed']}, пропущено: {summary['skipped']})")
+    table.add_row("Время", f"{summary['elapsed']} с")
+    table.add_row("Запросов в секунду", str(summary['requests_per_s']))
+    table.add_row("Токенов в секунду", f"{summary['tokens_per_s']} ({summary['completion_tokens']} токенов)")
+    console.print(table)
+    return 0 if summary['failed'] == 0 else 1
+
+
 def main():
     """Основная функция CLI"""
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        sys.exit(run_batch(sys.argv[2:]))
+    
     # Создаем директорию для истории
     history_dir = Path.home() / '.ai_agent'
     history_dir.mkdir(exist_ok=True)
@@ -201,8 +271,10 @@ def main():
             full_response = ""
             response_parts = []
             
+            # Ctrl+C прерывает генерацию: агент закрывает запрос к модели
+            cancel_token = CancellationToken()
             try:
-                for chunk in agent.ask(user_input, stream=True):
+                for chunk in agent.ask(user_input, stream=True, cancel_token=cancel_token):
                     full_response += chunk
                     response_parts.append(chunk)
                     # Показываем прогресс
@@ -211,7 +283,8 @@ def main():
                 
                 console.print()  # Новая строка после прогресса
                 
-                # Форматируем и выводим ответ
+                # Форматируем и выводим ответ (markdown-it импортируется только здесь)
+                from rich.markdown import Markdown
                 console.print(Panel(
                     Markdown(full_response),
                     title="[green]AI Agent[/green]",
@@ -220,7 +293,8 @@ def main():
                 ))
                 
             except KeyboardInterrupt:
-                console.print("\n[yellow]Генерация прервана[/yellow]")
+                cancel_token.cancel("Ctrl+C")
+                console.print(f"\n[yellow]Генерация прервана (сэкономлено ~{cancel_token.tokens_saved} токенов)[/yellow]")
             except Exception as e:
                 console.print(f"[red]Ошибка: {e}[/red]")
         
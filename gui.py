@@ -14,6 +14,7 @@ from pathlib import Path
 import json
 from datetime import datetime
 from agent import CodeAgent
+from utils.cancellation import CancellationToken
 import requests
 import yaml
 
@@ -58,6 +59,10 @@ class CodeAgentGUI:
         # Очередь для обновления UI из других потоков
         self.message_queue = queue.Queue()
         
+        # Текущая генерация (отменяется при закрытии окна)
+        self.cancel_token = None
+        self.generation_thread = None
+        
         # Настройка стилей
         self.setup_styles()
         
@@ -69,6 +74,9 @@ class CodeAgentGUI:
         
         # Обработка очереди сообщений
         self.root.after(100, self.process_queue)
+        
+        # Закрытие окна останавливает генерацию на сервере модели
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
     
     def setup_styles(self):
         """Настройка стилей ttk"""
@@ -740,16 +748,31 @@ LM Studio:
         self.chat_text.config(state=tk.DISABLED)
         
         # Генерируем ответ в отдельном потоке
+        cancel_token = CancellationToken()
+        self.cancel_token = cancel_token
+        
         def generate():
             try:
-                for chunk in self.agent.ask(user_input, stream=True):
+                for chunk in self.agent.ask(user_input, stream=True, cancel_token=cancel_token):
                     self.message_queue.put(('chunk', chunk))
                 self.message_queue.put(('response_done',))
             except Exception as e:
                 self.message_queue.put(('chunk', f"\n\n❌ Ошибка: {str(e)}"))
                 self.message_queue.put(('response_done',))
         
-        threading.Thread(target=generate, daemon=True).start()
+        self.generation_thread = threading.Thread(target=generate, daemon=True)
+        self.generation_thread.start()
+    
+    def on_close(self):
+        """Закрытие окна: отмена генерации и остановка фоновых задач агента"""
+        if self.cancel_token is not None:
+            self.cancel_token.cancel("окно закрыто")
+        if self.generation_thread is not None:
+            # Даём агенту дописать историю хода
+            self.generation_thread.join(timeout=2)
+        if self.agent is not None:
+            self.agent.shutdown()
+        self.root.destroy()
     
     def clear_chat(self):
         """Очистка чата"""
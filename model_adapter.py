@@ -4,12 +4,16 @@
 """
 
 import re
-from typing import Dict, Optional, Tuple, List
-from dataclasses import dataclass
-import requests
-from rich.console import Console
+from typing import Any, Dict, Optional, Tuple, List
+from dataclasses import dataclass, asdict
 
-console = Console()
+from utils.http_pool import HTTPPool, get_default_pool
+from utils.probe_cache import ProbeCache
+from utils.token_counter import TokenCounter
+from utils.context_trim import trim_context
+from utils.lazy import LazyConsole
+
+console = LazyConsole()
 
 
 @dataclass
@@ -105,7 +109,15 @@ class ModelAdapter:
         },
     }
     
-    def __init__(self, provider: str, model_name: str, base_url: str = None):
+    def __init__(
+        self,
+        provider: str,
+        model_name: str,
+        base_url: str = None,
+        http_pool: Optional[HTTPPool] = None,
+        probe_cache: Optional[ProbeCache] = None,
+        token_counter: Optional[TokenCounter] = None
+    ):
         """
         Инициализация адаптера
         
@@ -113,24 +125,33 @@ class ModelAdapter:
             provider: Провайдер ("ollama", "lmstudio", "openai", "anthropic", "custom")
             model_name: Имя модели
             base_url: Базовый URL API
+            http_pool: Пул HTTP-соединений (по умолчанию общий пул процесса)
+            probe_cache: Кэш сетевых проверок (возможности модели, список моделей)
+            token_counter: Подсчёт токенов (по умолчанию оценка по числу символов)
         """
         self.provider = provider
         self.model_name = model_name
         self.base_url = base_url
+        self.http_pool = http_pool or get_default_pool()
+        self.probe_cache = probe_cache
         self.capabilities = self._detect_capabilities()
+        self.token_counter = token_counter or TokenCounter()
+        # Оценка без токенизатора: код обычно компактнее текста
+        self.token_counter.fallback.tokens_per_char = 0.3 if self.capabilities.model_type == "code" else 0.25
         self._tested = False
     
     def _detect_capabilities(self) -> ModelCapabilities:
         """Автоматическое определение возможностей модели"""
         # Сначала пробуем получить информацию от API (самый точный способ)
         api_capabilities = None
-        if self.provider == "ollama" and self.base_url:
-            api_capabilities = self._detect_from_ollama_api()
-        elif self.provider == "lmstudio" and self.base_url:
-            api_capabilities = self._detect_from_lmstudio_api()
-        elif self.provider in ["openai", "openai_compatible", "anthropic", "custom"] and self.base_url:
-            # Для OpenAI-совместимых API пробуем определить через API
-            api_capabilities = self._detect_from_openai_compatible_api()
+        if self.base_url:
+            key = ProbeCache.key('capabilities', self.provider, self.base_url, self.model_name)
+            if self.probe_cache is not None:
+                cached = self.probe_cache.fetch(key, self._probe_capabilities)
+            else:
+                cached = self._probe_capabilities()
+            if cached:
+                api_capabilities = ModelCapabilities(**cached)
         
         # Если получили информацию от API, используем её
         if api_capabilities:
@@ -149,6 +170,18 @@ class ModelAdapter:
         
         return capabilities
     
+    def _probe_capabilities(self) -> Optional[Dict[str, Any]]:
+        """Запрос возможностей модели у API провайдера (словарь для кэша проверок)"""
+        api_capabilities = None
+        if self.provider == "ollama":
+            api_capabilities = self._detect_from_ollama_api()
+        elif self.provider == "lmstudio":
+            api_capabilities = self._detect_from_lmstudio_api()
+        elif self.provider in ["openai", "openai_compatible", "anthropic", "custom"]:
+            # Для OpenAI-совместимых API пробуем определить через API
+            api_capabilities = self._detect_from_openai_compatible_api()
+        return asdict(api_capabilities) if api_capabilities else None
+    
     def _get_from_database(self) -> ModelCapabilities:
         """Получение информации из базы данных"""
         # Пробуем точное совпадение
@@ -243,7 +276,7 @@ class ModelAdapter:
         """Определение возможностей через Ollama API"""
         try:
             url = f"{self.base_url}/api/show"
-            response = requests.post(
+            response = self.http_pool.post(
                 url,
                 json={"name": self.model_name},
                 timeout=10
@@ -270,6 +303,11 @@ class ModelAdapter:
                 # Также проверяем параметры модели напрямую
                 if "parameters" in data:
                     params = data["parameters"]
+                    if isinstance(params, str):
+                        # Ollama отдаёт параметры строками вида "num_ctx 8192"
+                        params = dict(
+                            line.split(None, 1) for line in params.splitlines() if len(line.split(None, 1)) == 2
+                        )
                     if "num_ctx" in params:
                         context_size = int(params["num_ctx"])
                     elif "context_size" in params:
@@ -300,12 +338,20 @@ class ModelAdapter:
     def _detect_from_lmstudio_api(self) -> Optional[ModelCapabilities]:
         """Определение возможностей через LM Studio API (OpenAI-совместимый)"""
         try:
-            # Пробуем получить информацию о модели через OpenAI-совместимый API
+            # Пробуем получить информацию о модели через OpenAI-совместимый API.
+            # Тот же список моделей запрашивает агент - проверка выполняется один раз
             url = f"{self.base_url}/v1/models"
-            response = requests.get(url, timeout=10)
             
-            if response.status_code == 200:
-                data = response.json()
+            def probe():
+                response = self.http_pool.get(url, timeout=10)
+                return response.json() if response.status_code == 200 else None
+            
+            if self.probe_cache is not None:
+                data = self.probe_cache.fetch(ProbeCache.key('models', self.provider, self.base_url), probe)
+            else:
+                data = probe()
+            
+            if data:
                 models = data.get('data', [])
                 
                 # Ищем нашу модель в списке
@@ -370,7 +416,7 @@ class ModelAdapter:
                 if api_key:
                     headers['x-api-key'] = api_key
             
-            response = requests.get(url, headers=headers, timeout=10)
+            response = self.http_pool.get(url, headers=headers, timeout=10)
             
             if response.status_code == 200:
                 data = response.json()
@@ -453,20 +499,9 @@ class ModelAdapter:
             text: Текст для оценки
         
         Returns:
-            Примерное количество токенов
+            Количество токенов (точное, если доступен токенизатор модели)
         """
-        # Простая оценка: примерно 4 символа на токен для английского
-        # Для русского и кода может быть меньше
-        chars = len(text)
-        
-        # Учитываем тип модели
-        if self.capabilities.model_type == "code":
-            # Код обычно более компактный
-            tokens_per_char = 0.3
-        else:
-            tokens_per_char = 0.25
-        
-        return int(chars * tokens_per_char)
+        return self.token_counter.count(text)
     
     def get_max_context_for_project(self) -> int:
         """
@@ -583,6 +618,10 @@ class ModelAdapter:
         """
         Оптимизирует контекст под размер модели
         
+        Разделы описания проекта (структура, README, конфигурация, основной
+        файл) сохраняются по важности целиком, менее важные опускаются;
+        текст без разделов сокращается по границам строк (начало и конец).
+        
         Args:
             context: Контекст для оптимизации
             max_size: Максимальный размер в символах
@@ -593,38 +632,7 @@ class ModelAdapter:
         if max_size is None:
             max_size = self.get_max_context_for_project()
         
-        if len(context) <= max_size:
-            return context
-        
-        # Обрезаем контекст, сохраняя важные части
-        # Сначала пытаемся обрезать по абзацам
-        lines = context.split('\n')
-        
-        # Сохраняем начало (структура проекта)
-        important_start = []
-        important_end = []
-        middle = []
-        
-        in_important = True
-        for line in lines:
-            if len('\n'.join(important_start)) < max_size * 0.4:
-                important_start.append(line)
-            elif len('\n'.join(important_end)) < max_size * 0.3:
-                important_end.insert(0, line)
-            else:
-                middle.append(line)
-        
-        # Если всё ещё слишком длинно, обрезаем
-        result = '\n'.join(important_start)
-        if len(result) < max_size * 0.7:
-            result += '\n... [промежуточный контекст обрезан] ...\n'
-            result += '\n'.join(important_end[-int(max_size * 0.3):])
-        
-        # Финальная обрезка
-        if len(result) > max_size:
-            result = result[:max_size] + "\n... [контекст обрезан]"
-        
-        return result
+        return trim_context(context, max_size)
     
     def get_info(self) -> Dict:
         """Получает информацию о возможностях модели"""
@@ -652,7 +660,14 @@ class ModelAdapter:
         console.print(f"  Поддержка system prompt: {info['supports_system_prompt']}")
 
 
-def create_model_adapter(provider: str, model_name: str, base_url: str = None) -> ModelAdapter:
+def create_model_adapter(
+    provider: str,
+    model_name: str,
+    base_url: str = None,
+    http_pool: Optional[HTTPPool] = None,
+    probe_cache: Optional[ProbeCache] = None,
+    token_counter: Optional[TokenCounter] = None
+) -> ModelAdapter:
     """
     Создаёт адаптер для модели
     
@@ -660,9 +675,15 @@ def create_model_adapter(provider: str, model_name: str, base_url: str = None) -
         provider: Провайдер ("ollama", "lmstudio")
         model_name: Имя модели
         base_url: Базовый URL API
+        http_pool: Пул HTTP-соединений
+        probe_cache: Кэш сетевых проверок
+        token_counter: Подсчёт токенов
     
     Returns:
         ModelAdapter
     """
-    return ModelAdapter(provider, model_name, base_url)
+    return ModelAdapter(
+        provider, model_name, base_url,
+        http_pool=http_pool, probe_cache=probe_cache, token_counter=token_counter
+    )
 
@@ -5,27 +5,41 @@
 
 import os
 import json
+import fnmatch
+from dataclasses import replace
 from pathlib import Path
 from typing import Dict, List, Optional, Set
 import yaml
 import logging
 from functools import lru_cache
 
+from utils.symbol_chunks import Chunk, ChunkIndex, keyword_weights, query_keywords, score_chunk
+
 logger = logging.getLogger(__name__)
 
+# Файлы больше этого размера в поиске по запросу не участвуют
+MAX_FILE_SIZE_FOR_SEARCH = 100 * 1024  # 100KB
+# Текстовые файлы, содержимое которых просматривается при поиске
+SEARCH_SUFFIXES = {'.py', '.js', '.jsx', '.ts', '.tsx', '.md', '.txt', '.yaml', '.yml', '.json', '.toml'}
+# Обрезанный фрагмент короче этого не включается
+MIN_CHUNK_CHARS = 200
+
 
 class ProjectContext:
     """Класс для управления контекстом проекта"""
     
-    def __init__(self, project_root: str = "."):
+    def __init__(self, project_root: str = ".", chunk_cache: Optional[str] = None, chunk_chars: int = 2000):
         """
         Инициализация контекста проекта
         
         Args:
             project_root: Корневая директория проекта
+            chunk_cache: JSON-файл таблиц фрагментов для поиска (None - только в памяти)
+            chunk_chars: Наибольший размер фрагмента файла в символах
         """
         self.project_root = Path(project_root).resolve()
         self.context_cache: Dict[str, any] = {}
+        self.chunk_index = ChunkIndex(chunk_cache, max_chunk_chars=chunk_chars)
         self.ignored_patterns: Set[str] = {
             '__pycache__', '.git', '.venv', 'venv', 'node_modules',
             '.pytest_cache', '.mypy_cache', '.idea', '.vscode',
@@ -328,80 +342,118 @@ class ProjectContext:
         
         return found_files
     
-    def get_relevant_files_for_query(self, query: str, max_files: int = 3, max_file_size: int = 1500, max_depth: int = 5) -> Dict[str, str]:
+    def _search_files(self, max_depth: int, max_files: int = 5000):
+        """Файлы проекта не глубже max_depth каталогов (игнорируемые каталоги не обходятся)"""
+        count = 0
+        for directory, dirnames, filenames in os.walk(self.project_root):
+            relative_dir = Path(directory).relative_to(self.project_root)
+            if len(relative_dir.parts) >= max_depth:
+                dirnames[:] = []
+            dirnames[:] = sorted(name for name in dirnames if not self._is_ignored(name))
+            for name in sorted(filenames):
+                if self._is_ignored(name):
+                    continue
+                yield Path(directory) / name
+                count += 1
+                if count >= max_files:
+                    return
+    
+    def _is_ignored(self, name: str) -> bool:
+        return any(fnmatch.fnmatch(name, pattern) for pattern in self.ignored_patterns)
+    
+    def _read_for_search(self, path: Path) -> Optional[str]:
+        """Текст файла для поиска (None - файл вне проекта или бинарный)"""
+        from utils.file_utils import read_file_safe
+        
+        try:
+            path.resolve().relative_to(self.project_root)
+        except ValueError:
+            logger.warning(f"Попытка доступа к файлу вне project_root: {path}")
+            return None
+        content = read_file_safe(path, max_size=MAX_FILE_SIZE_FOR_SEARCH)
+        if content is None or '\x00' in content:
+            return None
+        return content
+    
+    def get_relevant_files_for_query(self, query: str, max_files: int = 3, max_file_size: int = 1500, max_depth: int = 5, max_chars: Optional[int] = None) -> Dict[str, str]:
         """
-        Находит релевантные файлы для запроса
+        Находит фрагменты файлов, релевантные запросу
+        
+        Файлы делятся на фрагменты (функции и классы Python, определения
+        JS/TS, разделы Markdown, части остальных текстовых файлов), каждый
+        фрагмент оценивается отдельно, и лучшие по всему проекту набираются
+        в пределах лимитов. Таблицы фрагментов кэшируются по времени
+        изменения файла.
         
         Args:
             query: Текст запроса
             max_files: Максимальное количество файлов (по умолчанию 3)
-            max_file_size: Максимальный размер каждого файла в символах (по умолчанию 1500)
+            max_file_size: Максимальный размер фрагментов одного файла в символах (по умолчанию 1500)
             max_depth: Максимальная глубина поиска (по умолчанию 5)
+            max_chars: Общий лимит символов (по умолчанию max_files * max_file_size)
         
         Returns:
-            Словарь {путь: содержимое}
+            Словарь {путь: фрагменты файла в порядке строк}
         """
-        query_lower = query.lower()
-        relevant_files = {}
-        
-        # Ключевые слова для поиска
-        keywords = []
-        for word in query_lower.split():
-            if len(word) > 3:  # Игнорируем короткие слова
-                keywords.append(word)
-        
-        # Константы для ограничений
-        MAX_FILE_SIZE_FOR_SEARCH = 100 * 1024  # 100KB
-        
-        # Ищем файлы с ограничением глубины
-        for depth in range(max_depth + 1):
-            if len(relevant_files) >= max_files:
-                break
-            
-            # Строим паттерн для поиска на определенной глубине
-            if depth == 0:
-                pattern = "*"
-            else:
-                pattern = "*/" * depth + "*"
-            
+        keywords = query_keywords(query)
+        if not keywords or max_files <= 0:
+            return {}
+        if max_chars is None:
+            max_chars = max_files * max_file_size
+        
+        candidates = []
+        for path in self._search_files(max_depth):
+            name_lower = path.name.lower()
+            # Содержимое проверяем только у текстовых файлов, остальные - по имени
+            if path.suffix not in SEARCH_SUFFIXES and not any(kw in name_lower for kw in keywords):
+                continue
             try:
-                for item in self.project_root.glob(pattern):
-                    if item.is_file() and len(relevant_files) < max_files:
-                        # Пропускаем большие файлы и бинарные
-                        try:
-                            if item.stat().st_size > MAX_FILE_SIZE_FOR_SEARCH:
-                                continue
-                        except (OSError, IOError, PermissionError) as e:
-                            logger.debug(f"Ошибка проверки размера файла {item}: {e}")
-                            continue
-                        
-                        # Проверяем имя файла
-                        name_lower = item.name.lower()
-                        if any(kw in name_lower for kw in keywords):
-                            content = self.get_file_content(str(item.relative_to(self.project_root)), max_size=50000)
-                            if content:
-                                # Ограничиваем размер содержимого
-                                if len(content) > max_file_size:
-                                    content = content[:max_file_size] + "\n... [файл обрезан]"
-                                relevant_files[str(item.relative_to(self.project_root))] = content
-                                continue
-                        
-                        # Проверяем содержимое (только для текстовых файлов)
-                        if item.suffix in ['.py', '.js', '.ts', '.md', '.txt', '.yaml', '.yml']:
-                            try:
-                                content = self.get_file_content(str(item.relative_to(self.project_root)), max_size=50000)
-                                if content and any(kw in content.lower() for kw in keywords):
-                                    # Ограничиваем размер содержимого
-                                    if len(content) > max_file_size:
-                                        content = content[:max_file_size] + "\n... [файл обрезан]"
-                                    relevant_files[str(item.relative_to(self.project_root))] = content
-                            except (OSError, IOError, UnicodeDecodeError) as e:
-                                logger.debug(f"Ошибка чтения содержимого {item}: {e}")
-                                continue
+                if path.stat().st_size > MAX_FILE_SIZE_FOR_SEARCH:
+                    continue
             except (OSError, IOError, PermissionError) as e:
-                logger.debug(f"Ошибка поиска на глубине {depth}: {e}")
+                logger.debug(f"Ошибка проверки размера файла {path}: {e}")
+                continue
+            try:
+                chunks = self.chunk_index.chunks(path, lambda path=path: self._read_for_search(path))
+            except (OSError, IOError, UnicodeDecodeError) as e:
+                logger.debug(f"Ошибка чтения содержимого {path}: {e}")
+                continue
+            relative = str(path.relative_to(self.project_root))
+            candidates.extend((relative, path.name, chunk) for chunk in chunks)
+        self.chunk_index.save()
+        
+        weights = keyword_weights(keywords, [chunk for _, _, chunk in candidates])
+        scored = []
+        for relative, file_name, chunk in candidates:
+            score = score_chunk(chunk, weights, file_name)
+            if score > 0:
+                scored.append((score, relative, chunk))
+        
+        # Лучшие фрагменты по всему проекту, пока есть место
+        scored.sort(key=lambda item: (-item[0], item[1], item[2].start))
+        selected: Dict[str, List[Chunk]] = {}
+        file_chars: Dict[str, int] = {}
+        total = 0
+        for score, relative, chunk in scored:
+            if relative not in selected and len(selected) >= max_files:
                 continue
+            free = min(max_file_size - file_chars.get(relative, 0), max_chars - total)
+            size = len(chunk.text) + len(chunk.label) + 10
+            if size > free:
+                # Первый фрагмент файла больше лимита - берём его начало
+                if relative in selected or free < MIN_CHUNK_CHARS:
+                    continue
+                text = chunk.text[:free - len(chunk.label) - 40] + "\n... [фрагмент обрезан]"
+                chunk = replace(chunk, text=text)
+                size = len(text) + len(chunk.label) + 10
+            selected.setdefault(relative, []).append(chunk)
+            file_chars[relative] = file_chars.get(relative, 0) + size
+            total += size
         
+        relevant_files = {}
+        for relative, chunks in selected.items():
+            chunks.sort(key=lambda chunk: chunk.start)
+            relevant_files[relative] = "\n".join(f"... [{chunk.label}]\n{chunk.text}" for chunk in chunks)
         return relevant_files
     
     @staticmethod
@@ -414,15 +466,17 @@ class ProjectContext:
         return f"{size:.1f} TB"
 
 
-def load_project_context(project_root: str = ".") -> ProjectContext:
+def load_project_context(project_root: str = ".", chunk_cache: Optional[str] = None, chunk_chars: int = 2000) -> ProjectContext:
     """
     Загружает контекст проекта
     
     Args:
         project_root: Корневая директория проекта
+        chunk_cache: JSON-файл таблиц фрагментов для поиска (None - только в памяти)
+        chunk_chars: Наибольший размер фрагмента файла в символах
     
     Returns:
         Объект ProjectContext
     """
-    return ProjectContext(project_root)
+    return ProjectContext(project_root, chunk_cache=chunk_cache, chunk_chars=chunk_chars)
 
@@ -0,0 +1,155 @@
+"""
+Асинхронный HTTP-клиент провайдеров моделей (aiohttp)
+"""
+
+import asyncio
+import logging
+import importlib.util
+from contextlib import asynccontextmanager
+from typing import Dict, Any, Optional, AsyncIterator, Tuple
+
+# aiohttp импортируется при первом асинхронном запросе: сам импорт
+# заметно удлиняет запуск CLI, где асинхронный режим не нужен
+AIOHTTP_AVAILABLE = importlib.util.find_spec('aiohttp') is not None
+
+logger = logging.getLogger(__name__)
+
+
+def async_request_errors() -> Tuple[type, ...]:
+    """Сетевые ошибки, которые обрабатываются как ошибки подключения"""
+    if not AIOHTTP_AVAILABLE:
+        return (asyncio.TimeoutError,)
+    import aiohttp
+    return (aiohttp.ClientError, asyncio.TimeoutError)
+
+
+class AsyncHTTPClient:
+    """
+    Асинхронный клиент с общим keep-alive пулом соединений
+
+    Использует одну aiohttp.ClientSession на event loop; лимит соединений
+    на хост берётся из секции http конфигурации (как и у синхронного HTTPPool).
+    """
+
+    def __init__(self, limit_per_host: int = 16, keep_alive: bool = True):
+        """
+        Args:
+            limit_per_host: Максимум одновременных соединений к одному хосту
+            keep_alive: Держать ли соединения открытыми между запросами
+        """
+        if not AIOHTTP_AVAILABLE:
+            raise ImportError("Для асинхронного режима требуется aiohttp: pip install aiohttp")
+        self.limit_per_host = limit_per_host
+        self.keep_alive = keep_alive
+        self._session: Optional['aiohttp.ClientSession'] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self.stats = {'requests': 0, 'new_connections': 0, 'reused_connections': 0}
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> 'AsyncHTTPClient':
+        """Создать клиент из секции http конфигурации"""
+        http_config = config.get('http', {}) or {}
+        return cls(
+            limit_per_host=http_config.get('pool_maxsize', 16),
+            keep_alive=http_config.get('keep_alive', True),
+        )
+
+    def _trace_config(self) -> 'aiohttp.TraceConfig':
+        """Трассировка для подсчёта новых и переиспользованных соединений"""
+        import aiohttp
+
+        trace = aiohttp.TraceConfig()
+
+        async def on_request_start(session, ctx, params):
+            self.stats['requests'] += 1
+
+        async def on_connection_create_end(session, ctx, params):
+            self.stats['new_connections'] += 1
+
+        async def on_connection_reuseconn(session, ctx, params):
+            self.stats['reused_connections'] += 1
+
+        trace.on_request_start.append(on_request_start)
+        trace.on_connection_create_end.append(on_connection_create_end)
+        trace.on_connection_reuseconn.append(on_connection_reuseconn)
+        return trace
+
+    async def _get_session(self) -> 'aiohttp.ClientSession':
+        """Сессия для текущего event loop (создаётся лениво)"""
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            import aiohttp
+
+            connector = aiohttp.TCPConnector(
+                limit=0,
+                limit_per_host=self.limit_per_host,
+                force_close=not self.keep_alive,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                trace_configs=[self._trace_config()],
+            )
+            self._loop = loop
+        return self._session
+
+    @asynccontextmanager
+    async def request(
+        self,
+        method: str,
+        url: str,
+        timeout: Optional[float] = None,
+        **kwargs
+    ) -> AsyncIterator['aiohttp.ClientResponse']:
+        """
+        Выполнить запрос; ответ доступен внутри async with
+
+        Args:
+            method: HTTP-метод
+            url: Полный URL
+            timeout: Таймаут подключения и чтения очередной порции (как в requests)
+        """
+        response = await self.send(method, url, timeout=timeout, **kwargs)
+        async with response:
+            yield response
+
+    async def send(self, method: str, url: str, timeout: Optional[float] = None, **kwargs) -> 'aiohttp.ClientResponse':
+        """
+        Выполнить запрос и вернуть ответ; вызывающий закрывает его (async with response)
+
+        Используется там, где ответ нужно проверить до входа в async with
+        (повторы по RetryPolicy).
+        """
+        import aiohttp
+
+        session = await self._get_session()
+        client_timeout = aiohttp.ClientTimeout(total=None, sock_connect=timeout, sock_read=timeout)
+        return await session.request(method, url, timeout=client_timeout, **kwargs)
+
+    async def get_json(self, url: str, timeout: Optional[float] = None, **kwargs) -> Any:
+        """GET-запрос с разбором JSON (None при ошибочном статусе)"""
+        async with self.request('GET', url, timeout=timeout, **kwargs) as response:
+            if response.status != 200:
+                return None
+            return await response.json(content_type=None)
+
+    @staticmethod
+    async def release(response: 'aiohttp.ClientResponse'):
+        """
+        Дочитать хвост логически завершённого потока (done / [DONE]),
+        чтобы соединение вернулось в пул, а не было закрыто
+        """
+        try:
+            await response.content.read()
+        except async_request_errors() as e:
+            logger.debug(f"Не удалось дочитать ответ: {e}")
+
+    def get_stats(self) -> Dict[str, int]:
+        """Статистика запросов и соединений"""
+        return dict(self.stats)
+
+    async def close(self):
+        """Закрыть сессию и все соединения"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        self._loop = None
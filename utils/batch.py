@@ -0,0 +1,121 @@
+"""
+Пакетная обработка промптов из JSONL-файла
+"""
+
+import json
+import logging
+import threading
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Set
+
+logger = logging.getLogger(__name__)
+
+
+def _request_prompt(data: Dict[str, Any]) -> str:
+    """Текст запроса: поле prompt, либо title и body (формат requests.jsonl)"""
+    if data.get('prompt'):
+        return str(data['prompt'])
+    parts = [str(data[key]) for key in ('title', 'body') if data.get(key)]
+    return "\n\n".join(parts)
+
+
+def read_requests(path: str) -> Iterator[Dict[str, Any]]:
+    """
+    Чтение запросов из JSONL
+
+    Каждая строка - объект с полем prompt (или title/body) и необязательным
+    id (или request_id); без id используется номер строки.
+
+    Yields:
+        {'id': ..., 'prompt': ...}
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                data = json.loads(line)
+            except json.JSONDecodeError as e:
+                logger.warning(f"{path}:{line_no}: некорректный JSON пропущен ({e})")
+                continue
+            if isinstance(data, str):
+                data = {'prompt': data}
+            prompt = _request_prompt(data)
+            if not prompt:
+                logger.warning(f"{path}:{line_no}: пустой запрос пропущен")
+                continue
+            request_id = data.get('id', data.get('request_id', line_no))
+            yield {'id': str(request_id), 'prompt': prompt}
+
+
+def finished_ids(path: str) -> Set[str]:
+    """Id успешно обработанных запросов из файла результатов (для продолжения после сбоя)"""
+    done: Set[str] = set()
+    results_path = Path(path)
+    if not results_path.exists():
+        return done
+    with open(results_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                # Строка, недописанная при сбое - запрос будет выполнен заново
+                continue
+            if isinstance(result, dict) and result.get('ok'):
+                done.add(str(result.get('id')))
+    return done
+
+
+class ResultWriter:
+    """
+    Дозапись результатов в JSONL по мере готовности
+
+    Каждая строка сбрасывается на диск сразу, поэтому после сбоя в файле
+    остаются все завершённые запросы.
+    """
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        # Недописанная при сбое строка не должна склеиться со следующей
+        needs_newline = False
+        if self.path.exists() and self.path.stat().st_size > 0:
+            with open(self.path, 'rb') as f:
+                f.seek(-1, 2)
+                needs_newline = f.read(1) != b'\n'
+        self._file = open(self.path, 'a', encoding='utf-8')
+        if needs_newline:
+            self._file.write('\n')
+
+    def write(self, result: Dict[str, Any]):
+        with self._lock:
+            self._file.write(json.dumps(result, ensure_ascii=False) + '\n')
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def __enter__(self) -> 'ResultWriter':
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def summarize(results: List[Dict[str, Any]], elapsed: float, skipped: int = 0) -> Dict[str, Any]:
+    """Итоговая пропускная способность пакета"""
+    completion_tokens = sum(r.get('completion_tokens', 0) for r in results)
+    ok = sum(1 for r in results if r.get('ok'))
+    return {
+        'total': len(results),
+        'ok': ok,
+        'failed': len(results) - ok,
+        'skipped': skipped,
+        'elapsed': round(elapsed, 2),
+        'requests_per_s': round(len(results) / elapsed, 3) if elapsed > 0 else 0.0,
+        'completion_tokens': completion_tokens,
+        'tokens_per_s': round(completion_tokens / elapsed, 1) if elapsed > 0 else 0.0,
+    }
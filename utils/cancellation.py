@@ -0,0 +1,59 @@
+"""
+Отмена генерации: клиент ушёл - запрос к модели прерывается
+"""
+
+import time
+import logging
+import threading
+from typing import Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class CancellationToken:
+    """
+    Токен отмены одного хода диалога
+
+    Передаётся в ask()/aask(); cancel() можно вызывать из любого потока
+    (обработчик WebSocket, Ctrl+C, закрытие окна). Зарегистрированные
+    обработчики закрывают HTTP-ответы провайдера, чтобы сервер прекратил
+    генерацию, а цикл инструментов не запускает следующую итерацию.
+    """
+
+    def __init__(self):
+        self.reason: Optional[str] = None
+        self.cancelled_at: Optional[float] = None
+        # Оценка несгенерированных токенов (заполняет агент при завершении хода)
+        self.tokens_saved = 0
+        self._callbacks: List[Callable[[], None]] = []
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self, reason: str = "отменено"):
+        """Отменить генерацию (повторные вызовы игнорируются)"""
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self.cancelled_at = time.monotonic()
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+
+        logger.info(f"Генерация отменена: {reason}")
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.debug(f"Ошибка обработчика отмены: {e}")
+
+    def register(self, callback: Callable[[], None]):
+        """Вызвать callback при отмене (сразу, если токен уже отменён)"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
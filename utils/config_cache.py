@@ -0,0 +1,71 @@
+"""
+Кэш проверенной конфигурации
+"""
+
+import os
+import json
+import hashlib
+import logging
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Схема конфигурации: при её изменении сохранённые результаты устаревают
+_VALIDATOR_PATH = Path(__file__).with_name('config_validator.py')
+
+
+class ConfigCache:
+    """
+    Результат validate_config() для неизменённого config.yaml
+
+    Проверка импортирует pydantic и строит модели конфигурации - это
+    самая долгая часть запуска CLI. Результат сохраняется в JSON под
+    отпечатком содержимого файла и схемы; пока ни то, ни другое не
+    менялось, повторная проверка не нужна. Сохраняются только
+    конфигурации, прошедшие проверку.
+    """
+
+    def __init__(self, path: Optional[str] = "./cache/config.json"):
+        """
+        Args:
+            path: Путь к JSON-файлу (None - кэш выключен)
+        """
+        self.path = Path(path) if path else None
+
+    @staticmethod
+    def fingerprint(content: str) -> str:
+        """Отпечаток текста конфигурации и версии схемы"""
+        digest = hashlib.sha256(content.encode('utf-8'))
+        try:
+            stat = _VALIDATOR_PATH.stat()
+            digest.update(f"{stat.st_mtime_ns}:{stat.st_size}".encode())
+        except OSError:
+            pass
+        return digest.hexdigest()
+
+    def get(self, content: str) -> Optional[Dict[str, Any]]:
+        """Проверенная конфигурация для этого текста или None"""
+        if self.path is None or not self.path.exists():
+            return None
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.debug(f"Кэш конфигурации не прочитан: {e}")
+            return None
+        if data.get('fingerprint') != self.fingerprint(content):
+            return None
+        return data.get('config')
+
+    def put(self, content: str, config: Dict[str, Any]):
+        if self.path is None:
+            return
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_suffix(self.path.suffix + '.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'fingerprint': self.fingerprint(content), 'config': config}, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except (OSError, TypeError, ValueError) as e:
+            logger.debug(f"Кэш конфигурации не сохранён: {e}")
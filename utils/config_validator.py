@@ -2,7 +2,7 @@
 Валидация конфигурации с использованием Pydantic
 """
 
-from typing import Optional, Dict, Any, List, Tuple
+from typing import Optional, Dict, Any, List, Tuple, Union
 from pydantic import BaseModel, validator, Field
 import logging
 
@@ -16,6 +16,7 @@ class GenerationConfig(BaseModel):
     top_p: float = Field(default=0.95, ge=0.0, le=1.0)
     top_k: int = Field(default=40, ge=1, le=100)
     repetition_penalty: float = Field(default=1.1, ge=1.0, le=2.0)
+    stop: List[str] = Field(default_factory=list)
 
 
 class ModelConfig(BaseModel):
@@ -25,6 +26,7 @@ class ModelConfig(BaseModel):
     device: str = Field(default="cuda", description="Устройство")
     generation: GenerationConfig = Field(default_factory=GenerationConfig)
     model_path: Optional[str] = None
+    lazy_load: bool = Field(default=False, description="Загружать локальную модель при первом запросе")
     
     @validator('provider')
     def validate_provider(cls, v):
@@ -54,12 +56,14 @@ class AgentConfig(BaseModel):
 class OllamaConfig(BaseModel):
     """Конфигурация Ollama"""
     base_url: str = Field(default="http://localhost:11434")
+    endpoints: List[str] = Field(default_factory=list)
     timeout: int = Field(default=300, ge=1, le=3600)
 
 
 class LMStudioConfig(BaseModel):
     """Конфигурация LM Studio"""
     base_url: str = Field(default="http://localhost:1234")
+    endpoints: List[str] = Field(default_factory=list)
     timeout: int = Field(default=300, ge=1, le=3600)
 
 
@@ -78,6 +82,153 @@ class GPUConfig(BaseModel):
     use_flash_attention: bool = Field(default=True)
 
 
+class HTTPConfig(BaseModel):
+    """Конфигурация пула HTTP-соединений"""
+    pool_connections: int = Field(default=4, ge=1, le=256)
+    pool_maxsize: int = Field(default=16, ge=1, le=1024)
+    keep_alive: bool = Field(default=True)
+    pool_block: bool = Field(default=False)
+
+
+class SessionsConfig(BaseModel):
+    """Конфигурация сессий веб-интерфейса"""
+    max_sessions: int = Field(default=500, ge=1, le=100000)
+    idle_timeout: int = Field(default=3600, ge=10)
+    max_memory_mb: int = Field(default=256, ge=1)
+
+
+class CacheConfig(BaseModel):
+    """Конфигурация кэша ответов"""
+    enabled: bool = Field(default=True)
+    path: str = Field(default="./cache/responses.sqlite")
+    memory_entries: int = Field(default=256, ge=0)
+    max_disk_mb: float = Field(default=100, ge=0)
+    ttl: int = Field(default=86400, ge=1)
+    max_temperature: float = Field(default=0.0, ge=0.0, le=2.0)
+
+
+class CompactionConfig(BaseModel):
+    """Конфигурация фонового сжатия истории"""
+    enabled: bool = Field(default=True)
+    trigger_ratio: float = Field(default=0.5, gt=0.0, le=1.0)
+    keep_turns: int = Field(default=4, ge=1)
+    summary_tokens: int = Field(default=512, ge=32, le=8192)
+    idle_delay: float = Field(default=1.0, ge=0)
+    max_defer: float = Field(default=30, ge=0)
+
+
+class ContextConfig(BaseModel):
+    """Конфигурация упаковки промпта в окно контекста"""
+    layout: str = Field(default="stable")
+    chunk_cache: Optional[str] = Field(default="./cache/chunks.json")
+    chunk_chars: int = Field(default=2000, ge=200)
+    project_share: float = Field(default=0.25, ge=0.0, le=1.0)
+    history_slack: float = Field(default=0.25, ge=0.0, le=1.0)
+    max_files: int = Field(default=3, ge=0, le=20)
+    max_file_chars: int = Field(default=4000, ge=100)
+    max_response_share: float = Field(default=0.5, gt=0.0, lt=1.0)
+    recent_turns: int = Field(default=3, ge=0)
+    response_reserve: Optional[int] = Field(default=None, ge=0)
+    safety_margin: float = Field(default=0.05, ge=0.0, lt=0.5)
+    
+    @validator('layout')
+    def validate_layout(cls, v):
+        allowed = ['stable', 'packed']
+        if v not in allowed:
+            raise ValueError(f'Неподдерживаемая раскладка промпта: {v}. Допустимые: {allowed}')
+        return v
+
+
+class BalancerConfig(BaseModel):
+    """Конфигурация балансировки между серверами провайдера"""
+    strategy: str = Field(default="least_outstanding")
+    ewma_alpha: float = Field(default=0.3, gt=0.0, le=1.0)
+    health_check_interval: float = Field(default=10, ge=1)
+    
+    @validator('strategy')
+    def validate_strategy(cls, v):
+        allowed = ['least_outstanding', 'latency']
+        if v not in allowed:
+            raise ValueError(f'Неподдерживаемая стратегия балансировки: {v}. Допустимые: {allowed}')
+        return v
+
+
+class ContinuousBatchingConfig(BaseModel):
+    """Конфигурация непрерывного батчинга локальной модели"""
+    enabled: bool = Field(default=True)
+    max_batch_size: int = Field(default=8, ge=1, le=256)
+
+
+class PrefixCacheConfig(BaseModel):
+    """Конфигурация кэша KV префиксов локальной модели"""
+    enabled: bool = Field(default=True)
+    max_memory_mb: float = Field(default=1024, gt=0)
+    block_size: int = Field(default=32, ge=1, le=4096)
+
+
+class ProbeCacheConfig(BaseModel):
+    """Конфигурация кэша стартовых проверок провайдера"""
+    enabled: bool = Field(default=True)
+    path: str = Field(default="./cache/probes.json")
+    ttl: int = Field(default=600, ge=1)
+
+
+class TokenCalibrationConfig(BaseModel):
+    """Конфигурация калибровки оценки токенов по данным провайдера"""
+    enabled: bool = Field(default=True)
+    path: str = Field(default="./cache/token_calibration.json")
+    decay: float = Field(default=0.98, gt=0.0, le=1.0)
+
+
+class TokenizerConfig(BaseModel):
+    """Конфигурация подсчёта токенов"""
+    enabled: bool = Field(default=True)
+    path: Optional[str] = Field(default=None)
+    memo_entries: int = Field(default=2048, ge=0)
+
+
+class HedgingConfig(BaseModel):
+    """Конфигурация хеджирования запросов (дублирование на второй сервер)"""
+    enabled: bool = Field(default=False)
+    delay: Union[float, str] = Field(default="auto")
+    percentile: float = Field(default=0.95, gt=0.0, le=1.0)
+    min_delay: float = Field(default=0.5, ge=0)
+    max_delay: float = Field(default=10, ge=0)
+    
+    @validator('delay')
+    def validate_delay(cls, v):
+        if isinstance(v, str) and v != 'auto':
+            raise ValueError(f'delay должен быть числом секунд или "auto", получено: {v}')
+        if not isinstance(v, str) and v < 0:
+            raise ValueError('delay не может быть отрицательным')
+        return v
+
+
+class RetryConfig(BaseModel):
+    """Конфигурация повторов запросов и circuit breaker"""
+    max_attempts: int = Field(default=4, ge=1, le=20)
+    base_delay: float = Field(default=0.5, ge=0)
+    max_delay: float = Field(default=10, ge=0)
+    deadline: float = Field(default=300, ge=1)
+    retry_statuses: List[int] = Field(default_factory=lambda: [408, 425, 429, 500, 502, 503, 504])
+    breaker_threshold: int = Field(default=5, ge=1)
+    breaker_reset_timeout: float = Field(default=30, ge=1)
+
+
+class BatchConfig(BaseModel):
+    """Конфигурация пакетной обработки"""
+    concurrency: int = Field(default=4, ge=1, le=256)
+
+
+class WarmupConfig(BaseModel):
+    """Конфигурация фоновой загрузки модели"""
+    enabled: bool = Field(default=True)
+    keep_alive: str = Field(default="30m")
+    ping_interval: float = Field(default=240, ge=1)
+    check_interval: float = Field(default=30, ge=1)
+    wait_timeout: float = Field(default=120, ge=0)
+
+
 class UIConfig(BaseModel):
     """Конфигурация UI"""
     cli_theme: str = Field(default="dark")
@@ -94,6 +245,21 @@ class AppConfig(BaseModel):
     lmstudio: LMStudioConfig = Field(default_factory=LMStudioConfig)
     mcp: MCPConfig = Field(default_factory=MCPConfig)
     gpu: GPUConfig = Field(default_factory=GPUConfig)
+    http: HTTPConfig = Field(default_factory=HTTPConfig)
+    sessions: SessionsConfig = Field(default_factory=SessionsConfig)
+    cache: CacheConfig = Field(default_factory=CacheConfig)
+    compaction: CompactionConfig = Field(default_factory=CompactionConfig)
+    context: ContextConfig = Field(default_factory=ContextConfig)
+    retry: RetryConfig = Field(default_factory=RetryConfig)
+    balancer: BalancerConfig = Field(default_factory=BalancerConfig)
+    hedging: HedgingConfig = Field(default_factory=HedgingConfig)
+    continuous_batching: ContinuousBatchingConfig = Field(default_factory=ContinuousBatchingConfig)
+    prefix_cache: PrefixCacheConfig = Field(default_factory=PrefixCacheConfig)
+    probe_cache: ProbeCacheConfig = Field(default_factory=ProbeCacheConfig)
+    token_calibration: TokenCalibrationConfig = Field(default_factory=TokenCalibrationConfig)
+    tokenizer: TokenizerConfig = Field(default_factory=TokenizerConfig)
+    warmup: WarmupConfig = Field(default_factory=WarmupConfig)
+    batch: BatchConfig = Field(default_factory=BatchConfig)
     ui: UIConfig = Field(default_factory=UIConfig)
     
     @classmethod
@@ -0,0 +1,230 @@
+"""
+Упаковка промпта в окно контекста модели по приоритетам фрагментов
+"""
+
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Segment:
+    """
+    Фрагмент промпта
+
+    Attributes:
+        name: Имя для журнала решений (system, tools, project, file:..., history:N, user)
+        text: Текст фрагмента
+        priority: Порядок заполнения окна (меньше - важнее)
+        required: Обязательный фрагмент (системный промпт, запрос пользователя)
+        tokens: Токены фрагмента, если уже посчитаны (например, по TokenLedger)
+        messages: Сколько сообщений чата добавляет фрагмент (служебные токены)
+        cut: Укороченный текст по числу символов; None - фрагмент не обрезается
+        min_tokens: Обрезанный фрагмент короче этого не включается
+        requires: Фрагмент включается, только если включён фрагмент с этим именем
+        payload: Данные для сборки сообщений (например, сообщения хода истории)
+    """
+    name: str
+    text: str
+    priority: int
+    required: bool = False
+    tokens: Optional[int] = None
+    messages: int = 0
+    cut: Optional[Callable[[int], str]] = None
+    min_tokens: int = 64
+    requires: Optional[str] = None
+    payload: Any = None
+
+
+@dataclass
+class PackResult:
+    """Решение упаковки одного запроса"""
+    window: int
+    reserve: int
+    budget: int
+    used: int = 0
+    included: List[Segment] = field(default_factory=list)
+    truncated: Dict[str, int] = field(default_factory=dict)
+    dropped: List[str] = field(default_factory=list)
+
+    def get(self, name: str) -> Optional[Segment]:
+        for segment in self.included:
+            if segment.name == name:
+                return segment
+        return None
+
+    def summary(self) -> str:
+        """Строка журнала: фрагменты одного вида (history:N, file:...) сведены вместе, * - обрезан"""
+        groups: Dict[str, List[Segment]] = {}
+        for segment in self.included:
+            groups.setdefault(segment.name.split(':')[0], []).append(segment)
+        included = []
+        for kind, group in groups.items():
+            label = kind if len(group) == 1 else f"{kind}×{len(group)}"
+            mark = "*" if any(segment.name in self.truncated for segment in group) else ""
+            included.append(f"{label}={sum(segment.tokens for segment in group)}{mark}")
+        parts = [f"окно {self.window}, ответ {self.reserve}, занято {self.used}/{self.budget}"]
+        parts.append("включено: " + ", ".join(included))
+        if self.dropped:
+            dropped: Dict[str, int] = {}
+            for name in self.dropped:
+                kind = name.split(':')[0]
+                dropped[kind] = dropped.get(kind, 0) + 1
+            parts.append("отброшено: " + ", ".join(
+                kind if number == 1 else f"{kind}×{number}" for kind, number in dropped.items()
+            ))
+        return "; ".join(parts)
+
+
+class ContextPacker:
+    """
+    Заполнение окна контекста фрагментами по приоритету
+
+    Из окна вычитается место под ответ (лимит генерации, но не больше
+    max_response_share окна) и запас на погрешность подсчёта. Сначала
+    ставятся обязательные фрагменты, затем остальные в порядке приоритета:
+    фрагмент, который не помещается целиком, обрезается до оставшегося
+    места (если это разрешено) или отбрасывается. Цепочка requires держит
+    историю непрерывной: если не поместился ход, более старые тоже не
+    включаются.
+    """
+
+    def __init__(self, safety_margin: float = 0.05, max_response_share: float = 0.5, response_reserve: Optional[int] = None):
+        """
+        Args:
+            safety_margin: Доля окна, оставляемая на погрешность подсчёта токенов
+            max_response_share: Наибольшая доля окна под ответ
+            response_reserve: Место под ответ в токенах (None - лимит генерации запроса)
+        """
+        self.safety_margin = safety_margin
+        self.max_response_share = max_response_share
+        self.response_reserve = response_reserve
+        self.stats = {'requests': 0, 'truncated': 0, 'dropped': 0, 'overflows': 0}
+        self.last: Optional[PackResult] = None
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> 'ContextPacker':
+        """Создать из секции context конфигурации"""
+        context_config = config.get('context', {}) or {}
+        return cls(
+            safety_margin=context_config.get('safety_margin', 0.05),
+            max_response_share=context_config.get('max_response_share', 0.5),
+            response_reserve=context_config.get('response_reserve'),
+        )
+
+    def budget(self, window: int, generation_budget: int) -> PackResult:
+        """Место под промпт: окно минус ответ и запас"""
+        reserve = self.response_reserve if self.response_reserve is not None else generation_budget
+        reserve = min(reserve, int(window * self.max_response_share))
+        budget = window - reserve - int(window * self.safety_margin)
+        return PackResult(window=window, reserve=reserve, budget=max(budget, 0))
+
+    @staticmethod
+    def _fit(segment: Segment, max_tokens: int, count: Callable[[str], int], overhead: int) -> Optional[str]:
+        """Обрезать текст фрагмента до max_tokens (None - не помещается)"""
+        text_tokens = max(segment.tokens - overhead, 1)
+        limit = max_tokens - overhead
+        if segment.cut is None or limit < segment.min_tokens:
+            return None
+        chars = int(len(segment.text) * limit / text_tokens)
+        # Токенов на символ в начале текста может быть больше, чем в среднем
+        for _ in range(8):
+            if chars <= 0:
+                return None
+            text = segment.cut(chars)
+            tokens = count(text)
+            if tokens <= limit:
+                return text if tokens >= segment.min_tokens else None
+            chars = int(chars * min(0.9, limit / tokens))
+        return None
+
+    def fit(self, segment: Segment, max_tokens: int, count: Callable[[str], int]) -> Optional[str]:
+        """Текст фрагмента не длиннее max_tokens (обрезанный при необходимости; None - не помещается)"""
+        if segment.tokens is None:
+            segment.tokens = count(segment.text)
+        if segment.tokens <= max_tokens:
+            return segment.text
+        return self._fit(segment, max_tokens, count, 0)
+
+    def pack(
+        self,
+        segments: List[Segment],
+        window: int,
+        generation_budget: int,
+        count: Callable[[str], int],
+        message_overhead: int = 0
+    ) -> PackResult:
+        """
+        Выбрать фрагменты, помещающиеся в окно
+
+        Args:
+            segments: Фрагменты промпта
+            window: Окно контекста модели в токенах
+            generation_budget: Лимит генерации запроса
+            count: Подсчёт токенов текста
+            message_overhead: Служебные токены одного сообщения чата
+
+        Returns:
+            Включённые фрагменты (в исходном порядке) и журнал решения
+        """
+        result = self.budget(window, generation_budget)
+        for segment in segments:
+            if segment.tokens is None:
+                segment.tokens = count(segment.text)
+            segment.tokens += message_overhead * segment.messages
+
+        free = result.budget
+        included = set()
+        ordered = sorted(segments, key=lambda s: (not s.required, s.priority))
+        for segment in ordered:
+            if segment.requires is not None and segment.requires not in included:
+                result.dropped.append(segment.name)
+                continue
+            if segment.tokens <= free or (segment.required and segment.cut is None):
+                included.add(segment.name)
+                free -= segment.tokens
+                continue
+            text = self._fit(segment, free, count, message_overhead * segment.messages)
+            if text is not None:
+                result.truncated[segment.name] = segment.tokens
+                segment.text = text
+                segment.tokens = count(text) + message_overhead * segment.messages
+                included.add(segment.name)
+                free -= segment.tokens
+            elif segment.required:
+                # Обязательный фрагмент остаётся, даже если окно переполнено
+                included.add(segment.name)
+                free -= segment.tokens
+            else:
+                result.dropped.append(segment.name)
+
+        result.included = [segment for segment in segments if segment.name in included]
+        result.used = result.budget - free
+
+        self.stats['requests'] += 1
+        self.stats['truncated'] += len(result.truncated)
+        self.stats['dropped'] += len(result.dropped)
+        if free < 0:
+            self.stats['overflows'] += 1
+            logger.warning(f"Промпт не помещается в окно: {result.summary()}")
+        else:
+            logger.info(f"Упаковка контекста: {result.summary()}")
+        self.last = result
+        return result
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Счётчики и последнее решение для /api/health"""
+        last = None
+        if self.last is not None:
+            last = {
+                'window': self.last.window,
+                'reserve': self.last.reserve,
+                'budget': self.last.budget,
+                'used': self.last.used,
+                'included': [segment.name for segment in self.last.included],
+                'truncated': list(self.last.truncated),
+                'dropped': self.last.dropped,
+            }
+        return {**self.stats, 'last': last}
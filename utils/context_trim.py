@@ -0,0 +1,153 @@
+"""
+Сокращение контекста до заданного числа символов за линейное время
+"""
+
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+from typing import List, Optional, Sequence, Tuple
+
+# Заголовки разделов ProjectContext.get_project_summary в порядке важности
+PROJECT_SUMMARY_SECTIONS: Tuple[Tuple[str, str], ...] = (
+    ('Структура проекта:', 'структура'),
+    ('README (', 'README'),
+    ('Конфигурационные файлы:', 'конфигурация'),
+    ('Основной файл:', 'основной файл'),
+)
+
+TRUNCATED_MARK = "... [раздел обрезан]"
+MIDDLE_MARK = "... [промежуточный контекст обрезан] ..."
+
+
+class _Lines:
+    """Строки текста и префиксные суммы их длин (с переводом строки)"""
+
+    def __init__(self, text: str):
+        self.lines = text.split('\n')
+        # ends[i] - длина текста из строк [0, i] вместе с переводами строк между ними
+        self.ends = list(accumulate(len(line) + 1 for line in self.lines))
+
+    def length(self, start: int, end: int) -> int:
+        """Длина '\\n'.join(lines[start:end])"""
+        if end <= start:
+            return 0
+        before = self.ends[start - 1] if start else 0
+        return self.ends[end - 1] - before - 1
+
+    def fit_forward(self, start: int, end: int, limit: int) -> int:
+        """Наибольшее k: строки [start, k) занимают не больше limit символов"""
+        before = self.ends[start - 1] if start else 0
+        return bisect_right(self.ends, before + limit + 1, start, end)
+
+    def fit_backward(self, start: int, end: int, limit: int) -> int:
+        """Наименьшее k: строки [k, end) занимают не больше limit символов"""
+        if self.length(start, end) <= limit:
+            return start
+        # Нужна граница ends[k-1] >= ends[end-1] - limit - 1
+        j = bisect_left(self.ends, self.ends[end - 1] - limit - 1, max(start - 1, 0), end)
+        return min(max(j + 1, start), end)
+
+    def join(self, start: int, end: int) -> str:
+        return '\n'.join(self.lines[start:end])
+
+
+def _cut_head(lines: _Lines, start: int, end: int, limit: int) -> str:
+    """Начало диапазона строк не длиннее limit (по границам строк, иначе по символам)"""
+    k = lines.fit_forward(start, end, limit)
+    if k > start:
+        return lines.join(start, k)
+    return lines.lines[start][:limit] if start < end else ''
+
+
+def _find_sections(lines: _Lines, markers: Sequence[Tuple[str, str]]) -> List[Tuple[int, int, int, str]]:
+    """Разделы: (первая строка, конец, важность, имя); текст до первого заголовка важнее всех"""
+    starts = []
+    for index, line in enumerate(lines.lines):
+        for priority, (prefix, name) in enumerate(markers):
+            if line.startswith(prefix):
+                starts.append((index, priority + 1, name))
+                break
+    if not starts:
+        return []
+    sections = []
+    if starts[0][0] > 0:
+        sections.append((0, starts[0][0], 0, ''))
+    for number, (index, priority, name) in enumerate(starts):
+        end = starts[number + 1][0] if number + 1 < len(starts) else len(lines.lines)
+        sections.append((index, end, priority, name))
+    return sections
+
+
+def _trim_sections(lines: _Lines, sections: List[Tuple[int, int, int, str]], max_size: int) -> str:
+    """Разделы по важности целиком; первый не поместившийся обрезается, остальные опускаются"""
+    keep = {}
+    dropped = []
+    free = max_size
+    truncated = False
+    for number in sorted(range(len(sections)), key=lambda n: sections[n][2]):
+        start, end, _, name = sections[number]
+        # Разделитель между разделами - перевод строки
+        size = lines.length(start, end) + 1
+        if size <= free:
+            keep[number] = lines.join(start, end)
+            free -= size
+            continue
+        limit = free - len(TRUNCATED_MARK) - 2
+        if not truncated and limit > 0:
+            head = _cut_head(lines, start, end, limit)
+            if head:
+                keep[number] = head + '\n' + TRUNCATED_MARK
+                free -= len(keep[number]) + 1
+                truncated = True
+                continue
+        if name:
+            dropped.append(name)
+    result = '\n'.join(keep[number] for number in sorted(keep))
+    if dropped:
+        note = f"\n... [опущено: {', '.join(dropped)}]"
+        if len(result) + len(note) <= max_size:
+            result += note
+    return result
+
+
+def _trim_lines(lines: _Lines, max_size: int, head_share: float = 0.6) -> str:
+    """Начало и конец текста по границам строк, середина опускается"""
+    total = len(lines.lines)
+    budget = max_size - len(MIDDLE_MARK) - 2
+    if budget <= 0:
+        return _cut_head(lines, 0, total, max_size)
+    head_end = lines.fit_forward(0, total, int(budget * head_share))
+    tail_limit = budget - lines.length(0, head_end)
+    tail_start = max(lines.fit_backward(head_end, total, tail_limit), head_end) if head_end < total else total
+    if head_end == 0 and tail_start == total:
+        return _cut_head(lines, 0, total, max_size)
+    parts = [lines.join(0, head_end), MIDDLE_MARK]
+    if tail_start < total:
+        parts.append(lines.join(tail_start, total))
+    return '\n'.join(part for part in parts if part)
+
+
+def trim_context(text: str, max_size: int, sections: Optional[Sequence[Tuple[str, str]]] = PROJECT_SUMMARY_SECTIONS) -> str:
+    """
+    Сократить текст до max_size символов
+
+    Если в тексте есть заголовки разделов (по умолчанию - разделы описания
+    проекта), менее важные разделы опускаются целиком, а первый не
+    поместившийся обрезается по границе строки. Без разделов сохраняются
+    начало и конец текста по границам строк. Длины строк суммируются один
+    раз (префиксные суммы), границы ищутся двоичным поиском, поэтому время
+    линейно по размеру текста.
+
+    Args:
+        text: Исходный текст
+        max_size: Наибольшая длина результата
+        sections: Заголовки разделов (префикс строки, имя) в порядке важности
+    """
+    if len(text) <= max_size:
+        return text
+    if max_size <= 0:
+        return ''
+    lines = _Lines(text)
+    found = _find_sections(lines, sections or ())
+    if len(found) > 1:
+        return _trim_sections(lines, found, max_size)
+    return _trim_lines(lines, max_size)
@@ -0,0 +1,454 @@
+"""
+Непрерывный батчинг (continuous batching) для локальной модели transformers
+"""
+
+import time
+import queue
+import logging
+import threading
+from collections import deque
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from utils.local_generation import StopSequenceFilter
+from utils.prefix_cache import PrefixCache, cache_layers, make_cache
+
+logger = logging.getLogger(__name__)
+
+
+class BatchedSequence:
+    """
+    Запрос в движке непрерывного батчинга
+
+    Итерация выдаёт текст по мере генерации токенов; cancel() исключает
+    последовательность из батча на следующем шаге.
+    """
+
+    def __init__(self, prompt_ids: List[int], params: Dict[str, Any], stop: Sequence[str] = ()):
+        self.prompt_ids = prompt_ids
+        self.params = params
+        self.max_new_tokens = params.get('max_new_tokens', 4096)
+        self.stop_filter = StopSequenceFilter(stop)
+        self.generated: List[int] = []
+        self.next_token: Optional[int] = None
+        self.cancelled = False
+        self.finished = False
+        # Генерация дошла до EOS, max_new_tokens или стоп-последовательности (не отменена)
+        self.completed = False
+        self._emitted = 0
+        self._chunks: queue.Queue = queue.Queue()
+
+    @property
+    def usage(self) -> Dict[str, int]:
+        return {'prompt_tokens': len(self.prompt_ids), 'completion_tokens': len(self.generated)}
+
+    def cancel(self):
+        self.cancelled = True
+
+    def _emit_text(self, tokenizer, final: bool = False):
+        """Выдать новую часть декодированного текста"""
+        text = tokenizer.decode(self.generated, skip_special_tokens=True)
+        if text.endswith('\ufffd') and not final:
+            # Незавершённый многобайтовый символ - ждём следующий токен
+            return
+        ready = self.stop_filter.feed(text[self._emitted:])
+        self._emitted = len(text)
+        if ready:
+            self._chunks.put(ready)
+
+    def _finish(self, error: Optional[BaseException] = None):
+        if self.finished:
+            return
+        self.finished = True
+        self.completed = error is None and not self.cancelled
+        if error is None:
+            tail = self.stop_filter.finish()
+            if tail:
+                self._chunks.put(tail)
+        self._chunks.put(error if error is not None else StopIteration)
+
+    def __iter__(self) -> Iterator[str]:
+        try:
+            while True:
+                item = self._chunks.get()
+                if item is StopIteration:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            # Потребитель ушёл раньше конца генерации - освобождаем место в батче
+            if not self.finished:
+                self.cancel()
+
+
+class ContinuousBatcher:
+    """
+    Планировщик генерации для общей модели в процессе
+
+    Все запросы идут в один цикл декодирования: новые последовательности
+    проходят prefill и добавляются в батч между шагами, завершённые
+    (EOS, лимит токенов, стоп-последовательность, отмена) исключаются
+    сразу. KV-кэш батча выровнен по правому краю (левый паддинг), поэтому
+    каждый шаг - один вызов модели на все активные последовательности.
+    """
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        max_batch_size: int = 8,
+        stats_window: float = 10,
+        prefix_cache: Optional[PrefixCache] = None
+    ):
+        """
+        Args:
+            model: Модель transformers
+            tokenizer: Токенизатор модели
+            max_batch_size: Максимум последовательностей в одном шаге
+            stats_window: Окно расчёта токенов в секунду (секунды)
+            prefix_cache: Кэш KV префиксов (prefill только несовпавшего хвоста промпта)
+        """
+        self.model = model
+        self.tokenizer = tokenizer
+        self.prefix_cache = prefix_cache
+        self.max_batch_size = max(1, max_batch_size)
+        self.stats_window = stats_window
+        self.eos_ids = self._eos_ids()
+
+        self._pending: queue.Queue = queue.Queue()
+        self._active: List[BatchedSequence] = []
+        self._cache = None
+        self._mask = None
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+
+        self._recent: deque = deque()
+        self.stats = {'steps': 0, 'tokens': 0, 'prefills': 0, 'completed': 0, 'cancelled': 0, 'errors': 0}
+        self.last_batch_size = 0
+        self._batch_size_sum = 0
+
+    @classmethod
+    def from_config(
+        cls,
+        config: Dict[str, Any],
+        model,
+        tokenizer,
+        prefix_cache: Optional[PrefixCache] = None
+    ) -> Optional['ContinuousBatcher']:
+        """Создать из секции continuous_batching конфигурации (None если выключено)"""
+        batching_config = config.get('continuous_batching', {}) or {}
+        if not batching_config.get('enabled', True):
+            return None
+        return cls(
+            model,
+            tokenizer,
+            max_batch_size=batching_config.get('max_batch_size', 8),
+            prefix_cache=prefix_cache,
+        )
+
+    def _eos_ids(self) -> set:
+        ids = set()
+        candidates = [getattr(self.tokenizer, 'eos_token_id', None)]
+        generation_config = getattr(self.model, 'generation_config', None)
+        if generation_config is not None:
+            candidates.append(generation_config.eos_token_id)
+        for candidate in candidates:
+            if isinstance(candidate, int):
+                ids.add(candidate)
+            elif candidate:
+                ids.update(candidate)
+        return ids
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run, name="continuous-batching", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 5):
+        """Остановить планировщик; незавершённые запросы получают ошибку"""
+        self._stop_event.set()
+        self._pending.put(None)
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def submit(self, prompt_ids: List[int], params: Dict[str, Any], stop: Sequence[str] = ()) -> BatchedSequence:
+        """
+        Поставить запрос в очередь
+
+        Args:
+            prompt_ids: Токены промпта
+            params: Параметры генерации в формате model.generate()
+                (max_new_tokens, do_sample, temperature, top_p, top_k, repetition_penalty)
+            stop: Стоп-последовательности
+        """
+        sequence = BatchedSequence(list(prompt_ids), params, stop)
+        self.start()
+        self._pending.put(sequence)
+        return sequence
+
+    # ---------- Цикл планировщика ----------
+
+    def _run(self):
+        import torch
+
+        with torch.inference_mode():
+            while not self._stop_event.is_set():
+                try:
+                    self._admit(block=not self._active)
+                    if self._active:
+                        self._step()
+                except Exception as e:
+                    logger.error(f"Ошибка шага непрерывного батчинга: {e}")
+                    self.stats['errors'] += 1
+                    for sequence in self._active:
+                        sequence._finish(e)
+                    self._active = []
+                    self._cache = self._mask = None
+
+        stopped = RuntimeError("Движок генерации остановлен")
+        for sequence in self._active:
+            sequence._finish(stopped)
+        while not self._pending.empty():
+            sequence = self._pending.get_nowait()
+            if sequence is not None:
+                sequence._finish(stopped)
+
+    def _admit(self, block: bool):
+        """Prefill новых запросов и добавление их в батч (между шагами декодирования)"""
+        while len(self._active) < self.max_batch_size:
+            try:
+                sequence = self._pending.get(block=block, timeout=None if block else 0)
+            except queue.Empty:
+                return
+            block = False
+            if sequence is None or sequence.cancelled:
+                if sequence is not None:
+                    self.stats['cancelled'] += 1
+                    sequence._finish()
+                continue
+            try:
+                self._prefill(sequence)
+            except Exception as e:
+                logger.error(f"Ошибка prefill: {e}")
+                self.stats['errors'] += 1
+                sequence._finish(e)
+
+    def _prefill(self, sequence: BatchedSequence):
+        import torch
+
+        device = self.model.device
+        prompt_length = len(sequence.prompt_ids)
+        cached, past = 0, None
+        if self.prefix_cache is not None:
+            cached, layers = self.prefix_cache.lookup(sequence.prompt_ids)
+            if cached:
+                past = make_cache(layers)
+
+        input_ids = torch.tensor([sequence.prompt_ids[cached:]], device=device)
+        output = self.model(
+            input_ids=input_ids,
+            attention_mask=torch.ones((1, prompt_length), dtype=torch.long, device=device),
+            position_ids=torch.arange(cached, prompt_length, device=device).unsqueeze(0),
+            past_key_values=past,
+            use_cache=True,
+        )
+        self.stats['prefills'] += 1
+        if self.prefix_cache is not None:
+            self.prefix_cache.store(sequence.prompt_ids, cache_layers(output.past_key_values))
+
+        token = self._sample(output.logits[0, -1], sequence)
+        if self._accept_token(sequence, token):
+            # Ответ из одного токена - в батч не попадает
+            return
+
+        layers = cache_layers(output.past_key_values)
+        mask = torch.ones((1, len(sequence.prompt_ids)), dtype=torch.long, device=device)
+        self._merge(layers, mask)
+        self._active.append(sequence)
+
+    @staticmethod
+    def _left_pad(tensor, length: int, dim: int):
+        """Дополнить тензор нулями слева по измерению dim"""
+        import torch
+
+        if length <= 0:
+            return tensor
+        shape = list(tensor.shape)
+        shape[dim] = length
+        return torch.cat([tensor.new_zeros(shape), tensor], dim=dim)
+
+    def _merge(self, layers: List[Tuple[Any, Any]], mask):
+        """Добавить KV-кэш новой последовательности к кэшу батча (выравнивание по правому краю)"""
+        import torch
+
+        if self._cache is None:
+            self._mask = mask
+        else:
+            batch_length, new_length = self._mask.shape[1], mask.shape[1]
+            length = max(batch_length, new_length)
+            layers = [
+                (
+                    torch.cat([self._left_pad(keys, length - batch_length, 2), self._left_pad(new_keys, length - new_length, 2)]),
+                    torch.cat([self._left_pad(values, length - batch_length, 2), self._left_pad(new_values, length - new_length, 2)]),
+                )
+                for (keys, values), (new_keys, new_values) in zip(cache_layers(self._cache), layers)
+            ]
+            self._mask = torch.cat([self._left_pad(self._mask, length - batch_length, 1), self._left_pad(mask, length - new_length, 1)])
+        self._cache = make_cache(layers)
+
+    def _evict(self, keep: List[int]):
+        """Оставить в батче только строки keep и убрать общий левый паддинг"""
+        import torch
+
+        self._active = [self._active[i] for i in keep]
+        if not keep:
+            self._cache = self._mask = None
+            return
+
+        index = torch.tensor(keep, device=self._mask.device)
+        mask = self._mask.index_select(0, index)
+        first = int((mask.sum(dim=0) > 0).nonzero()[0])
+        self._mask = mask[:, first:]
+        self._cache = make_cache([
+            (keys.index_select(0, index)[:, :, first:], values.index_select(0, index)[:, :, first:])
+            for keys, values in cache_layers(self._cache)
+        ])
+
+    def _step(self):
+        """Один шаг декодирования для всех активных последовательностей"""
+        import torch
+
+        device = self._mask.device
+        input_ids = torch.tensor([[s.next_token] for s in self._active], device=device)
+        attention_mask = torch.cat([self._mask, self._mask.new_ones((len(self._active), 1))], dim=1)
+        position_ids = (attention_mask.sum(dim=1, keepdim=True) - 1)
+
+        output = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=self._cache,
+            use_cache=True,
+        )
+        self._cache = output.past_key_values
+        self._mask = attention_mask
+
+        batch_size = len(self._active)
+        self.stats['steps'] += 1
+        self.last_batch_size = batch_size
+        self._batch_size_sum += batch_size
+        self._record_tokens(batch_size)
+
+        keep = []
+        for row, sequence in enumerate(self._active):
+            if sequence.cancelled:
+                self.stats['cancelled'] += 1
+                sequence._finish()
+                continue
+            token = self._sample(output.logits[row, -1], sequence)
+            if not self._accept_token(sequence, token):
+                keep.append(row)
+            elif not sequence.cancelled:
+                self._store_prefix(row, sequence)
+
+        if len(keep) < batch_size:
+            self._evict(keep)
+
+    def _store_prefix(self, row: int, sequence: BatchedSequence):
+        """Сохранить KV промпта и ответа завершённой последовательности для следующего хода"""
+        if self.prefix_cache is None:
+            return
+        length = int(self._mask[row].sum())
+        tokens = (sequence.prompt_ids + sequence.generated)[:length]
+        # Копия строки, чтобы не удерживать в памяти тензоры всего батча
+        self.prefix_cache.store(tokens, [
+            (keys[row:row + 1, :, -length:].clone(), values[row:row + 1, :, -length:].clone())
+            for keys, values in cache_layers(self._cache)
+        ])
+
+    def _accept_token(self, sequence: BatchedSequence, token: int) -> bool:
+        """Учесть сгенерированный токен; True если последовательность завершена"""
+        if token in self.eos_ids:
+            sequence._emit_text(self.tokenizer, final=True)
+            sequence._finish()
+            self.stats['completed'] += 1
+            return True
+
+        sequence.generated.append(token)
+        sequence.next_token = token
+        sequence._emit_text(self.tokenizer)
+        if sequence.stop_filter.stopped or len(sequence.generated) >= sequence.max_new_tokens or sequence.cancelled:
+            if sequence.cancelled:
+                self.stats['cancelled'] += 1
+            else:
+                self.stats['completed'] += 1
+            sequence._emit_text(self.tokenizer, final=True)
+            sequence._finish()
+            return True
+        return False
+
+    @staticmethod
+    def _sample(logits, sequence: BatchedSequence) -> int:
+        """Выбор следующего токена с параметрами запроса"""
+        import torch
+
+        params = sequence.params
+        logits = logits.float()
+
+        penalty = params.get('repetition_penalty', 1.0)
+        if penalty and penalty != 1.0:
+            seen = torch.tensor(sorted(set(sequence.prompt_ids + sequence.generated)), device=logits.device)
+            scores = logits[seen]
+            logits[seen] = torch.where(scores < 0, scores * penalty, scores / penalty)
+
+        temperature = params.get('temperature', 1.0)
+        if not params.get('do_sample', True) or not temperature or temperature <= 0:
+            return int(torch.argmax(logits))
+
+        logits = logits / temperature
+        top_k = params.get('top_k')
+        if top_k and top_k < logits.shape[-1]:
+            threshold = torch.topk(logits, top_k).values[-1]
+            logits = logits.masked_fill(logits < threshold, float('-inf'))
+        top_p = params.get('top_p')
+        if top_p and top_p < 1.0:
+            sorted_logits, sorted_index = torch.sort(logits, descending=True)
+            cumulative = torch.softmax(sorted_logits, dim=-1).cumsum(dim=-1)
+            # Токен остаётся, если до него накоплено меньше top_p (первый остаётся всегда)
+            remove = cumulative - torch.softmax(sorted_logits, dim=-1) >= top_p
+            logits = logits.masked_fill(remove.scatter(0, sorted_index, remove), float('-inf'))
+        return int(torch.multinomial(torch.softmax(logits, dim=-1), 1))
+
+    # ---------- Статистика ----------
+
+    def _record_tokens(self, tokens: int):
+        now = time.monotonic()
+        self.stats['tokens'] += tokens
+        self._recent.append((now, tokens))
+        while self._recent and now - self._recent[0][0] > self.stats_window:
+            self._recent.popleft()
+
+    def tokens_per_second(self) -> float:
+        """Токенов в секунду за последние stats_window секунд"""
+        recent = list(self._recent)
+        if not recent:
+            return 0.0
+        elapsed = max(time.monotonic() - recent[0][0], 1e-3)
+        return sum(tokens for _, tokens in recent) / elapsed
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Состояние планировщика для /api/health"""
+        steps = self.stats['steps']
+        return {
+            **self.stats,
+            'max_batch_size': self.max_batch_size,
+            'active': len(self._active),
+            'pending': self._pending.qsize(),
+            'batch_size': self.last_batch_size,
+            'avg_batch_size': round(self._batch_size_sum / steps, 2) if steps else 0.0,
+            'tokens_per_s': round(self.tokens_per_second(), 1),
+        }
@@ -0,0 +1,292 @@
+"""
+Хеджирование запросов: дублирование медленного запроса на другой сервер
+"""
+
+import time
+import queue
+import asyncio
+import logging
+import threading
+from collections import deque
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, Optional
+
+from utils.load_balancer import RequestCancelled
+
+logger = logging.getLogger(__name__)
+
+# Минимум замеров времени до первого токена для оценки перцентиля
+MIN_SAMPLES = 10
+
+
+class Hedger:
+    """
+    Хеджирование потоковых запросов
+
+    Если первый токен не пришёл за hedge_delay(), тот же запрос отправляется
+    на второй сервер. Побеждает поток, первым выдавший содержательный чанк;
+    проигравший отменяется. Задержка - фиксированная (delay) или перцентиль
+    наблюдаемого времени до первого токена (TTFT), ограниченный min_delay и
+    max_delay.
+    """
+
+    def __init__(
+        self,
+        delay: Optional[float] = None,
+        percentile: float = 0.95,
+        min_delay: float = 0.5,
+        max_delay: float = 10,
+        window: int = 200
+    ):
+        """
+        Args:
+            delay: Фиксированная задержка хеджирования (None - по перцентилю TTFT)
+            percentile: Перцентиль TTFT для автоматической задержки
+            min_delay: Нижняя граница задержки (секунды)
+            max_delay: Верхняя граница задержки; она же используется, пока замеров мало
+            window: Сколько последних замеров TTFT учитывать
+        """
+        self.delay = delay
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self._samples: deque = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.stats = {'requests': 0, 'hedged': 0, 'hedge_wins': 0, 'cancelled': 0}
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> Optional['Hedger']:
+        """Создать из секции hedging конфигурации (None если выключено)"""
+        hedging_config = config.get('hedging', {}) or {}
+        if not hedging_config.get('enabled', False):
+            return None
+        delay = hedging_config.get('delay', 'auto')
+        return cls(
+            delay=None if delay in (None, 'auto') else float(delay),
+            percentile=hedging_config.get('percentile', 0.95),
+            min_delay=hedging_config.get('min_delay', 0.5),
+            max_delay=hedging_config.get('max_delay', 10),
+        )
+
+    def record_ttft(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def hedge_delay(self) -> float:
+        """Через сколько секунд без первого токена отправлять дублирующий запрос"""
+        if self.delay is not None:
+            return self.delay
+        with self._lock:
+            if len(self._samples) < MIN_SAMPLES:
+                return self.max_delay
+            samples = sorted(self._samples)
+        index = min(len(samples) - 1, int(len(samples) * self.percentile))
+        return min(self.max_delay, max(self.min_delay, samples[index]))
+
+    @staticmethod
+    def _winner_on_finish(attempt: int, buffered: Dict[int, list], finished: set, started_at: Dict[int, float]) -> Optional[int]:
+        """Победитель после завершения попытки без содержательных чанков (None - ждём дальше)"""
+        if not buffered[attempt]:
+            # Завершилась успешно, но без текста
+            return attempt
+        if finished == set(started_at):
+            # Ошибки у всех попыток - показываем ошибку основной
+            return 0
+        return None
+
+    @staticmethod
+    def _raise_if_cancelled(failures: Dict[int, Exception], winner: int):
+        """Победившая попытка оборвана отменой хода - сообщаем вызывающему (проигравшие отменяются молча)"""
+        error = failures.get(winner)
+        if isinstance(error, RequestCancelled):
+            raise error
+
+    def stream(
+        self,
+        start: Callable[[int], Iterator[str]],
+        cancel: Callable[[int], None],
+        is_error: Callable[[str], bool]
+    ) -> Iterator[str]:
+        """
+        Хеджированный синхронный поток
+
+        Попытки выполняются в фоновых потоках и передают чанки через очередь.
+
+        Args:
+            start: Создаёт поток попытки (0 - основная, 1 - дублирующая)
+            cancel: Отменяет попытку (закрывает её соединение)
+            is_error: Является ли чанк сообщением об ошибке
+        """
+        events: queue.Queue = queue.Queue()
+        finished_marker = object()
+        started_at: Dict[int, float] = {}
+        failures: Dict[int, Exception] = {}
+
+        def run(attempt: int):
+            try:
+                for chunk in start(attempt):
+                    events.put((attempt, chunk))
+            except Exception as e:
+                failures[attempt] = e
+                logger.debug(f"Попытка {attempt} хеджированного запроса: {e}")
+            finally:
+                events.put((attempt, finished_marker))
+
+        def launch(attempt: int):
+            started_at[attempt] = time.monotonic()
+            threading.Thread(target=run, args=(attempt,), name=f"hedge-{attempt}", daemon=True).start()
+
+        self.stats['requests'] += 1
+        launch(0)
+        try:
+            hedge_at = started_at[0] + self.hedge_delay()
+            buffered: Dict[int, list] = {0: [], 1: []}
+            finished = set()
+            winner = None
+            first_chunk = None
+
+            while winner is None:
+                timeout = None if 1 in started_at else max(0.0, hedge_at - time.monotonic())
+                try:
+                    attempt, item = events.get(timeout=timeout)
+                except queue.Empty:
+                    logger.info(f"Нет первого токена за {self.hedge_delay():.1f}с, дублируем запрос")
+                    self.stats['hedged'] += 1
+                    launch(1)
+                    continue
+
+                if item is finished_marker:
+                    finished.add(attempt)
+                    winner = self._winner_on_finish(attempt, buffered, finished, started_at)
+                    continue
+                if is_error(item):
+                    buffered[attempt].append(item)
+                    continue
+                winner = attempt
+                first_chunk = item
+
+            self.record_ttft(time.monotonic() - started_at[winner])
+            for attempt in list(started_at):
+                if attempt != winner and attempt not in finished:
+                    self.stats['cancelled'] += 1
+                    cancel(attempt)
+                    finished.add(attempt)
+            if winner == 1:
+                self.stats['hedge_wins'] += 1
+
+            yield from buffered[winner]
+            if first_chunk is not None:
+                yield first_chunk
+                while winner not in finished:
+                    attempt, item = events.get()
+                    if attempt != winner:
+                        continue
+                    if item is finished_marker:
+                        finished.add(winner)
+                        break
+                    yield item
+            self._raise_if_cancelled(failures, winner)
+        finally:
+            # Потребитель прервал поток - отменяем все незавершённые попытки
+            for attempt in started_at:
+                if attempt not in finished:
+                    cancel(attempt)
+
+    async def astream(
+        self,
+        start: Callable[[int], AsyncIterator[str]],
+        cancel: Callable[[int], None],
+        is_error: Callable[[str], bool]
+    ) -> AsyncIterator[str]:
+        """
+        Хеджированный асинхронный поток
+
+        Попытки - задачи asyncio; проигравшая отменяется через task.cancel(),
+        что закрывает её HTTP-соединение (cancel вызывается дополнительно).
+        """
+        events: asyncio.Queue = asyncio.Queue()
+        finished_marker = object()
+        started_at: Dict[int, float] = {}
+        tasks: Dict[int, asyncio.Task] = {}
+        failures: Dict[int, Exception] = {}
+
+        async def run(attempt: int):
+            try:
+                async for chunk in start(attempt):
+                    await events.put((attempt, chunk))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                failures[attempt] = e
+                logger.debug(f"Попытка {attempt} хеджированного запроса: {e}")
+            finally:
+                events.put_nowait((attempt, finished_marker))
+
+        def launch(attempt: int):
+            started_at[attempt] = time.monotonic()
+            tasks[attempt] = asyncio.ensure_future(run(attempt))
+
+        self.stats['requests'] += 1
+        launch(0)
+        hedge_at = started_at[0] + self.hedge_delay()
+        buffered: Dict[int, list] = {0: [], 1: []}
+        finished = set()
+        winner = None
+        first_chunk = None
+
+        try:
+            while winner is None:
+                timeout = None if 1 in started_at else max(0.0, hedge_at - time.monotonic())
+                try:
+                    attempt, item = await asyncio.wait_for(events.get(), timeout)
+                except asyncio.TimeoutError:
+                    logger.info(f"Нет первого токена за {self.hedge_delay():.1f}с, дублируем запрос")
+                    self.stats['hedged'] += 1
+                    launch(1)
+                    continue
+
+                if item is finished_marker:
+                    finished.add(attempt)
+                    winner = self._winner_on_finish(attempt, buffered, finished, started_at)
+                    continue
+                if is_error(item):
+                    buffered[attempt].append(item)
+                    continue
+                winner = attempt
+                first_chunk = item
+
+            self.record_ttft(time.monotonic() - started_at[winner])
+            for attempt, task in tasks.items():
+                if attempt != winner and attempt not in finished:
+                    self.stats['cancelled'] += 1
+                    cancel(attempt)
+                    task.cancel()
+            if winner == 1:
+                self.stats['hedge_wins'] += 1
+
+            for chunk in buffered[winner]:
+                yield chunk
+            if first_chunk is not None:
+                yield first_chunk
+                while winner not in finished:
+                    attempt, item = await events.get()
+                    if attempt != winner:
+                        continue
+                    if item is finished_marker:
+                        finished.add(winner)
+                        break
+                    yield item
+            self._raise_if_cancelled(failures, winner)
+        finally:
+            # Потребитель прервал поток - отменяем все незавершённые попытки
+            for attempt, task in tasks.items():
+                if not task.done():
+                    cancel(attempt)
+                    task.cancel()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Счётчики хеджирования и текущая задержка"""
+        stats = dict(self.stats)
+        stats['delay'] = round(self.hedge_delay(), 3)
+        with self._lock:
+            stats['ttft_samples'] = len(self._samples)
+        return stats
@@ -0,0 +1,220 @@
+"""
+Фоновое сжатие старой части истории диалога в краткое содержание
+"""
+
+import time
+import queue
+import logging
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = (
+    "Ты ведёшь краткое содержание разговора программиста с AI-ассистентом. "
+    "Обнови содержание с учётом новых сообщений. Сохрани принятые решения, "
+    "договорённости, требования пользователя, имена файлов, функций и команд, "
+    "нерешённые вопросы. Не пересказывай код целиком и не добавляй ничего от себя. "
+    "Ответь только текстом содержания, списком коротких пунктов."
+)
+
+ROLE_NAMES = {'user': 'Пользователь', 'assistant': 'Ассистент', 'system': 'Система'}
+
+
+def format_transcript(previous: Optional[str], messages: List[Dict], max_message_chars: int = 4000) -> str:
+    """Текст для модели: прежнее содержание и сообщения, которые нужно в него добавить"""
+    parts = []
+    if previous:
+        parts.append(f"Текущее содержание:\n{previous}\n")
+    parts.append("Новые сообщения:")
+    for message in messages:
+        content = message.get('content') or ''
+        if len(content) > max_message_chars:
+            content = content[:max_message_chars] + "\n... [сообщение обрезано]"
+        parts.append(f"{ROLE_NAMES.get(message.get('role'), message.get('role'))}: {content}")
+    return "\n\n".join(parts)
+
+
+class CompactionJob:
+    """
+    Одно сжатие: сообщения истории и прежнее содержание на входе,
+    новое содержание на выходе (summary; None - не удалось)
+    """
+
+    def __init__(self, messages: List[Dict], previous: Optional[Dict], run: Callable[[], Tuple[Optional[str], Dict[str, int]]]):
+        """
+        Args:
+            messages: Сообщения истории, которые заменит содержание
+            previous: Запись истории с прежним содержанием (None - его нет)
+            run: Вызов модели: (текст содержания, расход токенов)
+        """
+        self.messages = messages
+        self.previous = previous
+        self.run = run
+        self.summary: Optional[str] = None
+        self.done = threading.Event()
+
+
+class HistoryCompactor:
+    """
+    Сжатие истории вне пути запроса
+
+    Когда токены истории сессии превышают trigger_ratio места под промпт,
+    агент ставит в очередь задание: все ходы, кроме keep_turns последних,
+    вместе с прежним содержанием сворачиваются моделью в новое содержание
+    (если их не меньше summary_tokens, иначе сжатие ничего не даст).
+    Задания выполняет один фоновый поток и только в простое: пока идут
+    ходы диалога (и idle_delay секунд после них), задание ждёт, но не
+    дольше max_defer. Время ожидания и работы, расход токенов и число ходов,
+    начатых во время сжатия, видны в get_stats.
+    """
+
+    def __init__(
+        self,
+        trigger_ratio: float = 0.5,
+        keep_turns: int = 4,
+        summary_tokens: int = 512,
+        idle_delay: float = 1.0,
+        max_defer: float = 30.0
+    ):
+        """
+        Args:
+            trigger_ratio: Доля места под промпт, после которой история сжимается
+            keep_turns: Последние ходы, которые остаются как есть
+            summary_tokens: Лимит генерации содержания
+            idle_delay: Секунд без активных ходов перед запуском сжатия
+            max_defer: Наибольшее ожидание простоя (секунды)
+        """
+        self.trigger_ratio = trigger_ratio
+        self.keep_turns = keep_turns
+        self.summary_tokens = summary_tokens
+        self.idle_delay = idle_delay
+        self.max_defer = max_defer
+
+        self._queue: 'queue.Queue[Optional[CompactionJob]]' = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._cond = threading.Condition()
+        self._active_turns = 0
+        self._last_activity = time.monotonic()
+        self._running = False
+        self.stats = {
+            'runs': 0,
+            'failures': 0,
+            'messages_compacted': 0,
+            'prompt_tokens': 0,
+            'completion_tokens': 0,
+            'seconds': 0.0,
+            'wait_seconds': 0.0,
+            'forced': 0,
+            'overlapping_turns': 0,
+        }
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> Optional['HistoryCompactor']:
+        """Создать из секции compaction конфигурации (None если выключено)"""
+        compaction_config = config.get('compaction', {}) or {}
+        if not compaction_config.get('enabled', True):
+            return None
+        return cls(
+            trigger_ratio=compaction_config.get('trigger_ratio', 0.5),
+            keep_turns=compaction_config.get('keep_turns', 4),
+            summary_tokens=compaction_config.get('summary_tokens', 512),
+            idle_delay=compaction_config.get('idle_delay', 1.0),
+            max_defer=compaction_config.get('max_defer', 30.0),
+        )
+
+    def begin_turn(self):
+        """Начался ход диалога (сжатие откладывается)"""
+        with self._cond:
+            self._active_turns += 1
+            self._last_activity = time.monotonic()
+            if self._running:
+                self.stats['overlapping_turns'] += 1
+
+    def end_turn(self):
+        """Ход диалога завершён"""
+        with self._cond:
+            self._active_turns = max(0, self._active_turns - 1)
+            self._last_activity = time.monotonic()
+            self._cond.notify_all()
+
+    def should_compact(self, history_tokens: int, old_tokens: int, prompt_budget: int) -> bool:
+        """
+        Args:
+            history_tokens: Токены всей истории
+            old_tokens: Токены ходов, которые будут сжаты
+            prompt_budget: Место под промпт
+        """
+        # Сжимать меньше, чем займёт само содержание, бессмысленно
+        return history_tokens > prompt_budget * self.trigger_ratio and old_tokens >= self.summary_tokens
+
+    def submit(self, job: CompactionJob):
+        """Поставить задание в очередь фонового потока"""
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="history-compactor", daemon=True)
+            self._thread.start()
+        self._queue.put(job)
+
+    def stop(self):
+        self._queue.put(None)
+
+    def _wait_idle(self) -> float:
+        """Дождаться простоя; возвращает время ожидания"""
+        start = time.monotonic()
+        with self._cond:
+            while True:
+                waited = time.monotonic() - start
+                if waited >= self.max_defer:
+                    self.stats['forced'] += 1
+                    break
+                quiet = time.monotonic() - self._last_activity
+                if self._active_turns == 0 and quiet >= self.idle_delay:
+                    break
+                timeout = self.max_defer - waited
+                if self._active_turns == 0:
+                    timeout = min(timeout, self.idle_delay - quiet)
+                self._cond.wait(timeout)
+            self._running = True
+        return time.monotonic() - start
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            waited = self._wait_idle()
+            start = time.monotonic()
+            usage: Dict[str, int] = {}
+            try:
+                job.summary, usage = job.run()
+            except Exception as e:
+                logger.warning(f"Сжатие истории не удалось: {e}")
+                job.summary = None
+            finally:
+                with self._cond:
+                    self._running = False
+                elapsed = time.monotonic() - start
+                self.stats['runs'] += 1
+                self.stats['seconds'] += elapsed
+                self.stats['wait_seconds'] += waited
+                self.stats['prompt_tokens'] += usage.get('prompt_tokens', 0)
+                self.stats['completion_tokens'] += usage.get('completion_tokens', 0)
+                if job.summary is None:
+                    self.stats['failures'] += 1
+                else:
+                    self.stats['messages_compacted'] += len(job.messages)
+                logger.info(
+                    f"Сжатие истории: {len(job.messages)} сообщений за {elapsed:.1f}с "
+                    f"(ожидание простоя {waited:.1f}с, токены {usage or 'неизвестно'})"
+                )
+                job.done.set()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Счётчики сжатий для /api/health"""
+        with self._cond:
+            return {
+                **{key: round(value, 3) if isinstance(value, float) else value for key, value in self.stats.items()},
+                'pending': self._queue.qsize(),
+                'running': self._running,
+                'active_turns': self._active_turns,
+            }
@@ -0,0 +1,190 @@
+"""
+Пул keep-alive HTTP-соединений для провайдеров моделей
+"""
+
+import logging
+import threading
+from typing import TYPE_CHECKING, Dict, Any, Optional, Tuple
+from urllib.parse import urlsplit
+
+# requests импортируется при создании первой сессии: сам импорт (urllib3,
+# certifi, charset_normalizer) заметно удлиняет запуск, а веб-сервер
+# отправляет запросы генерации через aiohttp
+if TYPE_CHECKING:
+    import requests
+
+logger = logging.getLogger(__name__)
+
+
+def request_exceptions():
+    """Модуль requests.exceptions (для except без импорта requests при запуске)"""
+    import requests
+    return requests.exceptions
+
+
+def retryable_errors() -> Tuple[type, ...]:
+    """Сетевые ошибки, после которых запрос можно повторить"""
+    exceptions = request_exceptions()
+    return (exceptions.ConnectionError, exceptions.Timeout)
+
+
+class HTTPPool:
+    """
+    Пул HTTP-сессий с keep-alive, по одной сессии на базовый URL
+
+    Все запросы к одному хосту (Ollama, LM Studio, OpenAI-совместимый API)
+    идут через общую requests.Session, поэтому TCP-соединения переиспользуются
+    между ходами диалога и итерациями MCP-инструментов.
+    """
+
+    def __init__(
+        self,
+        pool_connections: int = 4,
+        pool_maxsize: int = 16,
+        keep_alive: bool = True,
+        pool_block: bool = False
+    ):
+        """
+        Args:
+            pool_connections: Количество пулов urllib3 на сессию
+            pool_maxsize: Максимум соединений в пуле одного хоста
+            keep_alive: Держать ли соединения открытыми между запросами
+            pool_block: Блокироваться ли при исчерпании пула (иначе открывается лишнее соединение)
+        """
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.keep_alive = keep_alive
+        self.pool_block = pool_block
+        self._sessions: Dict[str, 'requests.Session'] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> 'HTTPPool':
+        """Создать пул из секции http конфигурации"""
+        http_config = config.get('http', {}) or {}
+        return cls(
+            pool_connections=http_config.get('pool_connections', 4),
+            pool_maxsize=http_config.get('pool_maxsize', 16),
+            keep_alive=http_config.get('keep_alive', True),
+            pool_block=http_config.get('pool_block', False),
+        )
+
+    @staticmethod
+    def _base_key(url: str) -> str:
+        """Ключ пула: схема и хост без пути (http://localhost:1234)"""
+        parts = urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}".lower()
+
+    def _create_session(self) -> 'requests.Session':
+        """Создать сессию с настроенным адаптером"""
+        import requests
+        from requests.adapters import HTTPAdapter
+        
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize,
+            pool_block=self.pool_block,
+        )
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if not self.keep_alive:
+            session.headers['Connection'] = 'close'
+        return session
+
+    def session_for(self, url: str) -> 'requests.Session':
+        """Получить (или создать) сессию для базового URL"""
+        key = self._base_key(url)
+        session = self._sessions.get(key)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(key)
+                if session is None:
+                    session = self._create_session()
+                    self._sessions[key] = session
+                    logger.debug(f"Создан HTTP-пул для {key}")
+        return session
+
+    def request(self, method: str, url: str, **kwargs) -> 'requests.Response':
+        """Выполнить запрос через сессию соответствующего хоста"""
+        return self.session_for(url).request(method, url, **kwargs)
+
+    def get(self, url: str, **kwargs) -> 'requests.Response':
+        """GET-запрос через пул"""
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> 'requests.Response':
+        """POST-запрос через пул"""
+        return self.request('POST', url, **kwargs)
+
+    @staticmethod
+    def release(response: 'requests.Response'):
+        """
+        Вернуть соединение стримингового ответа в пул
+
+        Вызывается после того, как поток логически завершён (done / [DONE]):
+        дочитывает хвост тела, чтобы соединение можно было переиспользовать.
+        Для прерванного потока используйте response.close().
+        """
+        raw = getattr(response, 'raw', None)
+        try:
+            if raw is not None and hasattr(raw, 'drain_conn'):
+                raw.drain_conn()
+        except Exception as e:
+            logger.debug(f"Не удалось дочитать ответ: {e}")
+
+    def get_stats(self) -> Dict[str, Dict[str, int]]:
+        """
+        Статистика соединений по хостам
+
+        Returns:
+            {base_url: {'requests', 'new_connections', 'reused_connections'}}
+        """
+        stats = {}
+        with self._lock:
+            sessions = list(self._sessions.items())
+
+        for key, session in sessions:
+            total_requests = 0
+            new_connections = 0
+            for adapter in set(session.adapters.values()):
+                pool_manager = getattr(adapter, 'poolmanager', None)
+                if pool_manager is None:
+                    continue
+                for key_pool in list(pool_manager.pools.keys()):
+                    pool = pool_manager.pools.get(key_pool)
+                    if pool is None:
+                        continue
+                    total_requests += getattr(pool, 'num_requests', 0)
+                    new_connections += getattr(pool, 'num_connections', 0)
+            stats[key] = {
+                'requests': total_requests,
+                'new_connections': new_connections,
+                'reused_connections': max(0, total_requests - new_connections),
+            }
+        return stats
+
+    def close(self):
+        """Закрыть все сессии и соединения"""
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+        for session in sessions:
+            try:
+                session.close()
+            except Exception as e:
+                logger.debug(f"Ошибка закрытия HTTP-сессии: {e}")
+
+
+_default_pool: Optional[HTTPPool] = None
+_default_pool_lock = threading.Lock()
+
+
+def get_default_pool() -> HTTPPool:
+    """Общий пул процесса для кода, которому пул не передан явно"""
+    global _default_pool
+    if _default_pool is None:
+        with _default_pool_lock:
+            if _default_pool is None:
+                _default_pool = HTTPPool()
+    return _default_pool
@@ -0,0 +1,61 @@
+"""
+Отложенное создание необязательных компонентов агента
+"""
+
+import threading
+from typing import Any, Callable, Generic, Optional, TypeVar
+
+T = TypeVar('T')
+
+
+class Lazy(Generic[T]):
+    """
+    Значение, которое создаётся при первом обращении
+
+    Фабрика вызывается один раз, даже если первое обращение происходит
+    одновременно из нескольких потоков. Объект общий для агента и его
+    сессий (fork_session), поэтому компонент создаётся один раз для всех.
+    """
+
+    def __init__(self, factory: Callable[[], Optional[T]]):
+        self._factory = factory
+        self._value: Optional[T] = None
+        self._created = False
+        self._lock = threading.Lock()
+
+    @property
+    def created(self) -> bool:
+        return self._created
+
+    def get(self) -> Optional[T]:
+        if not self._created:
+            with self._lock:
+                if not self._created:
+                    self._value = self._factory()
+                    self._created = True
+        return self._value
+
+
+class LazyConsole:
+    """
+    rich.console.Console, которая создаётся при первом выводе
+
+    Импорт rich занимает десятки миллисекунд; модулям, которые печатают
+    только сообщения о состоянии, не нужно платить за него при импорте.
+    """
+
+    def __init__(self, **kwargs: Any):
+        self._kwargs = kwargs
+        self._console = None
+        self._lock = threading.Lock()
+
+    def _get(self):
+        if self._console is None:
+            with self._lock:
+                if self._console is None:
+                    from rich.console import Console
+                    self._console = Console(**self._kwargs)
+        return self._console
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._get(), name)
@@ -0,0 +1,297 @@
+"""
+Балансировка запросов между несколькими серверами одной модели
+"""
+
+import time
+import random
+import logging
+import threading
+from typing import Any, Dict, List, Optional
+
+from utils.retry_policy import CircuitBreaker, CircuitOpenError, CIRCUIT_CLOSED
+
+logger = logging.getLogger(__name__)
+
+# Стратегии выбора эндпоинта
+LEAST_OUTSTANDING = "least_outstanding"  # Меньше всего запросов в работе
+LATENCY = "latency"  # Наименьшая скользящая средняя задержки с учётом нагрузки
+
+# Адрес проверки здоровья для каждого провайдера (остальные - OpenAI-совместимые)
+HEALTH_PATHS = {
+    'ollama': '/api/tags',
+    'lmstudio': '/v1/models',
+}
+DEFAULT_HEALTH_PATH = '/models'
+
+
+class RequestCancelled(Exception):
+    """Запрос отменён (проигравшая попытка хеджирования)"""
+
+
+class Endpoint:
+    """Сервер модели и его статистика"""
+
+    def __init__(self, url: str, breaker: CircuitBreaker):
+        self.url = url.rstrip('/')
+        self.breaker = breaker
+        self.outstanding = 0
+        self.latency_ewma: Optional[float] = None
+        self.requests = 0
+        self.failures = 0
+
+    @property
+    def available(self) -> bool:
+        return self.breaker.state == CIRCUIT_CLOSED
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'url': self.url,
+            'state': self.breaker.state,
+            'outstanding': self.outstanding,
+            'latency_ms': round(self.latency_ewma * 1000, 1) if self.latency_ewma is not None else None,
+            'requests': self.requests,
+            'failures': self.failures,
+        }
+
+
+class EndpointPool:
+    """
+    Набор эндпоинтов провайдера с выбором по нагрузке
+
+    Каждый эндпоинт имеет свой CircuitBreaker: после серии ошибок он
+    исключается из ротации, а фоновая проверка здоровья возвращает его,
+    когда сервер снова отвечает. Задержка считается до получения заголовков
+    ответа (время до первого токена) и сглаживается EWMA.
+    """
+
+    def __init__(
+        self,
+        urls: List[str],
+        http_pool,
+        provider: str,
+        strategy: str = LEAST_OUTSTANDING,
+        ewma_alpha: float = 0.3,
+        health_check_interval: float = 10,
+        breaker_factory=None
+    ):
+        """
+        Args:
+            urls: Базовые URL серверов (первый - основной из base_url)
+            http_pool: Пул HTTP-соединений агента (для проверок здоровья)
+            provider: Провайдер (определяет адрес проверки здоровья)
+            strategy: LEAST_OUTSTANDING или LATENCY
+            ewma_alpha: Вес нового замера в скользящей средней задержки
+            health_check_interval: Период проверки исключённых эндпоинтов (секунды)
+            breaker_factory: Создаёт CircuitBreaker по URL эндпоинта
+        """
+        breaker_factory = breaker_factory or (lambda url: CircuitBreaker(name=url))
+        self.endpoints = [Endpoint(url, breaker_factory(url)) for url in dict.fromkeys(u.rstrip('/') for u in urls)]
+        self.primary_url = self.endpoints[0].url
+        self.http_pool = http_pool
+        self.health_path = HEALTH_PATHS.get(provider, DEFAULT_HEALTH_PATH)
+        self.strategy = strategy
+        self.ewma_alpha = ewma_alpha
+        self.health_check_interval = health_check_interval
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any], provider: str, base_url: Optional[str], http_pool) -> Optional['EndpointPool']:
+        """
+        Создать из конфигурации провайдера (None для провайдеров без эндпоинтов)
+
+        Дополнительные серверы задаются списком <provider>.endpoints,
+        параметры выбора - секцией balancer.
+        """
+        if provider == "local_transformers" or not base_url:
+            return None
+        urls = [base_url] + list(config.get(provider, {}).get('endpoints', []) or [])
+        balancer_config = config.get('balancer', {}) or {}
+        return cls(
+            urls,
+            http_pool,
+            provider,
+            strategy=balancer_config.get('strategy', LEAST_OUTSTANDING),
+            ewma_alpha=balancer_config.get('ewma_alpha', 0.3),
+            health_check_interval=balancer_config.get('health_check_interval', 10),
+            breaker_factory=lambda url: CircuitBreaker.from_config(config, name=url),
+        )
+
+    def start(self):
+        """Запустить фоновую проверку здоровья (только если эндпоинтов несколько)"""
+        if len(self.endpoints) < 2 or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._health_loop, name="endpoint-health", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _score(self, endpoint: Endpoint) -> tuple:
+        # Незамеренные эндпоинты получают нулевую задержку - их пробуют первыми;
+        # случайная добавка распределяет равные по счёту запросы
+        latency = endpoint.latency_ewma or 0.0
+        if self.strategy == LATENCY:
+            return (latency * (endpoint.outstanding + 1), random.random())
+        return (endpoint.outstanding, latency, random.random())
+
+    def acquire(self, preferred: Optional[Endpoint] = None, exclude: Optional[Endpoint] = None) -> Endpoint:
+        """
+        Выбрать эндпоинт и занять слот запроса
+
+        Args:
+            preferred: Закреплённый эндпоинт - используется, пока он доступен
+            exclude: Эндпоинт, который выбирать нельзя (занят основной попыткой)
+
+        Raises:
+            CircuitOpenError: Все подходящие эндпоинты исключены
+        """
+        with self._lock:
+            others = sorted((e for e in self.endpoints if e is not preferred and e is not exclude), key=self._score)
+            candidates = ([preferred] if preferred is not None and preferred is not exclude else []) + others
+
+            retry_in = None
+            for endpoint in candidates:
+                try:
+                    endpoint.breaker.before_request()
+                except CircuitOpenError as e:
+                    retry_in = e.retry_in if retry_in is None else min(retry_in, e.retry_in)
+                    continue
+                if preferred is not None and endpoint is not preferred:
+                    logger.info(f"Эндпоинт {preferred.url} недоступен, запрос переключён на {endpoint.url}")
+                endpoint.outstanding += 1
+                endpoint.requests += 1
+                return endpoint
+            raise CircuitOpenError(retry_in or 1)
+
+    def release(self, endpoint: Endpoint):
+        """Освободить слот запроса"""
+        with self._lock:
+            endpoint.outstanding = max(0, endpoint.outstanding - 1)
+
+    def record_latency(self, endpoint: Endpoint, latency: float):
+        with self._lock:
+            if endpoint.latency_ewma is None:
+                endpoint.latency_ewma = latency
+            else:
+                endpoint.latency_ewma += self.ewma_alpha * (latency - endpoint.latency_ewma)
+
+    def rebase(self, url: str, endpoint: Endpoint) -> str:
+        """Перенести URL основного сервера на выбранный эндпоинт"""
+        if url.startswith(self.primary_url):
+            return endpoint.url + url[len(self.primary_url):]
+        return url
+
+    def _health_loop(self):
+        """Возврат исключённых эндпоинтов, когда сервер снова отвечает"""
+        while not self._stop_event.wait(self.health_check_interval):
+            for endpoint in self.endpoints:
+                if endpoint.available:
+                    continue
+                try:
+                    response = self.http_pool.get(f"{endpoint.url}{self.health_path}", timeout=5)
+                    healthy = response.status_code == 200
+                    response.close()
+                except Exception as e:
+                    logger.debug(f"Проверка {endpoint.url}: {e}")
+                    healthy = False
+                if healthy:
+                    logger.info(f"Эндпоинт {endpoint.url} снова доступен")
+                    endpoint.breaker.record_success()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Состояние эндпоинтов для /api/health"""
+        with self._lock:
+            return {
+                'strategy': self.strategy,
+                'endpoints': [e.get_stats() for e in self.endpoints],
+            }
+
+
+class EndpointRoute:
+    """
+    Маршрут одного хода диалога
+
+    Первый запрос хода выбирает эндпоинт, запросы итераций инструментов идут
+    на него же (кэш промпта на стороне сервера остаётся полезным). Если
+    закреплённый эндпоинт исключён, ход переключается на другой. Объект
+    реализует интерфейс CircuitBreaker, который ожидает RetryPolicy.
+    """
+
+    def __init__(self, pool: EndpointPool, endpoint: Optional[Endpoint] = None, avoid: Optional['EndpointRoute'] = None):
+        """
+        Args:
+            pool: Набор эндпоинтов
+            endpoint: Начальный закреплённый эндпоинт
+            avoid: Маршрут, эндпоинт которого не использовать (дублирующий запрос)
+        """
+        self.pool = pool
+        self.endpoint = endpoint
+        self.avoid = avoid
+        self.aborted = False
+        self.response = None
+        self._active: Optional[Endpoint] = None
+        self._started = 0.0
+        self._waiting = False
+
+    def url(self, url: str) -> str:
+        """URL запроса на текущем эндпоинте"""
+        return self.pool.rebase(url, self.endpoint) if self.endpoint is not None else url
+
+    def before_request(self):
+        if self.aborted:
+            raise RequestCancelled()
+        self.release()
+        self.endpoint = self.pool.acquire(self.endpoint, exclude=self.avoid.endpoint if self.avoid else None)
+        self._active = self.endpoint
+        self._started = time.monotonic()
+        self._waiting = True
+
+    def attach(self, response):
+        """Запомнить ответ попытки, чтобы abort() мог закрыть соединение"""
+        self.response = response
+        if self.aborted:
+            response.close()
+            raise RequestCancelled()
+
+    def abort(self):
+        """Отменить запрос: закрыть соединение и не выполнять повторы"""
+        self.aborted = True
+        active = self._active
+        if self._waiting and active is not None:
+            # Ответа ещё нет: прошедшее время - нижняя оценка задержки эндпоинта,
+            # иначе медленный сервер так и останется незамеренным (и "самым быстрым")
+            self.pool.record_latency(active, time.monotonic() - self._started)
+        response = self.response
+        if response is not None:
+            try:
+                response.close()
+            except Exception as e:
+                logger.debug(f"Ошибка закрытия отменённого ответа: {e}")
+
+    def record_success(self):
+        self._waiting = False
+        if self._active is not None:
+            self.pool.record_latency(self._active, time.monotonic() - self._started)
+            self._active.breaker.record_success()
+
+    def record_failure(self):
+        self._waiting = False
+        if self._active is not None:
+            self._active.failures += 1
+            self._active.breaker.record_failure()
+        self.release()
+
+    def cancel_request(self):
+        self._waiting = False
+        if self._active is not None:
+            self._active.breaker.cancel_request()
+        self.release()
+
+    def release(self):
+        """Запрос завершён (поток дочитан или прерван)"""
+        if self._active is not None:
+            self.pool.release(self._active)
+            self._active = None
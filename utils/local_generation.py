@@ -0,0 +1,183 @@
+"""
+Потоковая генерация локальной модели transformers
+"""
+
+import threading
+import logging
+from typing import Any, Dict, Iterator, Optional, Sequence
+
+from utils.prefix_cache import PrefixCache, cache_layers, make_cache
+
+logger = logging.getLogger(__name__)
+
+
+class StopSequenceFilter:
+    """
+    Отсечение стоп-последовательностей в потоке текста
+
+    Хвост фрагмента, который может оказаться началом стоп-последовательности,
+    придерживается до следующего фрагмента. После совпадения поток
+    заканчивается; сама стоп-последовательность не выдаётся.
+    """
+
+    def __init__(self, stop: Sequence[str] = ()):
+        self.stop = [s for s in stop if s]
+        self.stopped = False
+        self._buffer = ""
+
+    def _partial_length(self) -> int:
+        """Длина хвоста буфера, совпадающего с началом какой-либо стоп-последовательности"""
+        for length in range(min(len(self._buffer), max(len(s) for s in self.stop) - 1), 0, -1):
+            tail = self._buffer[-length:]
+            if any(s.startswith(tail) for s in self.stop):
+                return length
+        return 0
+
+    def feed(self, text: str) -> str:
+        """Принять фрагмент и вернуть текст, который уже можно выдать"""
+        if self.stopped:
+            return ""
+        if not self.stop:
+            return text
+
+        self._buffer += text
+        positions = [p for p in (self._buffer.find(s) for s in self.stop) if p != -1]
+        if positions:
+            self.stopped = True
+            ready, self._buffer = self._buffer[:min(positions)], ""
+            return ready
+
+        keep = self._partial_length()
+        ready = self._buffer[:len(self._buffer) - keep]
+        self._buffer = self._buffer[len(self._buffer) - keep:]
+        return ready
+
+    def finish(self) -> str:
+        """Остаток буфера в конце потока"""
+        ready, self._buffer = ("" if self.stopped else self._buffer), ""
+        return ready
+
+
+class LocalGeneration:
+    """
+    Генерация model.generate() в фоновом потоке с выдачей текста по токенам
+
+    Текст приходит через TextIteratorStreamer сразу после декодирования
+    очередного токена. Остановка (cancel(), стоп-последовательность или
+    закрытие итератора) проверяется критерием остановки после каждого
+    токена, поэтому модель прекращает работу на следующем шаге.
+    """
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        inputs: Dict[str, Any],
+        generation_kwargs: Dict[str, Any],
+        stop: Sequence[str] = (),
+        prefix_cache: Optional[PrefixCache] = None
+    ):
+        """
+        Args:
+            model: Модель transformers
+            tokenizer: Токенизатор модели
+            inputs: Результат токенизации промпта (input_ids, attention_mask)
+            generation_kwargs: Параметры model.generate()
+            stop: Стоп-последовательности
+            prefix_cache: Кэш KV префиксов (prefill только несовпавшего хвоста промпта)
+        """
+        self.model = model
+        self.tokenizer = tokenizer
+        self.inputs = inputs
+        self.generation_kwargs = generation_kwargs
+        self.stop_filter = StopSequenceFilter(stop)
+        self.prefix_cache = prefix_cache
+        self.prompt_tokens = int(inputs['input_ids'].shape[-1])
+        self.completion_tokens = 0
+        self._sequence = None
+        self._halt = threading.Event()
+        self._error: Optional[BaseException] = None
+        # Генерация дошла до EOS, max_new_tokens или стоп-последовательности (не отменена)
+        self.completed = False
+
+    def cancel(self):
+        """Остановить генерацию (безопасно из любого потока)"""
+        self._halt.set()
+
+    @property
+    def usage(self) -> Dict[str, int]:
+        return {'prompt_tokens': self.prompt_tokens, 'completion_tokens': self.completion_tokens}
+
+    def _stopping_criteria(self):
+        from transformers import StoppingCriteria, StoppingCriteriaList
+
+        generation = self
+
+        class HaltCriteria(StoppingCriteria):
+            def __call__(self, input_ids, scores, **kwargs) -> bool:
+                generation.completion_tokens = int(input_ids.shape[-1]) - generation.prompt_tokens
+                generation._sequence = input_ids
+                return generation._halt.is_set()
+
+        return StoppingCriteriaList([HaltCriteria()])
+
+    def _store_prefix(self, cache):
+        """Сохранить KV промпта и ответа в кэш префиксов"""
+        layers = cache_layers(cache)
+        if self._sequence is None or not layers:
+            return
+        length = int(layers[0][0].shape[2])
+        self.prefix_cache.store(self._sequence[0, :length].tolist(), layers)
+
+    def __iter__(self) -> Iterator[str]:
+        from transformers import TextIteratorStreamer
+
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        cache_kwargs = {}
+        if self.prefix_cache is not None:
+            # generate() дописывает переданный кэш на месте - после генерации
+            # в нём KV промпта и ответа для следующего хода
+            prompt_ids = self.inputs['input_ids'][0].tolist()
+            cached, layers = self.prefix_cache.lookup(prompt_ids)
+            cache_kwargs['past_key_values'] = make_cache(layers) if cached else make_cache([])
+
+        def run():
+            try:
+                self.model.generate(
+                    **self.inputs,
+                    **self.generation_kwargs,
+                    **cache_kwargs,
+                    streamer=streamer,
+                    stopping_criteria=self._stopping_criteria(),
+                )
+                if cache_kwargs:
+                    self._store_prefix(cache_kwargs['past_key_values'])
+            except BaseException as e:
+                self._error = e
+                # Без end() потребитель ждал бы следующий токен бесконечно
+                streamer.end()
+
+        thread = threading.Thread(target=run, name="transformers-generate", daemon=True)
+        thread.start()
+        try:
+            for text in streamer:
+                ready = self.stop_filter.feed(text)
+                if ready:
+                    yield ready
+                if self.stop_filter.stopped:
+                    self.completed = True
+                    break
+                if self._halt.is_set():
+                    break
+            else:
+                tail = self.stop_filter.finish()
+                if tail:
+                    yield tail
+                self.completed = not self._halt.is_set()
+        finally:
+            # Итератор закрыт или поток остановлен - модель прекращает генерацию
+            self._halt.set()
+            thread.join()
+
+        if self._error is not None:
+            raise self._error
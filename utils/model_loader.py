@@ -0,0 +1,350 @@
+"""
+Загрузка локальной модели transformers
+"""
+
+import os
+import gc
+import time
+import logging
+import threading
+from typing import Any, Dict, Optional
+
+from utils.prefix_cache import PrefixCache
+from utils.continuous_batching import ContinuousBatcher
+
+try:
+    import psutil
+    PSUTIL_AVAILABLE = True
+except ImportError:
+    PSUTIL_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+# Загруженные модели процесса: ключ - параметры загрузки
+_registry: Dict[tuple, 'LoadedModel'] = {}
+_registry_lock = threading.Lock()
+
+
+def resident_memory_mb() -> Optional[float]:
+    """Резидентная память процесса (МБ), None если определить не удалось"""
+    if PSUTIL_AVAILABLE:
+        return psutil.Process().memory_info().rss / (1024 * 1024)
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class LoadedModel:
+    """
+    Модель и токенизатор, общие для всех агентов процесса
+
+    Кэш префиксов и планировщик батчей - тоже один на модель: запросы всех
+    агентов декодируются одним батчем и переиспользуют общие префиксы.
+    Они создаются, когда у модели появляется первая ссылка, и
+    останавливаются, когда ссылок не остаётся.
+    """
+
+    def __init__(self, key: tuple, model, tokenizer, load_seconds: float, memory_mb: Dict[str, float]):
+        self.key = key
+        self.model = model
+        self.tokenizer = tokenizer
+        self.load_seconds = load_seconds
+        self.memory_mb = memory_mb
+        self.refs = 0
+        self.prefix_cache: Optional[PrefixCache] = None
+        self.batch_engine: Optional[ContinuousBatcher] = None
+
+    def start(self, config: Dict[str, Any]):
+        """Создать кэш префиксов и планировщик батчей (секции prefix_cache и continuous_batching)"""
+        self.prefix_cache = PrefixCache.from_config(config)
+        self.batch_engine = ContinuousBatcher.from_config(config, self.model, self.tokenizer, self.prefix_cache)
+
+    def stop(self):
+        """Остановить планировщик и освободить KV кэша префиксов"""
+        if self.batch_engine is not None:
+            self.batch_engine.stop()
+        self.prefix_cache = self.batch_engine = None
+
+
+class ModelLoader:
+    """
+    Загрузчик модели с учётом секции gpu конфигурации
+
+    Веса safetensors отображаются в память (mmap) и читаются по мере
+    размещения на устройстве, без полной копии в RAM. Квантование
+    (use_4bit/use_8bit) требует bitsandbytes, FlashAttention - flash_attn;
+    без них модель загружается без этих оптимизаций. Одна и та же модель
+    с одинаковыми параметрами загружается в процессе один раз.
+    """
+
+    def __init__(
+        self,
+        model_path: str,
+        device: str = 'cuda',
+        use_gpu: bool = True,
+        max_memory: Optional[float] = None,
+        use_4bit: bool = False,
+        use_8bit: bool = False,
+        use_flash_attention: bool = True
+    ):
+        """
+        Args:
+            model_path: Путь к модели или её имя на Hugging Face Hub
+            device: Устройство из секции model (cuda, cpu, mps)
+            use_gpu: Разрешено ли использовать GPU
+            max_memory: Лимит памяти на одну GPU (ГБ)
+            use_4bit: Квантование весов в 4 бита
+            use_8bit: Квантование весов в 8 бит
+            use_flash_attention: Использовать FlashAttention 2, если установлен
+        """
+        self.model_path = model_path
+        self.device = device
+        self.use_gpu = use_gpu
+        self.max_memory = max_memory
+        self.use_4bit = use_4bit
+        self.use_8bit = use_8bit and not use_4bit
+        self.use_flash_attention = use_flash_attention
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any], model_name: str) -> 'ModelLoader':
+        """Создать из секций model и gpu конфигурации"""
+        model_config = config.get('model', {}) or {}
+        gpu_config = config.get('gpu', {}) or {}
+        return cls(
+            model_path=model_config.get('model_path') or model_name,
+            device=model_config.get('device', 'cuda'),
+            use_gpu=gpu_config.get('use_gpu', True),
+            max_memory=gpu_config.get('max_memory'),
+            use_4bit=gpu_config.get('use_4bit', False),
+            use_8bit=gpu_config.get('use_8bit', False),
+            use_flash_attention=gpu_config.get('use_flash_attention', True),
+        )
+
+    def resolve_device(self) -> str:
+        """Фактическое устройство: GPU только если оно разрешено и доступно"""
+        import torch
+
+        if self.device == 'cpu' or not self.use_gpu:
+            return 'cpu'
+        if self.device == 'mps':
+            return 'mps' if torch.backends.mps.is_available() else 'cpu'
+        if not torch.cuda.is_available():
+            logger.warning("CUDA недоступна, модель загружается на CPU")
+            return 'cpu'
+        return 'cuda'
+
+    @property
+    def key(self) -> tuple:
+        return (
+            self.model_path, self.resolve_device(), self.max_memory,
+            self.use_4bit, self.use_8bit, self.use_flash_attention,
+        )
+
+    def _has_safetensors(self) -> bool:
+        return os.path.isdir(self.model_path) and any(
+            name.endswith('.safetensors') for name in os.listdir(self.model_path)
+        )
+
+    def _quantization_config(self, dtype):
+        if not (self.use_4bit or self.use_8bit):
+            return None
+        try:
+            import bitsandbytes  # noqa: F401
+            from transformers import BitsAndBytesConfig
+        except ImportError:
+            logger.warning("bitsandbytes не установлен, квантование отключено")
+            return None
+        if self.use_4bit:
+            return BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_quant_type='nf4',
+                bnb_4bit_compute_dtype=dtype,
+                bnb_4bit_use_double_quant=True,
+            )
+        return BitsAndBytesConfig(load_in_8bit=True)
+
+    def _attention_implementation(self) -> str:
+        if self.use_flash_attention:
+            try:
+                import flash_attn  # noqa: F401
+                return 'flash_attention_2'
+            except ImportError:
+                logger.info("flash_attn не установлен, используется SDPA")
+        return 'sdpa'
+
+    def load_kwargs(self) -> Dict[str, Any]:
+        """Параметры AutoModelForCausalLM.from_pretrained()"""
+        import torch
+        import transformers
+        from packaging import version
+
+        device = self.resolve_device()
+        dtype = torch.float32 if device == 'cpu' else torch.float16
+        # torch_dtype устарел с transformers 4.56, более старые версии знают только его
+        dtype_arg = 'dtype' if version.parse(transformers.__version__) >= version.parse('4.56') else 'torch_dtype'
+        kwargs: Dict[str, Any] = {dtype_arg: dtype, 'low_cpu_mem_usage': True}
+        if self._has_safetensors():
+            kwargs['use_safetensors'] = True
+
+        if device == 'cuda':
+            kwargs['device_map'] = 'auto'
+            kwargs['attn_implementation'] = self._attention_implementation()
+            if self.max_memory:
+                kwargs['max_memory'] = {i: f"{self.max_memory}GiB" for i in range(torch.cuda.device_count())}
+            quantization = self._quantization_config(dtype)
+            if quantization is not None:
+                kwargs['quantization_config'] = quantization
+        elif device == 'mps':
+            kwargs['device_map'] = 'mps'
+        return kwargs
+
+    def acquire(self, config: Dict[str, Any]) -> LoadedModel:
+        """
+        Модель из реестра процесса или новая загрузка (счётчик ссылок +1)
+
+        Args:
+            config: Конфигурация агента - по ней создаются кэш префиксов и
+                планировщик батчей, если у модели ещё нет ссылок
+        """
+        key = self.key
+        with _registry_lock:
+            loaded = _registry.get(key)
+            if loaded is None:
+                self._evict_unused()
+                loaded = _registry[key] = self._load(key)
+            else:
+                logger.info(f"Модель {self.model_path} уже загружена, используется общий экземпляр")
+            loaded.refs += 1
+            if loaded.refs == 1:
+                loaded.start(config)
+            return loaded
+
+    @staticmethod
+    def release(loaded: LoadedModel):
+        """
+        Агент больше не использует модель
+
+        Без ссылок планировщик и кэш префиксов останавливаются, а сама
+        модель остаётся в памяти до загрузки другой.
+        """
+        with _registry_lock:
+            loaded.refs = max(0, loaded.refs - 1)
+            if loaded.refs == 0:
+                loaded.stop()
+
+    @staticmethod
+    def _evict_unused():
+        """Выгрузить модели без ссылок перед загрузкой новой"""
+        unused = [key for key, loaded in _registry.items() if loaded.refs == 0]
+        if not unused:
+            return
+        for key in unused:
+            logger.info(f"Выгрузка неиспользуемой модели {key[0]}")
+            _registry.pop(key).stop()
+        gc.collect()
+        try:
+            import torch
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        except ImportError:
+            pass
+
+    def _load(self, key: tuple) -> LoadedModel:
+        from transformers import AutoTokenizer, AutoModelForCausalLM
+
+        kwargs = self.load_kwargs()
+        rss_before = resident_memory_mb()
+        started = time.perf_counter()
+
+        tokenizer = AutoTokenizer.from_pretrained(self.model_path)
+        model = AutoModelForCausalLM.from_pretrained(self.model_path, **kwargs)
+        if 'device_map' not in kwargs:
+            model = model.to(key[1])
+        model.eval()
+
+        load_seconds = time.perf_counter() - started
+        memory = self._memory_usage(model, rss_before)
+        details = ", ".join(f"{name} {value:.0f} МБ" for name, value in memory.items())
+        logger.info(f"Модель {self.model_path} загружена за {load_seconds:.1f}с на {key[1]} ({details})")
+        return LoadedModel(key, model, tokenizer, load_seconds, memory)
+
+    @staticmethod
+    def _memory_usage(model, rss_before: Optional[float]) -> Dict[str, float]:
+        """Память модели: веса, прирост RSS процесса, выделенная память GPU"""
+        memory = {}
+        if hasattr(model, 'get_memory_footprint'):
+            memory['weights'] = model.get_memory_footprint() / (1024 * 1024)
+        rss = resident_memory_mb()
+        if rss is not None:
+            memory['rss'] = rss
+            if rss_before is not None:
+                memory['rss_delta'] = rss - rss_before
+        try:
+            import torch
+            if torch.cuda.is_available():
+                memory['gpu'] = torch.cuda.memory_allocated() / (1024 * 1024)
+        except ImportError:
+            pass
+        return memory
+
+
+class LocalModel:
+    """
+    Локальная модель агента: загрузка (сразу или при первом запросе)
+
+    Объект общий для агента и его сессий (fork_session), поэтому
+    отложенная загрузка выполняется один раз для всех. Кэш префиксов и
+    планировщик батчей принадлежат загруженной модели (LoadedModel) и
+    общие для всех агентов процесса.
+    """
+
+    def __init__(self, loader: ModelLoader, config: Dict[str, Any]):
+        self.loader = loader
+        self.config = config
+        self.model = None
+        self.tokenizer = None
+        self.prefix_cache: Optional[PrefixCache] = None
+        self.batch_engine: Optional[ContinuousBatcher] = None
+        # Модель уже была загружена другим агентом процесса
+        self.shared = False
+        self._loaded: Optional[LoadedModel] = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded is not None
+
+    def ensure_loaded(self) -> 'LocalModel':
+        """Загрузить модель, если она ещё не загружена"""
+        if self._loaded is None:
+            with self._lock:
+                if self._loaded is None:
+                    loaded = self.loader.acquire(self.config)
+                    self.shared = loaded.refs > 1
+                    self.tokenizer = loaded.tokenizer
+                    self.model = loaded.model
+                    self.prefix_cache = loaded.prefix_cache
+                    self.batch_engine = loaded.batch_engine
+                    self._loaded = loaded
+        return self
+
+    def close(self):
+        """Освободить ссылку на модель (планировщик остановится вместе с последней ссылкой)"""
+        with self._lock:
+            if self._loaded is not None:
+                ModelLoader.release(self._loaded)
+            self._loaded = None
+            self.model = self.tokenizer = None
+            self.prefix_cache = self.batch_engine = None
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Состояние модели для /api/health"""
+        stats: Dict[str, Any] = {'loaded': self.loaded, 'model_path': self.loader.model_path}
+        if self._loaded is not None:
+            stats['device'] = self._loaded.key[1]
+            stats['load_seconds'] = round(self._loaded.load_seconds, 2)
+            stats['memory_mb'] = {name: round(value, 1) for name, value in self._loaded.memory_mb.items()}
+        return stats
@@ -0,0 +1,192 @@
+"""
+Кэш KV префиксов промпта для локальной модели transformers
+"""
+
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def cache_layers(cache) -> List[Tuple[Any, Any]]:
+    """Тензоры (keys, values) по слоям из кэша любой версии transformers"""
+    if hasattr(cache, 'layers'):
+        return [(layer.keys, layer.values) for layer in cache.layers]
+    if hasattr(cache, 'key_cache'):
+        return list(zip(cache.key_cache, cache.value_cache))
+    return [(keys, values) for keys, values in cache]
+
+
+def make_cache(layers: List[Tuple[Any, Any]]):
+    """Кэш для past_key_values из тензоров по слоям"""
+    try:
+        from transformers import DynamicCache
+    except ImportError:
+        return tuple(layers)
+    if hasattr(DynamicCache, 'from_legacy_cache'):
+        return DynamicCache.from_legacy_cache(tuple(layers))
+    return DynamicCache(ddp_cache_data=layers)
+
+
+class _Entry:
+    """Сохранённый KV-кэш одной последовательности токенов"""
+
+    def __init__(self, tokens: Tuple[int, ...], layers: List[Tuple[Any, Any]], hashes: List[int]):
+        self.tokens = tokens
+        self.layers = layers
+        self.hashes = hashes
+        self.nbytes = sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in layers)
+
+
+class PrefixCache:
+    """
+    LRU-кэш past_key_values по префиксам токенов
+
+    Промпт нового хода (системный промпт, контекст проекта, история) почти
+    целиком совпадает с промптом и ответом предыдущего. Токены делятся на
+    блоки, для каждой границы блока считается цепочечный хеш префикса;
+    поиск идёт по хешам блок за блоком, затем совпадение уточняется
+    потокенно. Prefill нужен только для несовпавшего хвоста. Записи
+    вытесняются по LRU, когда тензоры превышают бюджет памяти.
+    """
+
+    def __init__(self, max_memory_mb: float = 1024, block_size: int = 32, min_tokens: int = 16):
+        """
+        Args:
+            max_memory_mb: Бюджет памяти на тензоры кэша (МБ)
+            block_size: Размер блока токенов для хешей префиксов
+            min_tokens: Совпадения короче не используются
+        """
+        self.max_bytes = int(max_memory_mb * 1024 * 1024)
+        self.block_size = max(1, block_size)
+        self.min_tokens = min_tokens
+        self._entries: 'OrderedDict[int, _Entry]' = OrderedDict()
+        self._index: Dict[int, int] = {}
+        self._next_id = 0
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'tokens_reused': 0, 'tokens_prefilled': 0, 'evictions': 0}
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> Optional['PrefixCache']:
+        """Создать из секции prefix_cache конфигурации (None если выключено)"""
+        prefix_config = config.get('prefix_cache', {}) or {}
+        if not prefix_config.get('enabled', True):
+            return None
+        return cls(
+            max_memory_mb=prefix_config.get('max_memory_mb', 1024),
+            block_size=prefix_config.get('block_size', 32),
+        )
+
+    def _block_hashes(self, tokens: Sequence[int]) -> List[int]:
+        """Хеши префиксов на границах полных блоков"""
+        hashes = []
+        current = 0
+        for start in range(0, len(tokens) - self.block_size + 1, self.block_size):
+            current = hash((current, tuple(tokens[start:start + self.block_size])))
+            hashes.append(current)
+        return hashes
+
+    def lookup(self, tokens: Sequence[int]) -> Tuple[int, Optional[List[Tuple[Any, Any]]]]:
+        """
+        Найти самый длинный сохранённый префикс
+
+        Хотя бы один токен промпта всегда остаётся для prefill - по нему
+        считаются логиты первого токена ответа.
+
+        Returns:
+            (число совпавших токенов, KV-тензоры этого префикса) или (0, None)
+        """
+        limit = len(tokens) - 1
+        with self._lock:
+            entry_id = entry = None
+            matched = 0
+            for blocks, block_hash in enumerate(self._block_hashes(tokens[:limit]), 1):
+                if block_hash not in self._index:
+                    break
+                entry_id = self._index[block_hash]
+                entry, matched = self._entries[entry_id], blocks * self.block_size
+
+            if entry is not None:
+                # Хеш мог совпасть случайно - проверяем токены
+                if tuple(tokens[:matched]) != entry.tokens[:matched]:
+                    entry, matched = None, 0
+                else:
+                    end = min(limit, len(entry.tokens))
+                    while matched < end and tokens[matched] == entry.tokens[matched]:
+                        matched += 1
+
+            if entry is None or matched < self.min_tokens:
+                self.stats['misses'] += 1
+                self.stats['tokens_prefilled'] += len(tokens)
+                return 0, None
+
+            self._entries.move_to_end(entry_id)
+            self.stats['hits'] += 1
+            self.stats['tokens_reused'] += matched
+            self.stats['tokens_prefilled'] += len(tokens) - matched
+            return matched, [(k[:, :, :matched], v[:, :, :matched]) for k, v in entry.layers]
+
+    def store(self, tokens: Sequence[int], layers: List[Tuple[Any, Any]]):
+        """
+        Сохранить KV-кэш последовательности
+
+        Args:
+            tokens: Токены, для которых посчитан кэш
+            layers: (keys, values) по слоям, батч из одной строки, длина len(tokens)
+        """
+        tokens = tuple(tokens)
+        if len(tokens) < self.min_tokens:
+            return
+        hashes = self._block_hashes(tokens)
+        entry = _Entry(tokens, layers, hashes)
+        if entry.nbytes > self.max_bytes:
+            return
+
+        with self._lock:
+            # Записи, которые являются префиксом новой, больше не нужны
+            for entry_id, old in list(self._entries.items()):
+                if len(old.tokens) <= len(tokens) and tokens[:len(old.tokens)] == old.tokens:
+                    self._remove(entry_id)
+
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = entry
+            self._bytes += entry.nbytes
+            for block_hash in hashes:
+                self._index[block_hash] = entry_id
+
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.stats['evictions'] += 1
+
+    def _remove(self, entry_id: int):
+        entry = self._entries.pop(entry_id)
+        self._bytes -= entry.nbytes
+        for block_hash in entry.hashes:
+            if self._index.get(block_hash) == entry_id:
+                del self._index[block_hash]
+        # Префиксы удалённой записи могут быть у других записей
+        for other_id, other in self._entries.items():
+            for block_hash in other.hashes:
+                self._index.setdefault(block_hash, other_id)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._index.clear()
+            self._bytes = 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Состояние кэша для /api/health"""
+        with self._lock:
+            total = self.stats['tokens_reused'] + self.stats['tokens_prefilled']
+            return {
+                **self.stats,
+                'entries': len(self._entries),
+                'memory_mb': round(self._bytes / (1024 * 1024), 1),
+                'reuse_ratio': round(self.stats['tokens_reused'] / total, 3) if total else 0.0,
+            }
@@ -0,0 +1,157 @@
+"""
+Кэш стартовых проверок провайдера (список моделей, возможности модели)
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ProbeCache:
+    """
+    Результаты сетевых проверок при создании агента
+
+    Значения хранятся в JSON-файле с временем жизни ttl, поэтому повторный
+    запуск (в том числе перезагрузка агента после сохранения настроек в
+    веб-интерфейсе) обходится без сети. Одинаковые проверки, запущенные
+    параллельно, выполняются один раз: второй вызов ждёт результата первого.
+    Сохраняются только успешные результаты (не None).
+    """
+
+    def __init__(self, path: Optional[str] = "./cache/probes.json", ttl: float = 600):
+        """
+        Args:
+            path: Путь к JSON-файлу (None - только в памяти процесса)
+            ttl: Время жизни результата (секунды)
+        """
+        self.path = Path(path) if path else None
+        self.ttl = ttl
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._inflight: Dict[str, threading.Event] = {}
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'shared': 0}
+        self._load()
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> 'ProbeCache':
+        """Создать из секции probe_cache (выключенный кэш не пишет на диск и не переживает перезапуск)"""
+        probe_config = config.get('probe_cache', {}) or {}
+        if not probe_config.get('enabled', True):
+            return cls(path=None)
+        return cls(
+            path=probe_config.get('path', './cache/probes.json'),
+            ttl=probe_config.get('ttl', 600),
+        )
+
+    @staticmethod
+    def key(*parts: Any) -> str:
+        return "|".join(str(part) for part in parts)
+
+    def _load(self):
+        if self.path is None or not self.path.exists():
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self._entries = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.debug(f"Кэш проверок не прочитан: {e}")
+            self._entries = {}
+
+    def _save(self):
+        """Атомарная запись файла (вызывается под блокировкой)"""
+        if self.path is None:
+            return
+        now = time.time()
+        entries = {k: v for k, v in self._entries.items() if now - v['time'] < self.ttl}
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_suffix(self.path.suffix + '.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(entries, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.debug(f"Кэш проверок не сохранён: {e}")
+
+    def get(self, key: str) -> Optional[Any]:
+        """Свежее значение или None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry['time'] < self.ttl:
+                return entry['value']
+        return None
+
+    def put(self, key: str, value: Any):
+        if value is None:
+            return
+        with self._lock:
+            self._entries[key] = {'time': time.time(), 'value': value}
+            self._save()
+
+    def invalidate(self, key: str):
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self._save()
+
+    def fetch(self, key: str, probe: Callable[[], Optional[Any]], refresh: bool = False) -> Optional[Any]:
+        """
+        Значение из кэша или результат probe()
+
+        Args:
+            key: Ключ проверки (провайдер, адрес, модель)
+            probe: Сетевая проверка; None - неудача, такой результат не сохраняется
+            refresh: Игнорировать сохранённое значение
+        """
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if not refresh and entry is not None and time.time() - entry['time'] < self.ttl:
+                    self.stats['hits'] += 1
+                    return entry['value']
+                inflight = self._inflight.get(key)
+                if inflight is None:
+                    inflight = self._inflight[key] = threading.Event()
+                    self.stats['misses'] += 1
+                    break
+            # Такая же проверка уже выполняется - ждём её результат
+            self.stats['shared'] += 1
+            inflight.wait()
+            refresh = False
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and time.time() - entry['time'] < self.ttl:
+                    return entry['value']
+                if key in self._inflight:
+                    continue
+            return None
+
+        value = None
+        try:
+            value = probe()
+            return value
+        finally:
+            with self._lock:
+                if value is not None:
+                    self._entries[key] = {'time': time.time(), 'value': value}
+                    self._save()
+                self._inflight.pop(key).set()
+
+    def prefetch(self, key: str, probe: Callable[[], Optional[Any]]):
+        """Запустить fetch() в фоновом потоке (результат заберёт следующий fetch())"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if (entry is not None and time.time() - entry['time'] < self.ttl) or key in self._inflight:
+                return
+
+        def run():
+            try:
+                self.fetch(key, probe)
+            except Exception as e:
+                logger.debug(f"Фоновая проверка {key}: {e}")
+
+        threading.Thread(target=run, name="startup-probe", daemon=True).start()
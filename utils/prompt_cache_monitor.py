@@ -0,0 +1,146 @@
+"""
+Доля промпта, которую сервер может взять из своего кэша префиксов
+"""
+
+import logging
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Промпт без сообщений: (роль, текст) каждого сообщения
+PromptSnapshot = List[Tuple[str, str]]
+
+
+def snapshot(messages: List[Dict]) -> PromptSnapshot:
+    return [(message.get('role', ''), message.get('content') or '') for message in messages]
+
+
+def _common_prefix_length(a: str, b: str) -> int:
+    """Длина общего начала строк (двоичный поиск, сравнение срезов)"""
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[:middle] == b[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def common_prefix_tokens(
+    previous: PromptSnapshot,
+    current: PromptSnapshot,
+    count: Callable[[str], int],
+    message_overhead: int = 0
+) -> int:
+    """
+    Токены общего начала двух промптов
+
+    Одинаковые сообщения в начале учитываются целиком, у первого
+    отличающегося сообщения той же роли - общее начало текста.
+    """
+    tokens = 0
+    for (prev_role, prev_content), (role, content) in zip(previous, current):
+        if prev_role != role:
+            break
+        if prev_content == content:
+            tokens += count(content) + message_overhead
+            continue
+        length = _common_prefix_length(prev_content, content)
+        if length:
+            tokens += count(content[:length]) + message_overhead
+        break
+    return tokens
+
+
+class PromptCacheMonitor:
+    """
+    Учёт повторного использования префикса промпта
+
+    Для каждого запроса сравнивается промпт с предыдущим промптом той же
+    сессии: общее начало - то, что сервер (Ollama, LM Studio, llama.cpp)
+    может взять из KV-кэша (ожидаемое попадание). Если провайдер сообщает,
+    сколько токенов взято из кэша (usage.prompt_tokens_details.cached_tokens,
+    timings.cache_n llama.cpp) или вычислил меньше токенов, чем в промпте
+    (prompt_eval_count старых версий Ollama), это фактическое попадание.
+    Время разбора промпта (prompt_eval_duration Ollama) сохраняется рядом:
+    при попадании в кэш скорость разбора заметно выше.
+    """
+
+    def __init__(self, partial_ratio: float = 0.7):
+        """
+        Args:
+            partial_ratio: Отчёт провайдера меньше этой доли оценки промпта
+                считается числом вычисленных токенов без кэша
+        """
+        self.partial_ratio = partial_ratio
+        self._lock = threading.Lock()
+        self.stats = {
+            'requests': 0,
+            'prompt_tokens': 0,
+            'expected_cached_tokens': 0,
+            'reported_requests': 0,
+            'reported_prompt_tokens': 0,
+            'reported_cached_tokens': 0,
+        }
+        self.last: Optional[Dict[str, Any]] = None
+
+    def cached_tokens(self, prompt_tokens: int, usage: Optional[Dict[str, int]]) -> Optional[int]:
+        """Токены из кэша по отчёту провайдера (None - провайдер не сообщил)"""
+        if not usage:
+            return None
+        if 'cached_tokens' in usage:
+            return usage['cached_tokens']
+        reported = usage.get('prompt_tokens', 0)
+        if reported and reported < prompt_tokens * self.partial_ratio:
+            return prompt_tokens - reported
+        return None
+
+    def observe(self, prompt_tokens: int, expected_cached: int, usage: Optional[Dict[str, int]]) -> Optional[int]:
+        """
+        Учесть запрос
+
+        Args:
+            prompt_tokens: Оценка токенов промпта
+            expected_cached: Токены общего начала с предыдущим промптом сессии
+            usage: Расход токенов, который сообщил провайдер
+
+        Returns:
+            Токены из кэша по отчёту провайдера (None - неизвестно)
+        """
+        cached = self.cached_tokens(prompt_tokens, usage)
+        with self._lock:
+            self.stats['requests'] += 1
+            self.stats['prompt_tokens'] += prompt_tokens
+            self.stats['expected_cached_tokens'] += expected_cached
+            if cached is not None:
+                self.stats['reported_requests'] += 1
+                self.stats['reported_prompt_tokens'] += prompt_tokens
+                self.stats['reported_cached_tokens'] += cached
+            self.last = {
+                'prompt_tokens': prompt_tokens,
+                'expected_cached_tokens': expected_cached,
+                'cached_tokens': cached,
+                'prompt_eval_ms': (usage or {}).get('prompt_eval_ms'),
+            }
+        message = f"Префикс промпта: ожидается из кэша {expected_cached}/{prompt_tokens} токенов"
+        if cached is not None:
+            message += f", по данным провайдера {cached}"
+        if (usage or {}).get('prompt_eval_ms') is not None:
+            message += f", разбор промпта {usage['prompt_eval_ms']}мс"
+        logger.info(message)
+        return cached
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Доли попаданий для /api/health"""
+        with self._lock:
+            stats = dict(self.stats)
+            stats['expected_hit_ratio'] = round(
+                stats['expected_cached_tokens'] / stats['prompt_tokens'], 3
+            ) if stats['prompt_tokens'] else None
+            stats['reported_hit_ratio'] = round(
+                stats['reported_cached_tokens'] / stats['reported_prompt_tokens'], 3
+            ) if stats['reported_prompt_tokens'] else None
+            stats['last'] = self.last
+            return stats
@@ -0,0 +1,204 @@
+"""
+Кэш ответов модели для детерминированных запросов (низкая температура)
+"""
+
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """
+    Двухуровневый кэш ответов: LRU в памяти + SQLite на диске
+
+    Ключ - хэш канонического JSON из модели, параметров генерации и полного
+    списка сообщений. Значение - список чанков ответа, поэтому попадание в кэш
+    стримится так же, как живой ответ. Записи живут ttl секунд; при превышении
+    max_disk_mb удаляются давно не использовавшиеся.
+    """
+
+    def __init__(
+        self,
+        path: str = "./cache/responses.sqlite",
+        memory_entries: int = 256,
+        max_disk_mb: float = 100,
+        ttl: float = 86400,
+        max_temperature: float = 0.0
+    ):
+        """
+        Args:
+            path: Путь к файлу SQLite
+            memory_entries: Количество записей в памяти
+            max_disk_mb: Максимальный размер данных на диске (МБ)
+            ttl: Время жизни записи (секунды)
+            max_temperature: Запросы с более высокой температурой не кэшируются
+                (0 - только жадное декодирование: при сэмплировании повтор должен давать новый ответ)
+        """
+        self.path = Path(path)
+        self.memory_entries = memory_entries
+        self.max_disk_bytes = int(max_disk_mb * 1024 * 1024)
+        self.ttl = ttl
+        self.max_temperature = max_temperature
+        self._memory: 'OrderedDict[str, tuple]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'bypassed': 0, 'stores': 0, 'evictions': 0}
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, chunks TEXT NOT NULL, size INTEGER NOT NULL, "
+            "created REAL NOT NULL, expires REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_responses_access ON responses(last_access)")
+        self._db.commit()
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> Optional['ResponseCache']:
+        """Создать кэш из секции cache конфигурации (None если кэш выключен)"""
+        cache_config = config.get('cache', {}) or {}
+        if not cache_config.get('enabled', False):
+            return None
+        try:
+            return cls(
+                path=cache_config.get('path', './cache/responses.sqlite'),
+                memory_entries=cache_config.get('memory_entries', 256),
+                max_disk_mb=cache_config.get('max_disk_mb', 100),
+                ttl=cache_config.get('ttl', 86400),
+                max_temperature=cache_config.get('max_temperature', 0.0),
+            )
+        except (sqlite3.Error, OSError) as e:
+            logger.warning(f"Кэш ответов недоступен: {e}")
+            return None
+
+    def is_cacheable(self, temperature: Optional[float]) -> bool:
+        """Детерминированный ли запрос (сэмплирующие температуры кэш обходят)"""
+        if temperature is None or temperature > self.max_temperature:
+            with self._lock:
+                self.stats['bypassed'] += 1
+            return False
+        return True
+
+    @staticmethod
+    def make_key(model: str, params: Dict[str, Any], messages: List[Dict]) -> str:
+        """Канонический хэш модели, параметров генерации и сообщений"""
+        canonical = json.dumps(
+            {
+                'model': model,
+                'params': params,
+                # Только значимые поля: timestamp и прочие метаданные не влияют на ответ
+                'messages': [{'role': m.get('role'), 'content': m.get('content')} for m in messages],
+            },
+            sort_keys=True,
+            ensure_ascii=False,
+            separators=(',', ':'),
+        )
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[List[str]]:
+        """Получить чанки ответа по ключу (None при промахе)"""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                chunks, expires = entry
+                if expires > now:
+                    self._memory.move_to_end(key)
+                    self.stats['hits'] += 1
+                    self.stats['memory_hits'] += 1
+                    return list(chunks)
+                del self._memory[key]
+
+            try:
+                row = self._db.execute(
+                    "SELECT chunks, expires FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and row[1] > now:
+                    self._db.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+                    self._db.commit()
+                    chunks = json.loads(row[0])
+                    self._remember_locked(key, chunks, row[1])
+                    self.stats['hits'] += 1
+                    self.stats['disk_hits'] += 1
+                    return list(chunks)
+            except sqlite3.Error as e:
+                logger.warning(f"Ошибка чтения кэша ответов: {e}")
+
+            self.stats['misses'] += 1
+            return None
+
+    def put(self, key: str, chunks: List[str]):
+        """Сохранить чанки ответа"""
+        now = time.time()
+        expires = now + self.ttl
+        data = json.dumps(list(chunks), ensure_ascii=False)
+        with self._lock:
+            self._remember_locked(key, list(chunks), expires)
+            try:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses (key, chunks, size, created, expires, last_access) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, data, len(data.encode('utf-8')), now, expires, now)
+                )
+                self._evict_disk_locked(now)
+                self._db.commit()
+                self.stats['stores'] += 1
+            except sqlite3.Error as e:
+                logger.warning(f"Ошибка записи кэша ответов: {e}")
+
+    def _remember_locked(self, key: str, chunks: List[str], expires: float):
+        """Положить запись в LRU в памяти"""
+        self._memory[key] = (tuple(chunks), expires)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _evict_disk_locked(self, now: float):
+        """Удаление просроченных записей и вытеснение по размеру"""
+        self._db.execute("DELETE FROM responses WHERE expires <= ?", (now,))
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_disk_bytes:
+            return
+        rows = self._db.execute("SELECT key, size FROM responses ORDER BY last_access").fetchall()
+        for key, size in rows:
+            if total <= self.max_disk_bytes:
+                break
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._memory.pop(key, None)
+            total -= size
+            self.stats['evictions'] += 1
+
+    def clear(self):
+        """Очистить кэш"""
+        with self._lock:
+            self._memory.clear()
+            try:
+                self._db.execute("DELETE FROM responses")
+                self._db.commit()
+            except sqlite3.Error as e:
+                logger.warning(f"Ошибка очистки кэша ответов: {e}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Счётчики попаданий и промахов"""
+        with self._lock:
+            stats = dict(self.stats)
+            stats['memory_entries'] = len(self._memory)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 3) if lookups else 0.0
+        return stats
+
+    def close(self):
+        """Закрыть базу данных"""
+        with self._lock:
+            try:
+                self._db.close()
+            except sqlite3.Error:
+                pass
@@ -0,0 +1,327 @@
+"""
+Политика повторов (экспоненциальная задержка с джиттером) и circuit breaker
+для запросов к провайдерам моделей
+"""
+
+import time
+import random
+import asyncio
+import logging
+import threading
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+# Состояния circuit breaker
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Запрос отклонён без обращения к серверу: бэкенд считается недоступным"""
+
+    def __init__(self, retry_in: float):
+        self.retry_in = retry_in
+        super().__init__(
+            f"Сервер модели временно недоступен (несколько ошибок подряд). "
+            f"Следующая попытка подключения через {retry_in:.0f}с"
+        )
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker: после failure_threshold ошибок подряд запросы отклоняются
+    сразу (open). Через reset_timeout секунд пропускается один пробный запрос
+    (half_open): успех закрывает цепь, ошибка снова открывает её.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30, name: str = ""):
+        """
+        Args:
+            failure_threshold: Количество ошибок подряд до размыкания
+            reset_timeout: Сколько секунд отклонять запросы перед пробным
+            name: Имя бэкенда для логов
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.name = name
+        self.state = CIRCUIT_CLOSED
+        self.failures = 0
+        self.rejected = 0
+        self.opened_at: Optional[float] = None
+        self.transitions: deque = deque(maxlen=20)
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any], name: str = "") -> 'CircuitBreaker':
+        """Создать из секции retry конфигурации"""
+        retry_config = config.get('retry', {}) or {}
+        return cls(
+            failure_threshold=retry_config.get('breaker_threshold', 5),
+            reset_timeout=retry_config.get('breaker_reset_timeout', 30),
+            name=name,
+        )
+
+    def _transition_locked(self, state: str):
+        if state == self.state:
+            return
+        logger.warning(f"Circuit breaker {self.name}: {self.state} -> {state}")
+        self.transitions.append({'from': self.state, 'to': state, 'at': time.time()})
+        self.state = state
+        if state == CIRCUIT_OPEN:
+            self.opened_at = time.monotonic()
+        self._probe_in_flight = False
+
+    def before_request(self):
+        """
+        Проверка перед запросом
+
+        Raises:
+            CircuitOpenError: Цепь разомкнута (или пробный запрос уже выполняется)
+        """
+        with self._lock:
+            if self.state == CIRCUIT_CLOSED:
+                return
+            if self.state == CIRCUIT_OPEN:
+                remaining = self.reset_timeout - (time.monotonic() - self.opened_at)
+                if remaining > 0:
+                    self.rejected += 1
+                    raise CircuitOpenError(remaining)
+                self._transition_locked(CIRCUIT_HALF_OPEN)
+            # half_open: только один пробный запрос одновременно
+            if self._probe_in_flight:
+                self.rejected += 1
+                raise CircuitOpenError(1)
+            self._probe_in_flight = True
+
+    def cancel_request(self):
+        """Запрос прерван без результата (например, отменён клиентом)"""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._transition_locked(CIRCUIT_CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == CIRCUIT_HALF_OPEN or self.failures >= self.failure_threshold:
+                self._transition_locked(CIRCUIT_OPEN)
+
+    def get_status(self) -> Dict[str, Any]:
+        """Состояние для /api/health"""
+        with self._lock:
+            status = {
+                'state': self.state,
+                'consecutive_failures': self.failures,
+                'rejected': self.rejected,
+                'transitions': list(self.transitions),
+            }
+            if self.state == CIRCUIT_OPEN:
+                status['retry_in'] = round(max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at)), 1)
+            return status
+
+
+class RetryPolicy:
+    """
+    Политика повторов запросов к провайдеру
+
+    Повторяются только ошибки подключения, таймауты и статусы из
+    retry_statuses; задержка растёт экспоненциально со случайным джиттером
+    (full jitter), чтобы параллельные запросы не били в сервер одновременно.
+    Все попытки укладываются в общий deadline: таймаут попытки и паузы
+    ограничиваются оставшимся временем. Повтор возможен только до получения
+    ответа - оборванный посреди потока ответ не повторяется.
+    """
+
+    DEFAULT_RETRY_STATUSES = (408, 425, 429, 500, 502, 503, 504)
+
+    def __init__(
+        self,
+        max_attempts: int = 4,
+        base_delay: float = 0.5,
+        max_delay: float = 10,
+        deadline: float = 300,
+        retry_statuses: Iterable[int] = DEFAULT_RETRY_STATUSES
+    ):
+        """
+        Args:
+            max_attempts: Максимум попыток (включая первую)
+            base_delay: Базовая задержка перед повтором (секунды)
+            max_delay: Максимальная задержка перед повтором
+            deadline: Общий лимит времени на все попытки
+            retry_statuses: HTTP-статусы, при которых запрос повторяется
+        """
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.retry_statuses = frozenset(retry_statuses)
+        self.stats = {'requests': 0, 'retries': 0, 'gave_up': 0}
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> 'RetryPolicy':
+        """Создать из секции retry конфигурации"""
+        retry_config = config.get('retry', {}) or {}
+        return cls(
+            max_attempts=retry_config.get('max_attempts', 4),
+            base_delay=retry_config.get('base_delay', 0.5),
+            max_delay=retry_config.get('max_delay', 10),
+            deadline=retry_config.get('deadline', 300),
+            retry_statuses=retry_config.get('retry_statuses', cls.DEFAULT_RETRY_STATUSES),
+        )
+
+    def backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """Задержка перед повтором номер attempt (с нуля)"""
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    @staticmethod
+    def _status(response) -> int:
+        """HTTP-статус ответа requests или aiohttp"""
+        status = getattr(response, 'status_code', None)
+        return status if status is not None else response.status
+
+    @staticmethod
+    def _retry_after(response) -> Optional[float]:
+        """Значение заголовка Retry-After в секундах (если задано числом)"""
+        try:
+            return float(response.headers.get('Retry-After'))
+        except (TypeError, ValueError):
+            return None
+
+    def _next_delay(self, attempt: int, started: float, response=None) -> Optional[float]:
+        """Задержка перед следующей попыткой или None, если повторять нельзя"""
+        if attempt + 1 >= self.max_attempts:
+            return None
+        retry_after = self._retry_after(response) if response is not None else None
+        delay = self.backoff(attempt, retry_after)
+        if time.monotonic() - started + delay >= self.deadline:
+            return None
+        return delay
+
+    def _attempt_timeout(self, timeout: float, started: float) -> float:
+        """Таймаут попытки, ограниченный оставшимся временем"""
+        return max(1.0, min(timeout, self.deadline - (time.monotonic() - started)))
+
+    def _on_response(self, response, breaker: Optional[CircuitBreaker]) -> bool:
+        """Учёт ответа в breaker; True если статус стоит повторить"""
+        retryable = self._status(response) in self.retry_statuses
+        if breaker is not None:
+            if retryable:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+        return retryable
+
+    def call(
+        self,
+        send: Callable[[float], Any],
+        timeout: float,
+        errors: tuple,
+        breaker: Optional[CircuitBreaker] = None,
+        describe: str = "запрос"
+    ):
+        """
+        Выполнить запрос с повторами
+
+        Args:
+            send: Отправляет запрос с заданным таймаутом и возвращает ответ
+            timeout: Таймаут одной попытки
+            errors: Исключения, которые считаются сбоем сети и повторяются
+            breaker: Circuit breaker бэкенда
+            describe: Описание запроса для логов
+
+        Returns:
+            Ответ последней попытки (статус может быть ошибочным)
+
+        Raises:
+            CircuitOpenError: Бэкенд недоступен, запрос не отправлялся
+        """
+        self.stats['requests'] += 1
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            if breaker is not None:
+                breaker.before_request()
+            try:
+                response = send(self._attempt_timeout(timeout, started))
+            except errors as e:
+                if breaker is not None:
+                    breaker.record_failure()
+                delay = self._next_delay(attempt, started)
+                if delay is None:
+                    self.stats['gave_up'] += 1
+                    raise
+                logger.info(f"{describe}: {e}; повтор через {delay:.1f}с (попытка {attempt + 2}/{self.max_attempts})")
+            except BaseException:
+                # Отмена или непредвиденная ошибка - результат попытки неизвестен
+                if breaker is not None:
+                    breaker.cancel_request()
+                raise
+            else:
+                if not self._on_response(response, breaker):
+                    return response
+                delay = self._next_delay(attempt, started, response)
+                if delay is None:
+                    self.stats['gave_up'] += 1
+                    return response
+                logger.info(f"{describe}: HTTP {self._status(response)}; повтор через {delay:.1f}с (попытка {attempt + 2}/{self.max_attempts})")
+                response.close()
+            self.stats['retries'] += 1
+            attempt += 1
+            time.sleep(delay)
+
+    async def acall(
+        self,
+        send: Callable[[float], Awaitable[Any]],
+        timeout: float,
+        errors: tuple,
+        breaker: Optional[CircuitBreaker] = None,
+        describe: str = "запрос"
+    ):
+        """Асинхронный вариант call (send - корутина)"""
+        self.stats['requests'] += 1
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            if breaker is not None:
+                breaker.before_request()
+            try:
+                response = await send(self._attempt_timeout(timeout, started))
+            except errors as e:
+                if breaker is not None:
+                    breaker.record_failure()
+                delay = self._next_delay(attempt, started)
+                if delay is None:
+                    self.stats['gave_up'] += 1
+                    raise
+                logger.info(f"{describe}: {e}; повтор через {delay:.1f}с (попытка {attempt + 2}/{self.max_attempts})")
+            except BaseException:
+                # Отмена или непредвиденная ошибка - результат попытки неизвестен
+                if breaker is not None:
+                    breaker.cancel_request()
+                raise
+            else:
+                if not self._on_response(response, breaker):
+                    return response
+                delay = self._next_delay(attempt, started, response)
+                if delay is None:
+                    self.stats['gave_up'] += 1
+                    return response
+                logger.info(f"{describe}: HTTP {self._status(response)}; повтор через {delay:.1f}с (попытка {attempt + 2}/{self.max_attempts})")
+                response.close()
+            self.stats['retries'] += 1
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    def get_stats(self) -> Dict[str, int]:
+        """Счётчики повторов"""
+        return dict(self.stats)
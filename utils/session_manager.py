@@ -0,0 +1,267 @@
+"""
+Менеджер сессий веб-интерфейса: отдельная история на вкладку браузера
+"""
+
+import sys
+import time
+import uuid
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Session:
+    """Сессия пользователя"""
+    session_id: str
+    agent: Any
+    created_at: float = field(default_factory=time.time)
+    last_access: float = field(default_factory=time.time)
+    memory_bytes: int = 0
+    # Запросы одной сессии выполняются по очереди, разные сессии - параллельно
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    # Агент создан прежним базовым агентом (настройки сохранены во время запроса)
+    stale: bool = False
+
+    @property
+    def busy(self) -> bool:
+        return self.lock.locked()
+
+
+def estimate_history_memory(history: List[Dict]) -> int:
+    """Примерный объём памяти, занимаемый историей диалога (в байтах)"""
+    total = sys.getsizeof(history)
+    for msg in history:
+        total += sys.getsizeof(msg)
+        for value in msg.values():
+            total += sys.getsizeof(value)
+    return total
+
+
+class SessionManager:
+    """
+    Хранилище сессий с LRU-вытеснением
+
+    Каждая сессия получает лёгкую копию агента (CodeAgent.fork_session):
+    пул соединений, адаптер модели, контекст проекта и MCP-инструменты общие,
+    своя только история. Сессии вытесняются по простою, по количеству и по
+    суммарному объёму истории; занятые (генерирующие) сессии не вытесняются.
+    """
+
+    def __init__(
+        self,
+        factory: Callable[[], Any],
+        max_sessions: int = 500,
+        idle_timeout: float = 3600,
+        max_memory_mb: float = 256
+    ):
+        """
+        Args:
+            factory: Создаёт агента для новой сессии
+            max_sessions: Максимальное количество сессий
+            idle_timeout: Время простоя (сек), после которого сессия удаляется
+            max_memory_mb: Лимит суммарного объёма истории всех сессий (МБ)
+        """
+        self.factory = factory
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.max_memory_bytes = int(max_memory_mb * 1024 * 1024)
+        self._sessions: 'OrderedDict[str, Session]' = OrderedDict()
+        self._lock = threading.Lock()
+        # Прежние базовые агенты и id сессий, которые ещё работают с ними
+        self._retired: List[Tuple[Any, Set[str]]] = []
+        # Задачи закрытия асинхронных соединений прежних агентов (ссылки, чтобы их не собрал GC)
+        self._closing: Set[asyncio.Task] = set()
+        self.evicted = 0
+
+    @classmethod
+    def from_config(cls, factory: Callable[[], Any], config: Dict) -> 'SessionManager':
+        """Создать менеджер из секции sessions конфигурации"""
+        sessions_config = config.get('sessions', {}) or {}
+        return cls(
+            factory,
+            max_sessions=sessions_config.get('max_sessions', 500),
+            idle_timeout=sessions_config.get('idle_timeout', 3600),
+            max_memory_mb=sessions_config.get('max_memory_mb', 256),
+        )
+
+    @staticmethod
+    def new_session_id() -> str:
+        return uuid.uuid4().hex
+
+    def get_or_create(self, session_id: Optional[str] = None) -> Tuple[Session, bool]:
+        """
+        Получить сессию по id или создать новую
+
+        Returns:
+            (сессия, создана ли новая)
+        """
+        with self._lock:
+            session = self._sessions.get(session_id) if session_id else None
+            if session is not None:
+                session.last_access = time.time()
+                self._sessions.move_to_end(session.session_id)
+                return session, False
+
+            session = Session(session_id=session_id or self.new_session_id(), agent=self.factory())
+            session.agent.session_id = session.session_id
+            self._sessions[session.session_id] = session
+            self._evict_locked()
+            retired = self._release_locked()
+            logger.debug(f"Создана сессия {session.session_id} (всего {len(self._sessions)})")
+        self._shutdown(retired)
+        return session, True
+
+    def agent_for(self, session: Session) -> Any:
+        """
+        Агент сессии для очередного запроса (вызывать под session.lock)
+
+        Устаревший агент пересоздаётся здесь, когда запрос, шедший во время
+        сохранения настроек, уже завершён и записал ответ в историю.
+        """
+        with self._lock:
+            if session.stale:
+                self._refork_locked(session)
+            retired = self._release_locked()
+        self._shutdown(retired)
+        return session.agent
+
+    def touch(self, session: Session):
+        """Обновить время доступа и объём истории после запроса"""
+        with self._lock:
+            if session.stale and not session.busy:
+                self._refork_locked(session)
+            session.last_access = time.time()
+            session.memory_bytes = estimate_history_memory(session.agent.history)
+            if session.session_id in self._sessions:
+                self._sessions.move_to_end(session.session_id)
+            self._evict_locked()
+            retired = self._release_locked()
+        self._shutdown(retired)
+
+    def remove(self, session_id: str):
+        """Удалить сессию"""
+        with self._lock:
+            self._sessions.pop(session_id, None)
+            self._forget_locked(session_id)
+            retired = self._release_locked()
+        self._shutdown(retired)
+
+    def rebind(self, factory: Callable[[Optional[List[Dict]]], Any], retired: Any = None):
+        """
+        Пересоздать агентов всех сессий с сохранением истории
+
+        Используется после перезагрузки базового агента (сохранение настроек).
+        Свободные сессии пересоздаются сразу. Занятые дописывают текущий ответ
+        в историю прежнего агента и пересоздаются после запроса (touch) или
+        перед следующим (agent_for). Прежний базовый агент (retired)
+        останавливается, когда с ним не работает ни одна сессия.
+        """
+        with self._lock:
+            self.factory = factory
+            users = set()
+            for session in self._sessions.values():
+                if not session.busy:
+                    self._refork_locked(session)
+                elif not session.stale:
+                    session.stale = True
+                    users.add(session.session_id)
+            if retired is not None:
+                self._retired.append((retired, users))
+            stopped = self._release_locked()
+        self._shutdown(stopped)
+
+    def _refork_locked(self, session: Session):
+        """Новый агент сессии от текущей фабрики (под self._lock)"""
+        session.agent = self.factory(session.agent.history)
+        session.agent.session_id = session.session_id
+        if session.stale:
+            session.stale = False
+            self._forget_locked(session.session_id)
+
+    def _forget_locked(self, session_id: str):
+        for _, users in self._retired:
+            users.discard(session_id)
+
+    def _release_locked(self) -> List[Any]:
+        """Прежние базовые агенты, которые больше не нужны ни одной сессии (под self._lock)"""
+        released = [agent for agent, users in self._retired if not users]
+        self._retired = [(agent, users) for agent, users in self._retired if users]
+        return released
+
+    def _shutdown(self, agents: List[Any]):
+        """Остановить прежних агентов и закрыть их асинхронные соединения"""
+        for agent in agents:
+            try:
+                agent.shutdown()
+            except Exception as e:
+                logger.warning(f"Ошибка остановки прежнего агента: {e}")
+            self._aclose(agent)
+
+    def _aclose(self, agent: Any):
+        """
+        Закрыть асинхронный клиент агента
+
+        Сессия aiohttp привязана к event loop веб-сервера, поэтому закрытие
+        планируется в текущем loop; вне loop (CLI, скрипты) выполняется сразу.
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if loop is None:
+            try:
+                asyncio.run(agent.aclose())
+            except Exception as e:
+                logger.warning(f"Ошибка закрытия соединений прежнего агента: {e}")
+            return
+        task = loop.create_task(agent.aclose())
+        self._closing.add(task)
+        task.add_done_callback(self._closed)
+
+    def _closed(self, task: asyncio.Task):
+        self._closing.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"Ошибка закрытия соединений прежнего агента: {task.exception()}")
+
+    def _evict_locked(self):
+        """Вытеснение по простою, количеству и памяти (под self._lock)"""
+        now = time.time()
+        for session_id, session in list(self._sessions.items()):
+            if not session.busy and now - session.last_access > self.idle_timeout:
+                del self._sessions[session_id]
+                self._forget_locked(session_id)
+                self.evicted += 1
+
+        # Самые давно использованные сессии - в начале OrderedDict
+        total_memory = sum(s.memory_bytes for s in self._sessions.values())
+        for session_id, session in list(self._sessions.items()):
+            if len(self._sessions) <= self.max_sessions and total_memory <= self.max_memory_bytes:
+                break
+            if session.busy:
+                continue
+            del self._sessions[session_id]
+            self._forget_locked(session_id)
+            total_memory -= session.memory_bytes
+            self.evicted += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Статистика сессий"""
+        with self._lock:
+            return {
+                'active': len(self._sessions),
+                'busy': sum(1 for s in self._sessions.values() if s.busy),
+                'stale': sum(1 for s in self._sessions.values() if s.stale),
+                'retired_agents': len(self._retired),
+                'memory_bytes': sum(s.memory_bytes for s in self._sessions.values()),
+                'max_sessions': self.max_sessions,
+                'evicted': self.evicted,
+            }
+
+    def __len__(self) -> int:
+        return len(self._sessions)
@@ -0,0 +1,176 @@
+"""
+Инкрементальный декодер потоковых ответов провайдеров (NDJSON и SSE)
+"""
+
+import json
+import time
+import logging
+from typing import Any, Dict, List, Optional
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+    FAST_JSON_AVAILABLE = True
+except ImportError:
+    _json_loads = json.loads
+    FAST_JSON_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+# Форматы потоков
+NDJSON = "ndjson"  # Ollama: один JSON-объект на строку
+SSE = "sse"  # OpenAI-совместимые API: строки "data: {...}", завершение "data: [DONE]"
+
+
+class StreamDecoder:
+    """
+    Декодер потока, работающий с байтовыми чанками
+
+    Чанки сети могут разрезать строку в любом месте - неполный хвост остаётся
+    в буфере до следующего feed(). Строки не декодируются в str: JSON
+    разбирается прямо из буфера (через orjson, если он установлен), а
+    служебные строки SSE отбрасываются по префиксу без разбора.
+    """
+
+    def __init__(self, fmt: str = SSE, allow_raw: bool = False):
+        """
+        Args:
+            fmt: Формат потока (NDJSON или SSE)
+            allow_raw: Для SSE - принимать строки без префикса "data:"
+                       (JSON или просто текст, как у некоторых версий LM Studio)
+        """
+        self.fmt = fmt
+        self.allow_raw = allow_raw
+        self.done = False
+        self.last_event: Optional[Dict[str, Any]] = None
+        self._buffer = bytearray()
+        self._started = time.perf_counter()
+        self._parse_seconds = 0.0
+        self._bytes = 0
+        self._frames = 0
+        self._chunks = 0
+        self._errors = 0
+
+    def feed(self, chunk: bytes) -> List[str]:
+        """
+        Добавить чанк из сети
+
+        Returns:
+            Фрагменты текста, полностью полученные к этому моменту
+        """
+        if self.done or not chunk:
+            return []
+
+        started = time.perf_counter()
+        self._bytes += len(chunk)
+        self._chunks += 1
+
+        buffer = self._buffer
+        buffer += chunk
+        contents: List[str] = []
+        start = 0
+        while not self.done:
+            end = buffer.find(b'\n', start)
+            if end == -1:
+                break
+            self._parse_line(buffer, start, end, contents)
+            start = end + 1
+
+        if self.done:
+            buffer.clear()
+        elif start:
+            del buffer[:start]
+
+        self._parse_seconds += time.perf_counter() - started
+        return contents
+
+    def finish(self) -> List[str]:
+        """Разобрать остаток буфера после закрытия потока"""
+        contents: List[str] = []
+        if self._buffer and not self.done:
+            started = time.perf_counter()
+            self._parse_line(self._buffer, 0, len(self._buffer), contents)
+            self._buffer.clear()
+            self._parse_seconds += time.perf_counter() - started
+        return contents
+
+    def _parse_line(self, buffer: bytearray, start: int, end: int, contents: List[str]):
+        """Разбор одной строки buffer[start:end]"""
+        # Пропускаем пробелы и \r по краям без копирования
+        while start < end and buffer[start] in b' \t\r':
+            start += 1
+        while end > start and buffer[end - 1] in b' \t\r':
+            end -= 1
+        if start == end:
+            return
+
+        if self.fmt == NDJSON:
+            data = self._loads(buffer, start, end)
+            if data is None:
+                return
+            self._frames += 1
+            self.last_event = data
+            message = data.get('message')
+            if message and message.get('content'):
+                contents.append(message['content'])
+            if data.get('done', False):
+                self.done = True
+            return
+
+        # SSE
+        if buffer.startswith(b'data:', start, end):
+            start += 5
+            if start < end and buffer[start] == 0x20:
+                start += 1
+            if buffer.startswith(b'[DONE]', start, end):
+                self.done = True
+                return
+            data = self._loads(buffer, start, end)
+        elif buffer[start] == 0x3A:  # ':' - комментарий / keep-alive
+            return
+        elif self.allow_raw:
+            data = self._loads(buffer, start, end)
+            if data is None:
+                # Не JSON - возможно, это просто текст
+                contents.append(bytes(buffer[start:end]).decode('utf-8', errors='replace'))
+                return
+        else:
+            # event:, id:, retry: и прочие служебные поля
+            return
+
+        if data is None:
+            return
+        self._frames += 1
+        self.last_event = data
+        choices = data.get('choices')
+        if choices:
+            content = (choices[0].get('delta') or {}).get('content')
+            if content:
+                contents.append(content)
+
+    def _loads(self, buffer: bytearray, start: int, end: int) -> Optional[Dict[str, Any]]:
+        """Разбор JSON из buffer[start:end] (None при ошибке)"""
+        try:
+            if FAST_JSON_AVAILABLE:
+                data = _json_loads(memoryview(buffer)[start:end])
+            else:
+                data = _json_loads(bytes(buffer[start:end]))
+        except ValueError:
+            self._errors += 1
+            return None
+        return data if isinstance(data, dict) else None
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Статистика разбора потока"""
+        elapsed = time.perf_counter() - self._started
+        return {
+            'format': self.fmt,
+            'fast_json': FAST_JSON_AVAILABLE,
+            'bytes': self._bytes,
+            'chunks': self._chunks,
+            'frames': self._frames,
+            'parse_errors': self._errors,
+            'parse_ms': round(self._parse_seconds * 1000, 3),
+            'parse_us_per_frame': round(self._parse_seconds * 1e6 / self._frames, 2) if self._frames else 0.0,
+            'parse_overhead_pct': round(self._parse_seconds * 100 / elapsed, 3) if elapsed > 0 else 0.0,
+        }
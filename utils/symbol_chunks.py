@@ -0,0 +1,364 @@
+"""
+Разбиение файлов проекта на смысловые фрагменты (функции, классы, разделы)
+для поиска по запросу
+"""
+
+import os
+import re
+import ast
+import json
+import math
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import cached_property
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Версия разбиения: таблицы в кэше с другой версией строятся заново
+CHUNKER_VERSION = 1
+
+PYTHON_SUFFIXES = {'.py', '.pyw'}
+SCRIPT_SUFFIXES = {'.js', '.jsx', '.mjs', '.cjs', '.ts', '.tsx'}
+MARKDOWN_SUFFIXES = {'.md', '.markdown'}
+
+PYTHON_DEFINITIONS = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+
+# Определения верхнего уровня JS/TS (с начала строки)
+SCRIPT_DEFINITION = re.compile(
+    r'^(?:export\s+(?:default\s+)?)?(?:declare\s+)?(?:abstract\s+)?(?:async\s+)?'
+    r'(?:function\s*\*?\s*(?P<function>[\w$]+)'
+    r'|class\s+(?P<class>[\w$]+)'
+    r'|(?:interface|type|enum)\s+(?P<type>[\w$]+)'
+    r'|(?:const|let|var)\s+(?P<variable>[\w$]+)\s*(?::[^=]+)?=\s*(?:async\s+)?(?:function\b|\([^)]*\)\s*(?::[^=]+)?=>|[\w$]+\s*=>))'
+)
+SCRIPT_LEADING = re.compile(r'^\s*(?://|/\*|\*|@)')
+MARKDOWN_HEADING = re.compile(r'^(#{1,6})\s+(.+?)\s*#*\s*$')
+WORD = re.compile(r'\w+')
+
+
+@dataclass
+class Chunk:
+    """
+    Фрагмент файла
+
+    Attributes:
+        name: Имя символа (функция, Класс.метод, заголовок раздела; '' - код вне определений)
+        kind: function, class, section, code
+        start: Первая строка (с 1)
+        end: Последняя строка (включительно)
+        text: Текст строк start..end
+    """
+    name: str
+    kind: str
+    start: int
+    end: int
+    text: str = ''
+
+    @property
+    def label(self) -> str:
+        return f"строки {self.start}-{self.end}" + (f": {self.name}" if self.name else "")
+
+    @cached_property
+    def lower_text(self) -> str:
+        return self.text.lower()
+
+
+Span = Tuple[int, int, str, str]
+
+
+def _span_chars(lines: List[str], start: int, end: int) -> int:
+    return sum(len(line) + 1 for line in lines[start - 1:end])
+
+
+def _python_start(node: ast.AST, lines: List[str]) -> int:
+    """Первая строка определения вместе с декораторами и комментариями над ним"""
+    start = min([node.lineno] + [decorator.lineno for decorator in node.decorator_list])
+    while start > 1 and lines[start - 2].lstrip().startswith('#'):
+        start -= 1
+    return start
+
+
+def _python_spans(nodes: List[ast.stmt], lines: List[str], prefix: str, max_chars: int, spans: List[Span]):
+    for node in nodes:
+        if not isinstance(node, PYTHON_DEFINITIONS):
+            continue
+        start = _python_start(node, lines)
+        name = prefix + node.name
+        kind = 'class' if isinstance(node, ast.ClassDef) else 'function'
+        if kind == 'class' and _span_chars(lines, start, node.end_lineno) > max_chars:
+            # Большой класс: заголовок отдельно, методы - своими фрагментами
+            methods = [child for child in node.body if isinstance(child, PYTHON_DEFINITIONS)]
+            if methods:
+                spans.append((start, _python_start(methods[0], lines) - 1, name, kind))
+                _python_spans(node.body, lines, name + '.', max_chars, spans)
+                continue
+        spans.append((start, node.end_lineno, name, kind))
+
+
+def python_spans(text: str, lines: List[str], max_chars: int) -> List[Span]:
+    """Функции и классы по синтаксическому дереву (SyntaxError - если файл не разбирается)"""
+    spans: List[Span] = []
+    _python_spans(ast.parse(text).body, lines, '', max_chars, spans)
+    return spans
+
+
+def script_spans(lines: List[str]) -> List[Span]:
+    """Определения верхнего уровня JS/TS: от определения до следующего"""
+    starts = []
+    for index, line in enumerate(lines):
+        match = SCRIPT_DEFINITION.match(line)
+        if match is None:
+            continue
+        start = index + 1
+        # Комментарии и декораторы над определением относятся к нему
+        while start > 1 and SCRIPT_LEADING.match(lines[start - 2]):
+            start -= 1
+        kind = 'class' if match.group('class') or match.group('type') else 'function'
+        name = next(group for group in match.groups() if group)
+        starts.append((start, name, kind))
+    return [
+        (start, (starts[number + 1][0] - 1) if number + 1 < len(starts) else len(lines), name, kind)
+        for number, (start, name, kind) in enumerate(starts)
+    ]
+
+
+def markdown_spans(lines: List[str]) -> List[Span]:
+    """Разделы по заголовкам (заголовки внутри блоков кода не учитываются)"""
+    starts = []
+    in_code = False
+    for index, line in enumerate(lines):
+        if line.lstrip().startswith('```'):
+            in_code = not in_code
+            continue
+        match = None if in_code else MARKDOWN_HEADING.match(line)
+        if match:
+            starts.append((index + 1, match.group(2)))
+    return [
+        (start, (starts[number + 1][0] - 1) if number + 1 < len(starts) else len(lines), name, 'section')
+        for number, (start, name) in enumerate(starts)
+    ]
+
+
+def _cover(spans: List[Span], lines: List[str]) -> List[Span]:
+    """Добавить фрагменты для строк вне определений (импорты, код модуля)"""
+    covered = []
+    line = 1
+    for start, end, name, kind in sorted(spans):
+        if start > line:
+            covered.append((line, start - 1, '', 'code'))
+        covered.append((start, end, name, kind))
+        line = max(line, end + 1)
+    if line <= len(lines):
+        covered.append((line, len(lines), '', 'code'))
+    return covered
+
+
+def _split_long(span: Span, lines: List[str], max_chars: int) -> List[Span]:
+    """Разделить слишком длинный фрагмент по строкам на примерно равные части не длиннее max_chars"""
+    start, end, name, kind = span
+    total = _span_chars(lines, start, end)
+    # Равные части вместо жадного заполнения: без коротких хвостов из одной строки
+    count = math.ceil(total / max_chars)
+    while True:
+        target = total / count
+        parts = []
+        size = 0
+        part_start = start
+        for line in range(start, end + 1):
+            length = len(lines[line - 1]) + 1
+            if size and (size + length > max_chars or size + length / 2 > target):
+                parts.append((part_start, line - 1, name, kind))
+                part_start, size = line, 0
+            size += length
+        parts.append((part_start, end, name, kind))
+        if len(parts) <= count:
+            return parts
+        count += 1
+
+
+def chunk_spans(file_name: str, text: str, max_chars: int = 2000) -> List[Span]:
+    """
+    Разбить текст файла на фрагменты
+
+    Python - функции и классы по синтаксическому дереву (большие классы - по
+    методам), JS/TS - определения верхнего уровня, Markdown - разделы по
+    заголовкам; остальные файлы и файлы с синтаксическими ошибками - части
+    по max_chars символов. Строки вне определений становятся фрагментами
+    вида code, фрагменты длиннее max_chars делятся по строкам.
+
+    Returns:
+        (первая строка, последняя строка, имя, вид) - строки с 1, включительно
+    """
+    lines = text.split('\n')
+    suffix = Path(file_name).suffix.lower()
+    spans: List[Span] = []
+    try:
+        if suffix in PYTHON_SUFFIXES:
+            spans = python_spans(text, lines, max_chars)
+        elif suffix in SCRIPT_SUFFIXES:
+            spans = script_spans(lines)
+        elif suffix in MARKDOWN_SUFFIXES:
+            spans = markdown_spans(lines)
+    except (SyntaxError, ValueError) as e:
+        logger.debug(f"Файл {file_name} не разобран, делится по строкам: {e}")
+        spans = []
+    result = []
+    for span in _cover(spans, lines):
+        start, end = span[0], span[1]
+        if not any(line.strip() for line in lines[start - 1:end]):
+            continue
+        result.extend(_split_long(span, lines, max_chars))
+    return result
+
+
+def query_keywords(query: str) -> List[str]:
+    """Слова запроса длиннее трёх символов (без повторов)"""
+    return list(dict.fromkeys(word for word in WORD.findall(query.lower()) if len(word) > 3))
+
+
+def keyword_weights(keywords: List[str], chunks: List[Chunk]) -> Dict[str, float]:
+    """Вес слова запроса: чем в меньшей доле фрагментов оно встречается, тем больше (IDF)"""
+    weights = {}
+    for keyword in keywords:
+        found = sum(1 for chunk in chunks if keyword in chunk.lower_text)
+        weights[keyword] = math.log(1 + len(chunks) / (1 + found))
+    return weights
+
+
+def score_chunk(chunk: Chunk, weights: Dict[str, float], file_name: str = '') -> float:
+    """
+    Оценка фрагмента для запроса
+
+    Слово запроса в имени символа весит больше всего, в имени файла - меньше,
+    вхождения в текст - логарифмически (первое вхождение важнее повторов);
+    всё умножается на вес слова (keyword_weights).
+    """
+    name = chunk.name.lower()
+    file_name = file_name.lower()
+    score = 0.0
+    for keyword, weight in weights.items():
+        points = 0.0
+        if keyword in name:
+            points += 5
+        if keyword in file_name:
+            points += 2
+        count = chunk.lower_text.count(keyword)
+        if count:
+            points += 1 + math.log(count)
+        score += points * weight
+    return score
+
+
+class ChunkIndex:
+    """
+    Таблицы фрагментов файлов проекта
+
+    Таблица файла (границы и имена фрагментов) строится один раз и
+    действует, пока не изменились время изменения и размер файла: при
+    повторном поиске разбираются только изменённые файлы. Таблицы
+    сохраняются в JSON-файле (переживают перезапуск), последние
+    memory_files файлов вместе с текстом фрагментов держатся в памяти.
+    """
+
+    def __init__(self, path: Optional[str] = None, max_chunk_chars: int = 2000, memory_files: int = 512):
+        """
+        Args:
+            path: Путь к JSON-файлу таблиц (None - только в памяти процесса)
+            max_chunk_chars: Наибольший размер фрагмента в символах
+            memory_files: Сколько файлов держать в памяти вместе с текстом
+        """
+        self.path = Path(path) if path else None
+        self.max_chunk_chars = max_chunk_chars
+        self.memory_files = memory_files
+        self._tables: Dict[str, Dict[str, Any]] = {}
+        self._memory: 'OrderedDict[str, Tuple[Tuple[int, int], List[Chunk]]]' = OrderedDict()
+        self._dirty = False
+        self._lock = threading.Lock()
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'chunked': 0, 'chunks': 0}
+        self._load()
+
+    def _load(self):
+        if self.path is None or not self.path.exists():
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.debug(f"Кэш фрагментов не прочитан: {e}")
+            return
+        if data.get('version') == CHUNKER_VERSION and data.get('max_chunk_chars') == self.max_chunk_chars:
+            self._tables = data.get('files', {})
+
+    def save(self):
+        """Атомарная запись таблиц, если они менялись (таблицы удалённых файлов отбрасываются)"""
+        with self._lock:
+            if self.path is None or not self._dirty:
+                return
+            tables = {key: table for key, table in self._tables.items() if os.path.exists(key)}
+            data = {'version': CHUNKER_VERSION, 'max_chunk_chars': self.max_chunk_chars, 'files': tables}
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = self.path.with_suffix(self.path.suffix + '.tmp')
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, ensure_ascii=False)
+                os.replace(tmp_path, self.path)
+                self._tables = tables
+                self._dirty = False
+            except OSError as e:
+                logger.debug(f"Кэш фрагментов не сохранён: {e}")
+
+    def chunks(self, path: Path, read: Callable[[], Optional[str]]) -> List[Chunk]:
+        """
+        Фрагменты файла
+
+        Args:
+            path: Абсолютный путь к файлу
+            read: Чтение текста файла (None - файл не читается)
+        """
+        key = str(path)
+        try:
+            stat = path.stat()
+        except OSError:
+            return []
+        version = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._memory.get(key)
+            if cached is not None and cached[0] == version:
+                self._memory.move_to_end(key)
+                self.stats['memory_hits'] += 1
+                return cached[1]
+            table = self._tables.get(key)
+        text = read()
+        if text is None:
+            return []
+        lines = text.split('\n')
+        if table is not None and (table['mtime_ns'], table['size']) == version:
+            spans = [tuple(span) for span in table['chunks']]
+            counter = 'disk_hits'
+        else:
+            spans = chunk_spans(path.name, text, self.max_chunk_chars)
+            counter = 'chunked'
+        chunks = [
+            Chunk(name, kind, start, end, '\n'.join(lines[start - 1:end]))
+            for start, end, name, kind in spans
+        ]
+        with self._lock:
+            self.stats[counter] += 1
+            if counter == 'chunked':
+                self.stats['chunks'] += len(chunks)
+                self._tables[key] = {'mtime_ns': version[0], 'size': version[1], 'chunks': [list(span) for span in spans]}
+                self._dirty = True
+            self._memory[key] = (version, chunks)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_files:
+                self._memory.popitem(last=False)
+        return chunks
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Счётчики для /api/health"""
+        with self._lock:
+            return {**self.stats, 'files': len(self._tables), 'in_memory': len(self._memory)}
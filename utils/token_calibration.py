@@ -0,0 +1,268 @@
+"""
+Калибровка оценки токенов по данным провайдера (prompt_eval_count, usage)
+"""
+
+import os
+import re
+import json
+import logging
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from utils.token_counter import HeuristicCounter
+
+logger = logging.getLogger(__name__)
+
+# Признаки: служебные токены сообщения, затем символы по типам (на 100 символов)
+FEATURES = ('message', 'code', 'prose', 'cyrillic')
+# Начальные значения: токенов на сообщение и на 100 символов кода, текста, кириллицы
+PRIOR = (4.0, 30.0, 25.0, 40.0)
+# Допустимый диапазон каждого коэффициента
+BOUNDS = ((0.0, 50.0), (6.0, 150.0), (5.0, 125.0), (8.0, 200.0))
+
+_FENCE = re.compile(r'```.*?(?:```|\Z)', re.S)
+_CYRILLIC = re.compile('[\u0400-\u04FF]')
+
+
+def content_chars(text: str) -> Tuple[int, int, int]:
+    """Символы текста по типам: (код в ``` блоках, прочий текст, кириллица)"""
+    if not text:
+        return 0, 0, 0
+    cyrillic = len(_CYRILLIC.findall(text))
+    code = 0
+    for block in _FENCE.findall(text):
+        code += len(block) - len(_CYRILLIC.findall(block))
+    return code, len(text) - cyrillic - code, cyrillic
+
+
+def text_features(text: str, messages: int = 0) -> List[float]:
+    code, prose, cyrillic = content_chars(text)
+    return [float(messages), code / 100, prose / 100, cyrillic / 100]
+
+
+def _solve(matrix: List[List[float]], vector: List[float]) -> Optional[List[float]]:
+    """Решение линейной системы методом Гаусса с выбором главного элемента"""
+    n = len(vector)
+    rows = [list(matrix[i]) + [vector[i]] for i in range(n)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(rows[r][col]))
+        if abs(rows[pivot][col]) < 1e-12:
+            return None
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        for r in range(col + 1, n):
+            factor = rows[r][col] / rows[col][col]
+            for c in range(col, n + 1):
+                rows[r][c] -= factor * rows[col][c]
+    result = [0.0] * n
+    for r in range(n - 1, -1, -1):
+        result[r] = (rows[r][n] - sum(rows[r][c] * result[c] for c in range(r + 1, n))) / rows[r][r]
+    return result
+
+
+class _ModelState:
+    """Накопленные нормальные уравнения регрессии токенов по признакам одной модели"""
+
+    def __init__(self, data: Optional[Dict[str, Any]] = None):
+        n = len(FEATURES)
+        data = data or {}
+        self.matrix: List[List[float]] = data.get('matrix') or [[0.0] * n for _ in range(n)]
+        self.vector: List[float] = data.get('vector') or [0.0] * n
+        self.samples: int = data.get('samples', 0)
+        self.weights: List[float] = data.get('weights') or list(PRIOR)
+        # Поколение коэффициентов: растёт, когда они заметно изменились
+        self.generation = 0
+        self._published = list(self.weights)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'matrix': self.matrix, 'vector': self.vector, 'samples': self.samples, 'weights': self.weights}
+
+
+class TokenCalibrator:
+    """
+    Онлайн-оценка числа токенов на символ по фактическому расходу
+
+    Ollama (prompt_eval_count/eval_count) и OpenAI-совместимые серверы
+    (usage) сообщают точное число токенов запроса и ответа. Для каждой
+    модели коэффициенты подбираются взвешенной регрессией: токены =
+    служебные токены на сообщение + токены на символ кода, прочего текста
+    и кириллицы. Старые наблюдения затухают (decay), коэффициенты
+    притягиваются к начальным значениям, пока данных мало. Состояние
+    сохраняется в JSON и переживает перезапуск.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = "./cache/token_calibration.json",
+        decay: float = 0.98,
+        prior_weight: float = 1.0,
+        min_samples: int = 3,
+        save_every: int = 5,
+        generation_tolerance: float = 0.05
+    ):
+        """
+        Args:
+            path: Путь к JSON-файлу (None - только в памяти процесса)
+            decay: Множитель веса прошлых наблюдений при каждом новом
+            prior_weight: Сила притяжения к начальным коэффициентам
+            min_samples: Сколько наблюдений нужно, чтобы заменить обычную оценку
+            save_every: Сохранять файл каждые N наблюдений
+            generation_tolerance: Относительное изменение коэффициента, после которого
+                сохранённые оценки (число токенов сообщений истории) пересчитываются
+        """
+        self.path = Path(path) if path else None
+        self.decay = decay
+        self.prior_weight = prior_weight
+        self.min_samples = min_samples
+        self.save_every = max(1, save_every)
+        self.generation_tolerance = generation_tolerance
+        self._models: Dict[str, _ModelState] = {}
+        self._unsaved = 0
+        self._lock = threading.Lock()
+        self._load()
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> Optional['TokenCalibrator']:
+        """Создать из секции token_calibration конфигурации (None если выключено)"""
+        calibration_config = config.get('token_calibration', {}) or {}
+        if not calibration_config.get('enabled', True):
+            return None
+        return cls(
+            path=calibration_config.get('path', './cache/token_calibration.json'),
+            decay=calibration_config.get('decay', 0.98),
+        )
+
+    def _load(self):
+        if self.path is None or not self.path.exists():
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self._models = {model: _ModelState(state) for model, state in data.items()}
+        except (OSError, ValueError, TypeError) as e:
+            logger.debug(f"Калибровка токенов не прочитана: {e}")
+            self._models = {}
+
+    def save(self):
+        """Атомарная запись файла"""
+        if self.path is None:
+            return
+        with self._lock:
+            if not self._unsaved:
+                return
+            data = {model: state.to_dict() for model, state in self._models.items()}
+            self._unsaved = 0
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_suffix(self.path.suffix + '.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.debug(f"Калибровка токенов не сохранена: {e}")
+
+    def _fit(self, state: _ModelState):
+        """Коэффициенты гребневой регрессии с притяжением к PRIOR"""
+        n = len(FEATURES)
+        matrix = [
+            [state.matrix[i][j] + (self.prior_weight if i == j else 0.0) for j in range(n)]
+            for i in range(n)
+        ]
+        vector = [state.vector[i] + self.prior_weight * PRIOR[i] for i in range(n)]
+        weights = _solve(matrix, vector)
+        if weights is None:
+            return
+        state.weights = [min(max(w, low), high) for w, (low, high) in zip(weights, BOUNDS)]
+        if any(abs(w - p) > self.generation_tolerance * max(p, 1.0) for w, p in zip(state.weights, state._published)):
+            state.generation += 1
+            state._published = list(state.weights)
+
+    def observe(self, model: str, features: Sequence[float], tokens: int):
+        """Учесть наблюдение: признаки текста и фактическое число токенов"""
+        if tokens <= 0 or not any(features[1:]):
+            return
+        with self._lock:
+            state = self._models.setdefault(model, _ModelState())
+            n = len(FEATURES)
+            for i in range(n):
+                state.vector[i] = state.vector[i] * self.decay + features[i] * tokens
+                for j in range(n):
+                    state.matrix[i][j] = state.matrix[i][j] * self.decay + features[i] * features[j]
+            state.samples += 1
+            self._fit(state)
+            self._unsaved += 1
+            should_save = self._unsaved >= self.save_every
+        if should_save:
+            self.save()
+
+    def observe_request(self, model: str, messages: List[Dict], response: str, usage: Dict[str, int]):
+        """Наблюдения по одному запросу: промпт и ответ отдельно"""
+        prompt_tokens = usage.get('prompt_tokens', 0)
+        if prompt_tokens and messages:
+            features = [0.0] * len(FEATURES)
+            for message in messages:
+                for i, value in enumerate(text_features(message.get('content') or '', messages=1)):
+                    features[i] += value
+            self.observe(model, features, prompt_tokens)
+        completion_tokens = usage.get('completion_tokens', 0)
+        if completion_tokens and response:
+            self.observe(model, text_features(response), completion_tokens)
+
+    def calibrated(self, model: str) -> bool:
+        state = self._models.get(model)
+        return state is not None and state.samples >= self.min_samples
+
+    def estimate(self, model: str, text: str) -> int:
+        """Токены текста по коэффициентам модели (без служебных токенов сообщения)"""
+        weights = self._models[model].weights if model in self._models else PRIOR
+        features = text_features(text)
+        return int(sum(w * x for w, x in zip(weights[1:], features[1:])))
+
+    def generation(self, model: str) -> int:
+        state = self._models.get(model)
+        return state.generation if state is not None and self.calibrated(model) else 0
+
+    def message_overhead(self, model: str) -> int:
+        """Служебные токены на одно сообщение чата"""
+        weights = self._models[model].weights if self.calibrated(model) else PRIOR
+        return int(round(weights[0]))
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Коэффициенты по моделям для /api/health (символов на токен по типам)"""
+        with self._lock:
+            return {
+                model: {
+                    'samples': state.samples,
+                    'tokens_per_message': round(state.weights[0], 2),
+                    **{
+                        f'chars_per_token_{name}': round(100 / weight, 2)
+                        for name, weight in zip(FEATURES[1:], state.weights[1:])
+                    },
+                }
+                for model, state in self._models.items()
+            }
+
+
+class CalibratedCounter(HeuristicCounter):
+    """
+    Оценка без токенизатора: калиброванные коэффициенты модели, а пока
+    наблюдений мало - обычное число токенов на символ
+    """
+
+    name = 'calibrated'
+
+    def __init__(self, calibrator: TokenCalibrator, model: str, tokens_per_char: float = 0.25):
+        super().__init__(tokens_per_char)
+        self.calibrator = calibrator
+        self.model = model
+
+    @property
+    def version(self) -> str:
+        if self.calibrator.calibrated(self.model):
+            return f"{self.name}:{self.calibrator.generation(self.model)}"
+        return super().version
+
+    def count(self, text: str) -> int:
+        if self.calibrator.calibrated(self.model):
+            return self.calibrator.estimate(self.model, text)
+        return super().count(text)
@@ -0,0 +1,216 @@
+"""
+Подсчёт токенов: токенизатор модели или оценка по числу символов
+"""
+
+import os
+import logging
+import threading
+import importlib.util
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from utils.lazy import Lazy
+
+# Библиотеки токенизаторов импортируются при первом подсчёте (быстрый запуск)
+TOKENIZERS_AVAILABLE = importlib.util.find_spec('tokenizers') is not None
+TRANSFORMERS_AVAILABLE = importlib.util.find_spec('transformers') is not None
+
+logger = logging.getLogger(__name__)
+
+
+class HeuristicCounter:
+    """Оценка по числу символов (без токенизатора)"""
+
+    name = 'heuristic'
+
+    def __init__(self, tokens_per_char: float = 0.25):
+        self.tokens_per_char = tokens_per_char
+
+    @property
+    def version(self) -> str:
+        """Меняется, когда тот же текст начинает считаться иначе"""
+        return f"{self.name}:{self.tokens_per_char}"
+
+    def count(self, text: str) -> int:
+        return int(len(text) * self.tokens_per_char)
+
+
+class TokenizerFileCounter:
+    """Токенизатор из файла tokenizer.json (библиотека tokenizers)"""
+
+    name = 'tokenizer.json'
+
+    def __init__(self, path: str):
+        from tokenizers import Tokenizer
+
+        self.path = path
+        self.version = f"{self.name}:{path}"
+        self._tokenizer = Tokenizer.from_file(path)
+
+    def count(self, text: str) -> int:
+        return len(self._tokenizer.encode(text, add_special_tokens=False).ids)
+
+
+class TransformersCounter:
+    """Токенизатор Hugging Face (локальный каталог модели или кэш Hub, без сети)"""
+
+    name = 'transformers'
+
+    def __init__(self, name_or_path: str):
+        from transformers import AutoTokenizer
+
+        self.path = name_or_path
+        self.version = f"{self.name}:{name_or_path}"
+        self._tokenizer = AutoTokenizer.from_pretrained(name_or_path, local_files_only=True)
+
+    def count(self, text: str) -> int:
+        return len(self._tokenizer.encode(text, add_special_tokens=False))
+
+
+def load_tokenizer_counter(path: str):
+    """
+    Счётчик на токенизаторе модели
+
+    Args:
+        path: Файл tokenizer.json, каталог модели или имя модели на Hugging Face Hub
+
+    Raises:
+        ImportError: Нет библиотеки tokenizers/transformers
+        OSError: Файлы токенизатора не найдены
+    """
+    tokenizer_file = path
+    if os.path.isdir(path):
+        tokenizer_file = os.path.join(path, 'tokenizer.json')
+    if tokenizer_file.endswith('.json') and os.path.isfile(tokenizer_file) and TOKENIZERS_AVAILABLE:
+        return TokenizerFileCounter(tokenizer_file)
+    if not TRANSFORMERS_AVAILABLE:
+        raise ImportError("Для токенизатора модели требуется tokenizers или transformers")
+    return TransformersCounter(path)
+
+
+class TokenCounter:
+    """
+    Подсчёт токенов с запоминанием результатов
+
+    Токенизатор модели загружается при первом подсчёте; если его нет
+    (не указан, не найден, нет библиотеки), используется оценка по числу
+    символов. Повторяющиеся строки - системный промпт, описания
+    инструментов, сообщения истории - считаются один раз: результаты
+    хранятся в LRU, ограниченном числом записей и суммарной длиной строк.
+    """
+
+    def __init__(
+        self,
+        tokenizer_path: Optional[str] = None,
+        fallback: Optional[HeuristicCounter] = None,
+        memo_entries: int = 2048,
+        memo_max_chars: int = 4_000_000
+    ):
+        """
+        Args:
+            tokenizer_path: tokenizer.json, каталог модели или имя на Hub (None - только оценка)
+            fallback: Оценка по символам, когда токенизатора нет
+            memo_entries: Сколько результатов запоминать (0 - не запоминать)
+            memo_max_chars: Суммарная длина запомненных строк
+        """
+        self.tokenizer_path = tokenizer_path
+        self.fallback = fallback or HeuristicCounter()
+        self.memo_entries = memo_entries
+        self.memo_max_chars = memo_max_chars
+        self._backend = Lazy(self._load_backend) if tokenizer_path else None
+        self._memo: 'OrderedDict[str, int]' = OrderedDict()
+        self._memo_chars = 0
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0}
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any], model_name: str, fallback: Optional[HeuristicCounter] = None) -> 'TokenCounter':
+        """
+        Создать из секции tokenizer конфигурации
+
+        Без tokenizer.path для local_transformers берётся токенизатор самой
+        модели (model.model_path или имя модели); для серверных провайдеров
+        имя модели на сервере не соответствует файлам токенизатора, поэтому
+        путь нужно указать явно.
+
+        Args:
+            fallback: Оценка без токенизатора (например, калиброванная по данным провайдера)
+        """
+        tokenizer_config = config.get('tokenizer', {}) or {}
+        model_config = config.get('model', {}) or {}
+        path = tokenizer_config.get('path')
+        if not path and model_config.get('provider') == 'local_transformers':
+            path = model_config.get('model_path') or model_name
+        if not tokenizer_config.get('enabled', True):
+            path = None
+        return cls(tokenizer_path=path, fallback=fallback, memo_entries=tokenizer_config.get('memo_entries', 2048))
+
+    def _load_backend(self):
+        try:
+            backend = load_tokenizer_counter(self.tokenizer_path)
+            logger.info(f"Токены считаются токенизатором {self.tokenizer_path} ({backend.name})")
+            return backend
+        except Exception as e:
+            logger.warning(f"Токенизатор {self.tokenizer_path} недоступен, используется оценка по символам: {e}")
+            return None
+
+    @property
+    def backend(self):
+        """Токенизатор модели или оценка по символам"""
+        backend = self._backend.get() if self._backend else None
+        return backend or self.fallback
+
+    @property
+    def version(self) -> str:
+        """Версия подсчёта: сохранённые числа токенов с другой версией устарели"""
+        return self.backend.version
+
+    @property
+    def exact(self) -> bool:
+        """Считает ли счётчик настоящим токенизатором"""
+        return self.backend is not self.fallback
+
+    def count(self, text: str) -> int:
+        """Число токенов текста"""
+        if not text:
+            return 0
+        backend = self.backend
+        # Оценку по символам дешевле посчитать заново, чем хранить
+        if backend is self.fallback or self.memo_entries <= 0 or len(text) > self.memo_max_chars:
+            return backend.count(text)
+
+        with self._lock:
+            tokens = self._memo.get(text)
+            if tokens is not None:
+                self._memo.move_to_end(text)
+                self.stats['hits'] += 1
+                return tokens
+            self.stats['misses'] += 1
+
+        tokens = backend.count(text)
+        with self._lock:
+            if text not in self._memo:
+                self._memo[text] = tokens
+                self._memo_chars += len(text)
+                while len(self._memo) > self.memo_entries or self._memo_chars > self.memo_max_chars:
+                    old_text, _ = self._memo.popitem(last=False)
+                    self._memo_chars -= len(old_text)
+        return tokens
+
+    def clear(self):
+        with self._lock:
+            self._memo.clear()
+            self._memo_chars = 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Состояние счётчика для /api/health"""
+        # Статистика не должна загружать токенизатор
+        loaded = self._backend is None or self._backend.created
+        backend_name = self.backend.name if loaded else 'not loaded'
+        with self._lock:
+            return {
+                **self.stats,
+                'backend': backend_name,
+                'tokenizer_path': self.tokenizer_path,
+                'entries': len(self._memo),
+            }
@@ -0,0 +1,65 @@
+"""
+Число токенов сообщений истории, посчитанное один раз
+"""
+
+from typing import Dict, Iterable, List, Tuple
+
+from utils.token_counter import TokenCounter
+
+
+class TokenLedger:
+    """
+    Токены сообщений диалога
+
+    Число токенов сообщения считается при первом обращении и дальше
+    берётся из таблицы: сборка промпта и проверки бюджета не перечитывают
+    текст истории на каждом ходе. Сообщение узнаётся по объекту (и
+    объекту строки content), поэтому в сами словари истории ничего не
+    добавляется - они уходят провайдеру и в файлы истории как есть.
+    Смена токенизатора или заметная перекалибровка оценки (version
+    счётчика) сбрасывает таблицу.
+    """
+
+    def __init__(self, counter: TokenCounter):
+        self.counter = counter
+        self._entries: Dict[int, Tuple[Dict, str, int]] = {}
+        self._version = None
+        self.stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    def _check_version(self):
+        version = self.counter.version
+        if version != self._version:
+            if self._entries:
+                self.stats['invalidations'] += 1
+            self._entries.clear()
+            self._version = version
+
+    def count(self, message: Dict) -> int:
+        """Токены содержимого сообщения"""
+        self._check_version()
+        content = message.get('content') or ''
+        cached = self._entries.get(id(message))
+        if cached is not None and cached[0] is message and cached[1] is content:
+            self.stats['hits'] += 1
+            return cached[2]
+        self.stats['misses'] += 1
+        tokens = self.counter.count(content)
+        # Ссылка на сообщение не даёт переиспользовать его id, пока запись в таблице
+        self._entries[id(message)] = (message, content, tokens)
+        return tokens
+
+    def total(self, messages: Iterable[Dict]) -> int:
+        return sum(self.count(message) for message in messages)
+
+    def retain(self, messages: List[Dict]):
+        """Оставить в таблице только эти сообщения (после очистки или замены истории)"""
+        keep = {id(message) for message in messages}
+        self._entries = {key: entry for key, entry in self._entries.items() if key in keep}
+
+    @property
+    def valid(self) -> bool:
+        """Не устарели ли посчитанные числа (без пересчёта)"""
+        return self._version == self.counter.version
+
+    def get_stats(self) -> Dict[str, int]:
+        return {**self.stats, 'entries': len(self._entries)}
@@ -0,0 +1,246 @@
+"""
+Фоновое отслеживание загрузки модели и поддержание её "горячей"
+"""
+
+import time
+import logging
+import threading
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Состояния модели
+STATE_UNKNOWN = "unknown"
+STATE_LOADING = "loading"
+STATE_READY = "ready"
+STATE_UNAVAILABLE = "unavailable"
+
+
+class ModelWarmKeeper:
+    """
+    Фоновый поток, который следит, загружена ли модель на сервере
+
+    При старте агента модель предзагружается, а при простое сервер получает
+    дешёвые пинги, чтобы не выгружать её по таймауту. Код запросов ждёт
+    события готовности (wait_ready) вместо слепых time.sleep.
+
+    Ollama: состояние - /api/ps, загрузка и пинг - /api/generate без промпта
+    с keep_alive. LM Studio: состояние - /api/v0/models (поле state) или
+    /v1/models, загрузка и пинг - completion на 1 токен.
+    """
+
+    def __init__(
+        self,
+        http_pool,
+        provider: str,
+        base_url: str,
+        model_name: str,
+        keep_alive: str = "30m",
+        ping_interval: float = 240,
+        check_interval: float = 30,
+        request_timeout: float = 300
+    ):
+        """
+        Args:
+            http_pool: Пул HTTP-соединений агента
+            provider: "ollama" или "lmstudio"
+            base_url: Базовый URL сервера
+            model_name: Имя модели
+            keep_alive: Сколько Ollama держит модель в памяти после запроса
+            ping_interval: Пинговать модель после стольких секунд простоя
+            check_interval: Период проверки состояния (секунды)
+            request_timeout: Таймаут загрузки модели
+        """
+        self.http_pool = http_pool
+        self.provider = provider
+        self.base_url = base_url.rstrip('/')
+        self.model_name = model_name
+        self.keep_alive = keep_alive
+        self.ping_interval = ping_interval
+        self.check_interval = check_interval
+        self.request_timeout = request_timeout
+
+        self.state = STATE_UNKNOWN
+        self.ready_event = threading.Event()
+        self.last_activity = time.monotonic()
+        self.last_ping: Optional[float] = None
+        self.loads = 0
+        self.pings = 0
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any], http_pool, provider: str, base_url: str, model_name: str) -> Optional['ModelWarmKeeper']:
+        """Создать из секции warmup конфигурации (None если выключено или провайдер не поддерживается)"""
+        warmup_config = config.get('warmup', {}) or {}
+        if not warmup_config.get('enabled', True) or provider not in ("ollama", "lmstudio") or not base_url:
+            return None
+        return cls(
+            http_pool,
+            provider,
+            base_url,
+            model_name,
+            keep_alive=warmup_config.get('keep_alive', '30m'),
+            ping_interval=warmup_config.get('ping_interval', 240),
+            check_interval=warmup_config.get('check_interval', 30),
+            request_timeout=config.get(provider, {}).get('timeout', 300),
+        )
+
+    def start(self):
+        """Запустить фоновый поток (предзагрузка модели)"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="model-warm-keeper", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Остановить фоновый поток"""
+        self._stop_event.set()
+
+    def note_activity(self):
+        """Отметить реальный запрос к модели (пинги при активном трафике не нужны)"""
+        self.last_activity = time.monotonic()
+
+    def wait_ready(self, timeout: Optional[float] = None) -> bool:
+        """
+        Дождаться готовности модели
+
+        Ожидание прерывается сразу, если сервер недоступен: ждать имеет смысл
+        только загрузку модели, а не поднятие упавшего сервера.
+
+        Returns:
+            True если модель загружена, False по таймауту или при недоступном сервере
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.ready_event.is_set():
+            if self.state == STATE_UNAVAILABLE:
+                return False
+            wait = 0.5
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+            self.ready_event.wait(wait)
+        return True
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            logger.info(f"Модель {self.model_name}: {self.state} -> {state}")
+        self.state = state
+        if state == STATE_READY:
+            self.ready_event.set()
+        else:
+            self.ready_event.clear()
+
+    def _run(self):
+        """Цикл: проверка состояния, загрузка, пинги при простое"""
+        while not self._stop_event.is_set():
+            try:
+                loaded = self.is_loaded()
+                if loaded is None:
+                    self._set_state(STATE_UNAVAILABLE)
+                elif not loaded:
+                    self._set_state(STATE_LOADING)
+                    if self._ping():
+                        self.loads += 1
+                        self._set_state(STATE_READY)
+                    else:
+                        # Сервер не смог загрузить модель - запросы не должны её ждать
+                        self._set_state(STATE_UNAVAILABLE)
+                else:
+                    self._set_state(STATE_READY)
+                    idle = time.monotonic() - max(self.last_activity, self.last_ping or 0)
+                    if idle >= self.ping_interval and self._ping():
+                        self.pings += 1
+            except Exception as e:
+                logger.debug(f"Ошибка фоновой проверки модели: {e}")
+                self._set_state(STATE_UNAVAILABLE)
+            self._stop_event.wait(self.check_interval)
+
+    def is_loaded(self) -> Optional[bool]:
+        """
+        Загружена ли модель на сервере
+
+        Returns:
+            True/False, или None если сервер недоступен
+        """
+        if self.provider == "ollama":
+            response = self.http_pool.get(f"{self.base_url}/api/ps", timeout=5)
+            if response.status_code != 200:
+                return None
+            for model in response.json().get('models', []):
+                if self._matches(model.get('name') or model.get('model') or ''):
+                    return True
+            return False
+
+        # LM Studio: расширенный API сообщает состояние модели явно
+        response = self.http_pool.get(f"{self.base_url}/api/v0/models", timeout=5)
+        if response.status_code == 200:
+            for model in response.json().get('data', []):
+                if self._matches(model.get('id') or ''):
+                    return model.get('state') == 'loaded'
+            return False
+
+        response = self.http_pool.get(f"{self.base_url}/v1/models", timeout=5)
+        if response.status_code == 502:
+            return False  # Сервер отвечает, но модель ещё загружается
+        if response.status_code != 200:
+            return None
+        return any(self._matches(m.get('id') or '') for m in response.json().get('data', []))
+
+    @staticmethod
+    def _full_name(name: str) -> str:
+        """Имя модели с тегом: без тега Ollama подразумевает :latest (llama3 -> llama3:latest)"""
+        name = name.strip().lower()
+        if name and ':' not in name.rsplit('/', 1)[-1]:
+            name += ':latest'
+        return name
+
+    def _matches(self, model_id: str) -> bool:
+        """
+        Сравнение полных имён моделей
+
+        llama3:8b и llama3:70b - разные модели. Допускается только префикс
+        пути (издатель в id LM Studio, реестр в имени Ollama).
+        """
+        a, b = self._full_name(model_id), self._full_name(self.model_name)
+        return bool(a) and (a == b or a.endswith('/' + b) or b.endswith('/' + a))
+
+    def _ping(self) -> bool:
+        """Загрузить модель или продлить её жизнь в памяти сервера"""
+        self.last_ping = time.monotonic()
+        if self.provider == "ollama":
+            # generate без промпта только загружает модель и обновляет keep_alive
+            response = self.http_pool.post(
+                f"{self.base_url}/api/generate",
+                json={'model': self.model_name, 'keep_alive': self.keep_alive},
+                timeout=self.request_timeout
+            )
+        else:
+            response = self.http_pool.post(
+                f"{self.base_url}/v1/chat/completions",
+                json={
+                    'model': self.model_name,
+                    'messages': [{'role': 'user', 'content': 'ping'}],
+                    'max_tokens': 1,
+                    'stream': False,
+                },
+                timeout=self.request_timeout
+            )
+        ok = response.status_code == 200
+        response.close()
+        if not ok:
+            logger.debug(f"Пинг модели {self.model_name} вернул {response.status_code}")
+        return ok
+
+    def get_status(self) -> Dict[str, Any]:
+        """Состояние для /api/health"""
+        return {
+            'state': self.state,
+            'ready': self.ready_event.is_set(),
+            'idle_seconds': round(time.monotonic() - self.last_activity, 1),
+            'loads': self.loads,
+            'pings': self.pings,
+        }
@@ -2,23 +2,63 @@
 Веб-интерфейс для AI Code Agent
 """
 
+import asyncio
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
 from fastapi.responses import HTMLResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 import json
+import re
+from typing import Dict, Optional
 from agent import CodeAgent
 import uvicorn
 from pathlib import Path
 import os
 import yaml
 from ide_components import FileBrowser
+from utils.session_manager import SessionManager
+from utils.cancellation import CancellationToken
 
 # Инициализация агента
 agent = None
 agent_error = None
 
+# Сессии пользователей: у каждой вкладки своя история, общие ресурсы - от agent
+sessions: Optional[SessionManager] = None
+SESSION_COOKIE = "session_id"
+SESSION_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+
+def _session_id_from(connection) -> Optional[str]:
+    """Id сессии из query-параметра или cookie (HTTP-запрос или WebSocket)"""
+    session_id = connection.query_params.get(SESSION_COOKIE) or connection.cookies.get(SESSION_COOKIE)
+    if session_id and SESSION_ID_PATTERN.match(session_id):
+        return session_id
+    return None
+
+
+def _with_session_cookie(request: Request, response):
+    """Выдать странице cookie сессии, чтобы WebSocket и /api/chat попадали в одну сессию"""
+    if _session_id_from(request) is None:
+        response.set_cookie(SESSION_COOKIE, SessionManager.new_session_id(), httponly=True, samesite="lax")
+    return response
+
+
+def _init_sessions(retired=None):
+    """
+    Создать менеджер сессий или перепривязать существующие сессии к новому агенту
+
+    Args:
+        retired: Прежний агент - остановится, когда его не будет использовать ни одна сессия
+    """
+    global sessions
+    factory = lambda history=None: agent.fork_session(history)
+    if sessions is None:
+        sessions = SessionManager.from_config(factory, agent.config)
+    else:
+        sessions.rebind(factory, retired=retired)
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -28,13 +68,17 @@ async def lifespan(app: FastAPI):
     try:
         agent = CodeAgent()
         agent_error = None
+        _init_sessions()
         print("🤖 AI Code Agent запущен!")
     except Exception as e:
         agent_error = str(e)
         print(f"❌ Ошибка инициализации агента: {e}")
         print("⚠ Приложение запущено, но агент недоступен")
     yield
-    # Shutdown (если нужно что-то очистить)
+    # Shutdown: останавливаем фоновые задачи и закрываем асинхронные соединения агента
+    if agent is not None:
+        agent.shutdown()
+        await agent.aclose()
 
 
 app = FastAPI(title="AI Code Agent", lifespan=lifespan)
@@ -49,13 +93,13 @@ if static_path.exists():
 @app.get("/", response_class=HTMLResponse)
 async def home(request: Request):
     """Главная страница"""
-    return templates.TemplateResponse("index.html", {"request": request})
+    return _with_session_cookie(request, templates.TemplateResponse("index.html", {"request": request}))
 
 
 @app.get("/ide", response_class=HTMLResponse)
 async def ide(request: Request):
     """IDE страница"""
-    return templates.TemplateResponse("ide.html", {"request": request})
+    return _with_session_cookie(request, templates.TemplateResponse("ide.html", {"request": request}))
 
 
 @app.get("/settings", response_class=HTMLResponse)
@@ -79,17 +123,33 @@ async def chat(request: Request):
     if not prompt:
         return {"error": "Промпт не может быть пустым"}
     
+    session, created = sessions.get_or_create(_session_id_from(request))
+    
     async def generate():
         """Асинхронная генерация ответа"""
+        # Клиент закрыл соединение - Starlette отменяет генератор, а токен
+        # закрывает запрос к модели, чтобы она не генерировала впустую
+        cancel_token = CancellationToken()
+        answer = None
         try:
-            for chunk in agent.ask(prompt, stream=stream):
-                yield f"data: {json.dumps({'content': chunk})}\n\n"
+            async with session.lock:
+                # Агент берётся под блокировкой: после сохранения настроек сессия пересоздаётся здесь
+                answer = sessions.agent_for(session).aask(prompt, stream=stream, cancel_token=cancel_token)
+                async for chunk in answer:
+                    yield f"data: {json.dumps({'content': chunk})}\n\n"
             yield "data: [DONE]\n\n"
+        except (asyncio.CancelledError, GeneratorExit):
+            cancel_token.cancel("клиент отключился")
+            raise
         except Exception as e:
             yield f"data: {json.dumps({'error': str(e)})}\n\n"
             yield "data: [DONE]\n\n"
+        finally:
+            if answer is not None:
+                await answer.aclose()
+            sessions.touch(session)
     
-    return StreamingResponse(
+    response = StreamingResponse(
         generate(),
         media_type="text/event-stream",
         headers={
@@ -97,6 +157,31 @@ async def chat(request: Request):
             "Connection": "keep-alive",
         }
     )
+    if created:
+        response.set_cookie(SESSION_COOKIE, session.session_id, httponly=True, samesite="lax")
+    return response
+
+
+async def _ws_reader(websocket: WebSocket, incoming: asyncio.Queue, current: Dict[str, Optional[CancellationToken]]):
+    """
+    Чтение сообщений WebSocket параллельно с генерацией
+
+    Сообщение cancel и отключение клиента сразу отменяют текущую генерацию,
+    остальные сообщения передаются в очередь по порядку. Завершение чтения
+    (или его ошибка) передаётся в очередь последним элементом.
+    """
+    try:
+        while True:
+            message = json.loads(await websocket.receive_text())
+            if message.get("type") == "cancel":
+                if current['token'] is not None:
+                    current['token'].cancel("остановлено пользователем")
+                continue
+            await incoming.put(message)
+    except Exception as e:
+        if current['token'] is not None:
+            current['token'].cancel("клиент отключился" if isinstance(e, WebSocketDisconnect) else f"ошибка WebSocket: {e}")
+        await incoming.put(e)
 
 
 @app.websocket("/ws")
@@ -114,10 +199,20 @@ async def websocket_endpoint(websocket: WebSocket):
         await websocket.close()
         return
     
+    # Сессия определяется при рукопожатии (query-параметр session_id или cookie)
+    session_id = _session_id_from(websocket)
+    
+    # Сообщения читаются отдельной задачей, чтобы отключение клиента во время
+    # генерации сразу останавливало запрос к модели
+    incoming: asyncio.Queue = asyncio.Queue()
+    current: Dict[str, Optional[CancellationToken]] = {'token': None}
+    reader = asyncio.create_task(_ws_reader(websocket, incoming, current))
+    
     try:
         while True:
-            data = await websocket.receive_text()
-            message = json.loads(data)
+            message = await incoming.get()
+            if isinstance(message, Exception):
+                raise message
             
             if message.get("type") == "chat":
                 prompt = message.get("prompt", "")
@@ -129,29 +224,48 @@ async def websocket_endpoint(websocket: WebSocket):
                     })
                     continue
                 
+                # Сессия могла быть вытеснена за время простоя - тогда создаётся заново
+                session, _ = sessions.get_or_create(session_id)
+                session_id = session.session_id
+                
                 # Отправляем ответ по частям
+                cancel_token = CancellationToken()
+                current['token'] = cancel_token
+                answer = None
                 try:
                     full_response = ""
-                    for chunk in agent.ask(prompt, stream=True):
-                        full_response += chunk
-                        await websocket.send_json({
-                            "type": "chunk",
-                            "content": chunk
-                        })
+                    async with session.lock:
+                        answer = sessions.agent_for(session).aask(prompt, stream=True, cancel_token=cancel_token)
+                        async for chunk in answer:
+                            full_response += chunk
+                            await websocket.send_json({
+                                "type": "chunk",
+                                "content": chunk
+                            })
                     
-                    await websocket.send_json({
-                        "type": "done",
-                        "content": full_response
-                    })
+                    done = {"type": "done", "content": full_response}
+                    if cancel_token.cancelled:
+                        done.update(cancelled=True, tokens_saved=cancel_token.tokens_saved)
+                    await websocket.send_json(done)
                 except Exception as e:
-                    await websocket.send_json({
-                        "type": "error",
-                        "content": f"Ошибка генерации: {str(e)}"
-                    })
+                    if not reader.done():
+                        await websocket.send_json({
+                            "type": "error",
+                            "content": f"Ошибка генерации: {str(e)}"
+                        })
+                finally:
+                    # Ответ не дочитан (клиент ушёл) - закрываем генератор и запрос к модели
+                    if answer is not None:
+                        await answer.aclose()
+                    current['token'] = None
+                    sessions.touch(session)
             
             elif message.get("type") == "clear":
-                if agent:
-                    agent.clear_history()
+                session, _ = sessions.get_or_create(session_id)
+                session_id = session.session_id
+                async with session.lock:
+                    sessions.agent_for(session).clear_history()
+                sessions.touch(session)
                 await websocket.send_json({"type": "cleared"})
     
     except WebSocketDisconnect:
@@ -165,6 +279,8 @@ async def websocket_endpoint(websocket: WebSocket):
             })
         except:
             pass
+    finally:
+        reader.cancel()
 
 
 @app.get("/api/health")
@@ -175,6 +291,25 @@ async def health():
         "status": "ok" if agent else "error",
         "model": agent.model_name if agent else None,
         "provider": agent.provider if agent else None,
+        "http_pool": agent.http_pool.get_stats() if agent else None,
+        "async_http": agent.async_http.get_stats() if agent and agent.async_http else None,
+        "sessions": sessions.get_stats() if sessions else None,
+        "response_cache": agent.response_cache.get_stats() if agent and agent.response_cache else None,
+        "warmup": agent.warm_keeper.get_status() if agent and agent.warm_keeper else None,
+        "endpoints": agent.endpoints.get_stats() if agent and agent.endpoints else None,
+        "circuit_breaker": agent.circuit_breaker.get_status() if agent else None,
+        "retry": agent.retry_policy.get_stats() if agent else None,
+        "hedging": agent.hedger.get_stats() if agent and agent.hedger else None,
+        "cancellation": agent.cancel_stats if agent else None,
+        "local_model": agent.local_model.get_stats() if agent and agent.local_model else None,
+        "continuous_batching": agent.local_model.batch_engine.get_stats() if agent and agent.local_model and agent.local_model.batch_engine else None,
+        "prefix_cache": agent.local_model.prefix_cache.get_stats() if agent and agent.local_model and agent.local_model.prefix_cache else None,
+        "token_counter": agent.token_counter.get_stats() if agent else None,
+        "token_calibration": agent.token_calibrator.get_stats() if agent and agent.token_calibrator else None,
+        "context_packer": agent.context_packer.get_stats() if agent else None,
+        "prompt_cache": agent.prompt_cache_monitor.get_stats() if agent else None,
+        "history_compaction": agent.history_compactor.get_stats() if agent and agent.history_compactor else None,
+        "symbol_chunks": agent.project_context.chunk_index.get_stats() if agent and agent._project_context and agent._project_context.created and agent.project_context else None,
         "error": agent_error
     }
 
@@ -316,8 +451,17 @@ async def save_settings(request: Request):
         # Перезагружаем агента с новой конфигурацией
         global agent, agent_error
         try:
+            # Прежний агент не останавливаем сразу: его ещё могут использовать идущие запросы сессий
+            retired = agent
             agent = CodeAgent()
             agent_error = None
+            if sessions is None:
+                _init_sessions()
+                if retired is not None:
+                    retired.shutdown()
+                    await retired.aclose()
+            else:
+                _init_sessions(retired=retired)
         except Exception as e:
             agent_error = str(e)
             return {